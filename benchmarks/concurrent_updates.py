@@ -0,0 +1,85 @@
+"""
+Processes the updates of many concurrent users through PerUserUpdateProcessor and the real handlers of main.py, and
+reports how long updates take from their arrival until their handler finished, and the throughput.
+
+Uses the database of benchmarks/handlers.py and its stub bot, so only the bot's own processing is measured:
+
+    python benchmarks/concurrent_updates.py --users 200 --updates-per-user 20 --max-concurrent-updates 64
+
+Every user sends an update every --interval seconds without waiting for the earlier ones to be answered, the way
+Telegram delivers them to a webhook, so a user's updates queue up behind each other while other users' run.
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+
+# benchmarks/handlers.py puts the repository on sys.path
+import handlers as benchmark
+from handlers import BenchmarkContext, CommandCounter, SCENARIOS, StubBot
+from update_processor import PerUserUpdateProcessor
+
+
+async def run_user(processor, bot, target, scenarios, args, latencies):
+    # the user_data of every update is prepared up front, outside the measured time
+    updates = []
+    for number in range(args.updates_per_user):
+        _, handler_name, prepare, make_update, handler_args = scenarios[number % len(scenarios)]
+        updates.append((getattr(benchmark.handlers, handler_name), make_update(bot, target),
+                        BenchmarkContext(bot, await prepare(target), handler_args)))
+
+    async def process(handler, update, context):
+        arrived = time.perf_counter()
+        await processor.process_update(update, handler(update, context))
+        latencies.append(time.perf_counter() - arrived)
+
+    tasks = []
+    for handler, update, context in updates:
+        tasks.append(asyncio.create_task(process(handler, update, context)))
+        await asyncio.sleep(args.interval)
+    await asyncio.gather(*tasks)
+
+
+async def run(args, targets):
+    scenarios = [scenario for scenario in SCENARIOS
+                 if not args.scenario or any(pattern in '{}/{}'.format(*scenario[:2]) for pattern in args.scenario)]
+    processor = PerUserUpdateProcessor(args.max_concurrent_updates)
+    bot = StubBot()
+    latencies = []
+    for cache in benchmark.handlers.CACHES:
+        cache.clear()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run_user(processor, bot, target, scenarios, args, latencies) for target in targets))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print('updates:    {}'.format(len(latencies)))
+    print('elapsed:    {:.2f} s'.format(elapsed))
+    print('throughput: {:.1f} updates/s'.format(len(latencies) / elapsed))
+    print('latency:    p50 {:.1f} ms, p99 {:.1f} ms, from arrival until the handler finished'.format(
+        statistics.median(latencies) * 1000, benchmark.percentile(latencies, 0.99) * 1000))
+    print('bot calls:  {}'.format(sum(bot.calls.values())))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    benchmark.add_database_arguments(parser)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--updates-per-user', type=int, default=10)
+    parser.add_argument('--interval', type=float, default=0.01, help='seconds between two updates of a user')
+    parser.add_argument('--max-concurrent-updates', type=int, default=64)
+    parser.add_argument('--scenario', action='append', default=[],
+                        help='only send updates of scenarios whose state/handler name contains this, can be repeated')
+    args = parser.parse_args()
+
+    _, db = benchmark.connect(args, CommandCounter())
+    _, targets = benchmark.pick_targets(db, args.users, args.random_seed)
+    if not targets:
+        sys.exit('no users to send updates for')
+    asyncio.run(run(args, targets))
+
+
+if __name__ == '__main__':
+    main()
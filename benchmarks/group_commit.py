@@ -0,0 +1,93 @@
+"""
+Measures postings per second of repository.post_transaction, each posting written on its own vs. group commit.
+
+Many shops posting at the same time are simulated by concurrent tasks, each posting one entry after another:
+
+    python benchmarks/group_commit.py --shops 200 --postings-per-shop 50
+    python benchmarks/group_commit.py --group-commit-max-batch 200 --group-commit-delay-ms 2
+
+The benchmark uses its own database, never the bot's one, and drops it when done.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import database  # noqa: E402
+import repository  # noqa: E402
+from models import Transaction  # noqa: E402
+
+
+def seed(shops, debtors_per_shop):
+    shop_ids = database.shops_col.insert_many([{'name': 'shop {}'.format(shop), 'phone_number': str(shop)}
+                                               for shop in range(shops)]).inserted_ids
+    debtors = {}
+    for shop_id in shop_ids:
+        debtors[shop_id] = database.debtors_col.insert_many([
+            {'shop_id': shop_id, 'name': 'debtor {}'.format(debtor), 'phone_number': str(debtor), 'debt_amount': 0}
+            for debtor in range(debtors_per_shop)]).inserted_ids
+    return debtors
+
+
+async def run_shop(shop_id, debtor_ids, postings, rng, latencies):
+    for _ in range(postings):
+        is_payment = rng.random() < 0.4
+        amount = rng.randrange(1, 100) * 1000
+        transaction = Transaction('payment' if is_payment else 'debt', amount, datetime.now())
+        started = time.perf_counter()
+        await repository.post_transaction(rng.choice(debtor_ids), shop_id, transaction,
+                                          -amount if is_payment else amount, {'name': 1})
+        latencies.append(time.perf_counter() - started)
+
+
+async def run(args, group_commit):
+    debtors = await repository.run_in_executor(seed, args.shops, args.debtors_per_shop)
+    if group_commit:
+        repository.enable_group_commit(args.group_commit_max_batch, args.group_commit_delay_ms / 1000)
+
+    rng = random.Random(args.random_seed)
+    latencies = []
+    started = time.perf_counter()
+    await asyncio.gather(*(run_shop(shop_id, debtor_ids, args.postings_per_shop, random.Random(rng.random()),
+                                    latencies)
+                           for shop_id, debtor_ids in debtors.items()))
+    elapsed = time.perf_counter() - started
+    await repository.disable_group_commit()
+
+    latencies.sort()
+    print('{:<14} {:>8.0f} postings/s  p50 {:>7.2f} ms  p99 {:>7.2f} ms'.format(
+        'group commit' if group_commit else 'per request', len(latencies) / elapsed,
+        statistics.median(latencies) * 1000, latencies[int(len(latencies) * 0.99) - 1] * 1000))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--mongodb-uri', default='mongodb://localhost:27017/')
+    parser.add_argument('--database', default='qarz_daftar_benchmark_group_commit')
+    parser.add_argument('--shops', type=int, default=100, help='shops posting concurrently')
+    parser.add_argument('--debtors-per-shop', type=int, default=50)
+    parser.add_argument('--postings-per-shop', type=int, default=50)
+    parser.add_argument('--group-commit-max-batch', type=int, default=100)
+    parser.add_argument('--group-commit-delay-ms', type=float, default=5)
+    parser.add_argument('--random-seed', type=int, default=42)
+    args = parser.parse_args()
+
+    os.environ['MONGODB_URI'] = args.mongodb_uri
+    os.environ['MONGODB_DATABASE'] = args.database
+    client = database.get_client()
+    for group_commit in (False, True):
+        client.drop_database(args.database)
+        database.ensure_indexes()
+        asyncio.run(run(args, group_commit))
+    client.drop_database(args.database)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,398 @@
+"""
+Drives the real handlers of main.py against a seeded MongoDB and reports latency and MongoDB commands per handler.
+
+Seed the benchmark database once, then run the scenarios on every commit that should be compared:
+
+    python benchmarks/handlers.py --seed --shops 10 --debtors 1000 --transactions 20
+    python benchmarks/handlers.py --output before.json
+    git checkout <other commit>
+    python benchmarks/handlers.py --output after.json --baseline before.json
+
+Without a mongod, --in-memory runs against mongomock (pip install mongomock), which always seeds first and cannot
+count MongoDB commands; its latencies only compare with other in-memory runs.
+
+The handlers get real telegram Update objects whose bot answers every API call instantly, so the latency is the
+bot's own work: MongoDB round trips, caches and rendering. The benchmark uses its own database, never the bot's one.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo import monitoring
+from telegram import Update, Message, CallbackQuery, Chat, User, Contact
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import database  # noqa: E402
+import main as handlers  # noqa: E402
+import repository  # noqa: E402
+from models import Shop, Debtor  # noqa: E402
+
+FIRST_NAMES = ['Alisher', 'Bobur', 'Dilshod', 'Farrux', 'Jasur', 'Kamola', 'Laylo', 'Madina', 'Nodir', 'Olim',
+               'Rustam', 'Sardor', 'Shahnoza', 'Temur', 'Umida', 'Zafar', 'Гулноза', 'Шерзод', 'Ўткир', 'Ғайрат']
+LAST_NAMES = ['Aliyev', 'Karimov', 'Rahimov', 'Saidov', 'Tursunov', 'Umarov', 'Yusupov', 'Норматов', 'Қодиров']
+NICKNAMES = ['aka', 'opa', 'domla', 'usta', 'bratan', 'qo‘shni', 'ака', 'опа']
+INSERT_CHUNK_SIZE = 10000
+
+
+def shop_phone(shop):
+    return '+99899{:07d}'.format(shop)
+
+
+def debtor_phone(debtor):
+    # the same people owe money in many shops, so the debtor side sees debts in several shops
+    return '+99890{:07d}'.format(debtor)
+
+
+# Benchmark database ===================================================================================================
+class CommandCounter(monitoring.CommandListener):
+    """Counts the commands sent to MongoDB by command name and collection."""
+
+    def __init__(self):
+        self.commands = Counter()
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        self.commands['{} {}'.format(event.command_name, collection if isinstance(collection, str) else '')
+                      .strip()] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def insert_chunked(collection, docs):
+    chunk = []
+    for doc in docs:
+        chunk.append(doc)
+        if len(chunk) == INSERT_CHUNK_SIZE:
+            collection.insert_many(chunk, ordered=False)
+            chunk = []
+    if chunk:
+        collection.insert_many(chunk, ordered=False)
+
+
+def ledger_buckets(rng, debtor_id, shop_id, transactions, now):
+    """Returns the monthly ledger buckets of a debtor with `transactions` spread over the last year, and the balance."""
+    buckets = {}
+    balance = 0
+    timestamps = sorted(now - timedelta(seconds=rng.randrange(365 * 24 * 3600)) for _ in range(transactions))
+    for timestamp in timestamps:
+        is_payment = balance > 0 and rng.random() < 0.4
+        amount = rng.randrange(1, min(balance, 500000) // 1000 + 1) * 1000 if is_payment else \
+            rng.randrange(1, 200) * 1000
+        balance += -amount if is_payment else amount
+        bucket = buckets.setdefault(repository.ledger_bucket(timestamp), {
+            'debtor_id': debtor_id, 'shop_id': shop_id, 'timestamp': repository.ledger_bucket(timestamp),
+            'transactions': []})
+        bucket['transactions'].append({'type': 'payment' if is_payment else 'debt', 'amount': amount,
+                                       'timestamp': timestamp})
+    return list(buckets.values()), balance
+
+
+def seed(db, args):
+    rng = random.Random(args.random_seed)
+    now = datetime.now()
+    for collection_name in db.list_collection_names():
+        db.drop_collection(collection_name)
+    database.ensure_indexes()
+
+    for shop in range(args.shops):
+        shop_id = db['shops'].insert_one(Shop('shop {}'.format(shop), 'location {}'.format(shop),
+                                              shop_phone(shop)).to_doc()).inserted_id
+        debtors = []
+        ledger = []
+        for debtor in range(args.debtors):
+            name = '{} {}'.format(rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES))
+            doc = Debtor(name, rng.choice(NICKNAMES), debtor_phone(debtor), shop_id, 0).to_doc()
+            doc['_id'] = ObjectId()
+            buckets, doc['debt_amount'] = ledger_buckets(rng, doc['_id'], shop_id, args.transactions, now)
+            doc['last_activity'] = buckets[-1]['transactions'][-1]['timestamp'] if buckets else now
+            debtors.append(doc)
+            ledger.extend(buckets)
+        insert_chunked(db['debtors'], debtors)
+        insert_chunked(db['ledger'], ledger)
+        repository.rebuild_shop_summary(shop_id)
+        print('seeded shop {}/{}'.format(shop + 1, args.shops), file=sys.stderr)
+
+    db['benchmark'].replace_one({'_id': 'dataset'}, {'_id': 'dataset', 'shops': args.shops, 'debtors': args.debtors,
+                                                     'transactions': args.transactions,
+                                                     'random_seed': args.random_seed}, upsert=True)
+
+
+# Fake telegram objects ================================================================================================
+class StubBot:
+    """Stands in for telegram.Bot, answers every API call instantly and counts it."""
+
+    defaults = None
+
+    def __init__(self):
+        self.calls = Counter()
+
+    def __getattr__(self, name):
+        async def call(*_, **__):
+            self.calls[name] += 1
+            return True
+        return call
+
+
+class BenchmarkContext:
+    """The parts of CallbackContext the handlers use."""
+
+    def __init__(self, bot, user_data, args=None):
+        self.bot = bot
+        self.user_data = user_data
+        self.chat_data = {}
+        self.args = args or []
+
+
+def message_update(bot, target, text=None, contact=None):
+    user_id = target['user_id']
+    user = User(user_id, 'benchmark', False)
+    message = Message(1, datetime.now(), Chat(user_id, Chat.PRIVATE), from_user=user, text=text, contact=contact)
+    message.set_bot(bot)
+    return Update(1, message=message)
+
+
+def callback_update(bot, target, data):
+    user_id = target['user_id']
+    user = User(user_id, 'benchmark', False)
+    message = Message(1, datetime.now(), Chat(user_id, Chat.PRIVATE), from_user=user, text='benchmark')
+    message.set_bot(bot)
+    query = CallbackQuery('1', user, 'benchmark', message=message, data=data)
+    query.set_bot(bot)
+    return Update(1, callback_query=query)
+
+
+# Scenarios ============================================================================================================
+# Every scenario prepares user_data the way the preceding steps of the conversation leave it, without measuring that.
+async def prepare_shop(target):
+    return {'user_type': 'shop', 'shop_id': target['shop_id']}
+
+
+async def prepare_debtors_list(target):
+    user_data = await prepare_shop(target)
+    user_data['chosen_shop_menu'] = 'list_of_debtors'
+    user_data['debtors_list'] = handlers.new_debtors_list_state()
+    await handlers.get_debtors_list_keyboard(target['shop_id'], user_data['debtors_list'])
+    return user_data
+
+
+async def prepare_debtor(target):
+    user_data = await prepare_shop(target)
+    user_data['chosen_debtor_id'] = target['debtor_id']
+    return user_data
+
+
+async def prepare_debtor_role(target):
+    return {'user_type': 'debtor', 'debtor_phone_number': target['debtor_phone']}
+
+
+# state, handler, user_data preparation, update factory, command arguments
+SCENARIOS = [
+    ('SHOP_MENU', 'handle_shop_menu', prepare_shop, lambda bot, t: message_update(bot, t, '/shop_menu'), None),
+    ('SHOP_MENU', 'list_of_debtors', prepare_shop, lambda bot, t: message_update(bot, t, '📃 List of debtors'), None),
+    ('SHOP_MENU', 'report', prepare_shop, lambda bot, t: message_update(bot, t, '/report week'), ['week']),
+    ('LIST_OF_DEBTORS', 'list_of_debtors_page', prepare_debtors_list,
+     lambda bot, t: callback_update(bot, t, 'page_next'), None),
+    ('LIST_OF_DEBTORS', 'list_of_debtors_sort', prepare_debtors_list,
+     lambda bot, t: callback_update(bot, t, 'sort_name'), None),
+    ('LIST_OF_DEBTORS', 'choose_debtor', prepare_debtors_list,
+     lambda bot, t: callback_update(bot, t, str(t['debtor_id'])), None),
+    ('SEARCH_DEBTOR', 'search_debtor_by_phone', prepare_shop,
+     lambda bot, t: message_update(bot, t, t['debtor_phone']), None),
+    ('SEARCH_DEBTOR', 'search_debtor_by_name', prepare_shop,
+     lambda bot, t: message_update(bot, t, t['debtor_name'][:4]), None),
+    ('DEBTOR_INFO', 'debtor_info_transactions', prepare_debtor,
+     lambda bot, t: callback_update(bot, t, 'transactions'), None),
+    ('SEND_DEBT', 'handle_debt', prepare_debtor, lambda bot, t: message_update(bot, t, '10000'), None),
+    ('SEND_PAYMENT', 'handle_payment', prepare_debtor, lambda bot, t: message_update(bot, t, '5000'), None),
+    ('SIGN_IN_AS_DEBTOR', 'handle_debtor_phone_number', prepare_debtor_role,
+     lambda bot, t: message_update(bot, t, contact=Contact(t['debtor_phone'], 'benchmark', user_id=t['user_id'])),
+     None),
+    ('DEBTOR_OPTIONS', 'show_debts', prepare_debtor_role, lambda bot, t: message_update(bot, t, '/show_my_debts'),
+     None),
+    ('DEBTOR_OPTIONS', 'select_debt', prepare_debtor_role,
+     lambda bot, t: callback_update(bot, t, str(t['debtor_id'])), None),
+]
+
+
+def pick_targets(db, count, random_seed):
+    """Picks the same debtors on every run over the same dataset, so that results of two commits are comparable."""
+    dataset = db['benchmark'].find_one({'_id': 'dataset'})
+    if dataset is None:
+        sys.exit('The benchmark database is empty, run with --seed first.')
+
+    rng = random.Random(random_seed)
+    targets = []
+    for _ in range(count):
+        shop = db['shops'].find_one({'phone_number': shop_phone(rng.randrange(dataset['shops']))}, {'_id': 1})
+        debtor = db['debtors'].find_one({'shop_id': shop['_id'],
+                                         'phone_number': debtor_phone(rng.randrange(dataset['debtors']))},
+                                        {'name': 1, 'phone_number': 1})
+        # every target is a user of its own, so that they are told apart like different Telegram users
+        targets.append({'user_id': len(targets) + 1, 'shop_id': shop['_id'], 'debtor_id': debtor['_id'],
+                        'debtor_name': debtor['name'], 'debtor_phone': debtor['phone_number']})
+    return dataset, targets
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[max(0, int(round(len(sorted_values) * fraction)) - 1)]
+
+
+async def run_scenario(counter, targets, state, handler_name, prepare, make_update, args):
+    handler = getattr(handlers, handler_name)
+    bot = StubBot()
+    latencies = []
+    commands = Counter()
+    for cache in handlers.CACHES:
+        cache.clear()
+
+    for target in targets:
+        context = BenchmarkContext(bot, await prepare(target), args)
+        # targets share shops, a page or card rendered for an earlier target or by `prepare` would be measured as a hit
+        handlers.rendered_cache.clear()
+        update = make_update(bot, target)
+        counter.commands.clear()
+
+        started = time.perf_counter()
+        await handler(update, context)
+        latencies.append(time.perf_counter() - started)
+        commands.update(counter.commands)
+
+    latencies.sort()
+    runs = len(latencies)
+    return {
+        'state': state,
+        'handler': handler_name,
+        'runs': runs,
+        'p50_ms': round(statistics.median(latencies) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 3),
+        'mongo_commands': round(sum(commands.values()) / runs, 2),
+        'mongo_commands_by_type': {command: round(count / runs, 2) for command, count in sorted(commands.items())},
+        'bot_calls': round(sum(bot.calls.values()) / runs, 2),
+    }
+
+
+async def run_scenarios(counter, targets, selected):
+    results = {}
+    for state, handler_name, prepare, make_update, args in SCENARIOS:
+        name = '{}/{}'.format(state, handler_name)
+        if selected and not any(pattern in name for pattern in selected):
+            continue
+        results[name] = await run_scenario(counter, targets, state, handler_name, prepare, make_update, args)
+        print('{:<50} p50 {:>8.2f} ms  p99 {:>8.2f} ms  {:>6.2f} commands'.format(
+            name, results[name]['p50_ms'], results[name]['p99_ms'], results[name]['mongo_commands']), file=sys.stderr)
+    return results
+
+
+# Reporting ============================================================================================================
+def git_revision():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True,
+                                  text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_ROOT,
+                               capture_output=True, text=True, check=True).stdout.strip()
+        return revision + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_change(old, new):
+    return '{:.2f} -> {:.2f} {}'.format(old, new, '{:+.0%}'.format(new / old - 1) if old else '')
+
+
+def print_comparison(baseline, results):
+    if baseline['dataset'] != results['dataset']:
+        print('warning: the baseline was measured on a different dataset {}'.format(baseline['dataset']))
+
+    print('{:<50} {:>22} {:>22} {:>16}'.format('scenario', 'p50 ms', 'p99 ms', 'commands'))
+    for name, new in results['scenarios'].items():
+        old = baseline['scenarios'].get(name)
+        if old is None:
+            print('{:<50} (new)'.format(name))
+            continue
+        print('{:<50} {:>22} {:>22} {:>16}'.format(
+            name,
+            format_change(old['p50_ms'], new['p50_ms']),
+            format_change(old['p99_ms'], new['p99_ms']),
+            '{:g} -> {:g}'.format(old['mongo_commands'], new['mongo_commands'])))
+
+
+def add_database_arguments(parser):
+    parser.add_argument('--mongodb-uri', default='mongodb://localhost:27017/')
+    parser.add_argument('--database', default='qarz_daftar_benchmark')
+    parser.add_argument('--in-memory', action='store_true', help='use mongomock instead of a mongod')
+    parser.add_argument('--seed', action='store_true', help='drop and seed the benchmark database, then run')
+    parser.add_argument('--shops', type=int, default=10)
+    parser.add_argument('--debtors', type=int, default=1000, help='debtors per shop')
+    parser.add_argument('--transactions', type=int, default=20, help='transactions per debtor')
+    parser.add_argument('--random-seed', type=int, default=42)
+
+
+def connect(args, counter):
+    """Returns the bot's client and database, counting their commands with `counter` and seeding them if asked to."""
+    # the bot's client is created on first use, from these variables and with the listeners registered by then
+    os.environ['MONGODB_URI'] = args.mongodb_uri
+    os.environ['MONGODB_DATABASE'] = args.database
+    monitoring.register(counter)
+    if args.in_memory:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit('--in-memory needs mongomock, pip install mongomock')
+        database._client = mongomock.MongoClient()
+    client = database.get_client()
+    db = database.get_database()
+    if args.seed or args.in_memory:
+        seed(db, args)
+    return client, db
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    add_database_arguments(parser)
+    parser.add_argument('--runs', type=int, default=200, help='runs per scenario')
+    parser.add_argument('--scenario', action='append', default=[],
+                        help='only run scenarios whose state/handler name contains this, can be repeated')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    counter = CommandCounter()
+    client, db = connect(args, counter)
+    dataset, targets = pick_targets(db, args.runs, args.random_seed)
+    dataset.pop('_id')
+    results = {
+        'revision': git_revision(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'server_version': 'mongomock' if args.in_memory else client.server_info().get('version'),
+        'dataset': dataset,
+        'scenarios': asyncio.run(run_scenarios(counter, targets, args.scenario)),
+    }
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            print_comparison(json.load(baseline_file), results)
+    elif not args.output:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
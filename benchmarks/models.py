@@ -0,0 +1,94 @@
+"""
+Measures memory per cached debtor and decode time of large debtor batches, as dicts vs. slotted models.
+
+Debtors are encoded to BSON once and decoded the way pymongo does, then turned into models in full and with the
+projection of the debtor list:
+
+    python benchmarks/models.py --debtors 100000
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import bson
+from bson import ObjectId
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from models import Debtor  # noqa: E402
+
+LIST_PROJECTION = {'name': 1, 'debt_amount': 1, 'last_activity': 1}
+
+
+def debtor_docs(count):
+    shop_id = ObjectId()
+    now = datetime.now().replace(microsecond=0)
+    docs = []
+    for number in range(count):
+        doc = Debtor('debtor {}'.format(number), 'nick {}'.format(number % 100), '+998{:09d}'.format(number), shop_id,
+                     number % 50 * 1000).to_doc()
+        doc.update(_id=ObjectId(), last_activity=now - timedelta(hours=number), remind_at=now + timedelta(days=3))
+        docs.append(doc)
+    return docs
+
+
+def project(doc, projection):
+    return {key: value for key, value in doc.items() if key == '_id' or projection.get(key)}
+
+
+def bytes_per_object(build):
+    """Returns the memory a list built by `build` holds per element, the elements' values included."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / len(objects)
+
+
+def timed(func, runs):
+    """Returns the median time of `runs` calls of `func`."""
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - started)
+    return statistics.median(times)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--debtors', type=int, default=50000)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    docs = debtor_docs(args.debtors)
+    full_data = b''.join(bson.encode(doc) for doc in docs)
+    list_data = b''.join(bson.encode(project(doc, LIST_PROJECTION)) for doc in docs)
+
+    print('{} debtors'.format(args.debtors))
+    print('memory per cached debtor')
+    print('  {:<24} {:>8.0f} bytes'.format('dict', bytes_per_object(lambda: bson.decode_all(full_data))))
+    print('  {:<24} {:>8.0f} bytes'.format('Debtor', bytes_per_object(
+        lambda: Debtor.from_docs(bson.decode_all(full_data)))))
+    print('  {:<24} {:>8.0f} bytes'.format('dict, list projection', bytes_per_object(
+        lambda: bson.decode_all(list_data))))
+    print('  {:<24} {:>8.0f} bytes'.format('Debtor, list projection', bytes_per_object(
+        lambda: Debtor.from_docs(bson.decode_all(list_data), LIST_PROJECTION))))
+
+    print('decode time per debtor, BSON to dict to model')
+    for name, data, projection in [('full', full_data, None), ('list projection', list_data, LIST_PROJECTION)]:
+        decoded = bson.decode_all(data)
+        bson_time = timed(lambda: bson.decode_all(data), args.runs)
+        model_time = timed(lambda: Debtor.from_docs(decoded, projection), args.runs)
+        print('  {:<24} BSON {:>6.2f} us + from_doc {:>6.2f} us'.format(
+            name, bson_time / args.debtors * 1e6, model_time / args.debtors * 1e6))
+
+
+if __name__ == '__main__':
+    main()
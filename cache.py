@@ -0,0 +1,71 @@
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Size bounded LRU cache whose entries expire `ttl` seconds after they were stored.
+    Not thread-safe, it is only used from the event loop.
+
+    A value read while the event loop awaits may be older than an invalidation that ran meanwhile: `set` it with the
+    `generation` taken before the read, and it is dropped if its key was invalidated since.
+    """
+
+    def __init__(self, name, maxsize, ttl):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self.generation = 0
+        # the generation each recently invalidated key was invalidated at, and the newest one forgotten of them
+        self._invalidated = OrderedDict()
+        self._forgotten = 0
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, generation=None):
+        if generation is not None and self._invalidated.get(key, self._forgotten) > generation:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+        self.generation += 1
+        self._invalidated[key] = self.generation
+        self._invalidated.move_to_end(key)
+        while len(self._invalidated) > self.maxsize:
+            self._forgotten = self._invalidated.popitem(last=False)[1]
+
+    def clear(self):
+        self._entries.clear()
+        self.generation += 1
+        self._invalidated.clear()
+        self._forgotten = self.generation
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests else 0.0,
+        }
@@ -0,0 +1,208 @@
+import logging
+import threading
+import time
+from os import environ
+from urllib.parse import parse_qsl
+
+import pymongo
+from pymongo import IndexModel
+from pymongo.errors import OperationFailure
+from pymongo.read_preferences import SecondaryPreferred
+
+from metrics import command_metrics, pool_metrics
+
+logger = logging.getLogger(__name__)
+
+# MongoDB connection ===================================================================================================
+# MongoClient keyword argument, environment variable, type and default. The variable wins over the URI, the default
+# only applies if the URI does not set the option either; options without a default are left to pymongo's own defaults
+CLIENT_OPTIONS = [
+    ('maxPoolSize', 'MONGODB_MAX_POOL_SIZE', int, None),
+    ('minPoolSize', 'MONGODB_MIN_POOL_SIZE', int, None),
+    ('maxIdleTimeMS', 'MONGODB_MAX_IDLE_TIME_MS', int, None),
+    # a request waiting longer than this for a pooled connection fails instead of piling up
+    ('waitQueueTimeoutMS', 'MONGODB_WAIT_QUEUE_TIMEOUT_MS', int, 10000),
+    ('serverSelectionTimeoutMS', 'MONGODB_SERVER_SELECTION_TIMEOUT_MS', int, 5000),
+    ('connectTimeoutMS', 'MONGODB_CONNECT_TIMEOUT_MS', int, 5000),
+    ('socketTimeoutMS', 'MONGODB_SOCKET_TIMEOUT_MS', int, 30000),
+    ('compressors', 'MONGODB_COMPRESSORS', str, 'zlib'),
+    ('readPreference', 'MONGODB_READ_PREFERENCE', str, None),
+    ('appname', 'MONGODB_APP_NAME', str, 'qarz_daftar'),
+]
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def client_options(uri):
+    # the query string rather than pymongo's URI parser, which resolves mongodb+srv:// hosts through DNS
+    uri_options = {name.lower() for name, _ in parse_qsl(uri.partition('?')[2])}
+    options = {}
+    for option, variable, cast, default in CLIENT_OPTIONS:
+        value = environ.get(variable)
+        if value is not None:
+            options[option] = cast(value)
+        elif default is not None and option.lower() not in uri_options:
+            options[option] = default
+    return options
+
+
+def get_client():
+    """Returns the MongoClient, creating it on first use so that importing the bot's modules does not connect."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                uri = environ.get('MONGODB_URI', 'mongodb://localhost:27017/')
+                _client = pymongo.MongoClient(uri, event_listeners=[command_metrics, pool_metrics],
+                                              **client_options(uri))
+    return _client
+
+
+def get_database():
+    return get_client()[environ.get('MONGODB_DATABASE', 'qarz_daftar')]
+
+
+def max_staleness():
+    """Seconds a secondary may lag behind the primary and still serve reads, MongoDB's minimum is 90."""
+    return int(environ.get('MONGODB_MAX_STALENESS_SECONDS', 90))
+
+
+class LazyCollection:
+    """
+    Stands in for a collection of the bot's database and resolves it on first use. With `secondary_reads`, reads go to
+    a secondary that lags no more than max_staleness(), or to the primary if there is none.
+    """
+
+    def __init__(self, name, secondary_reads=False):
+        self.name = name
+        self.secondary_reads = secondary_reads
+        self._collection = None
+
+    def __getattr__(self, attribute):
+        if self._collection is None:
+            collection = get_database()[self.name]
+            if self.secondary_reads:
+                collection = collection.with_options(read_preference=SecondaryPreferred(max_staleness=max_staleness()))
+            self._collection = collection
+        return getattr(self._collection, attribute)
+
+
+debtors_col = LazyCollection('debtors')
+shops_col = LazyCollection('shops')
+# transactions of a debtor, bucketed per calendar month
+ledger_col = LazyCollection('ledger')
+# one document per shop with its running totals, `_id` is the shop's `_id`
+shop_summaries_col = LazyCollection('shop_summaries')
+# debts and payments of closed report periods, see reports.py
+report_cache_col = LazyCollection('report_cache')
+# chat of every debtor who signed in to the bot, `_id` is the phone number
+debtor_chats_col = LazyCollection('debtor_chats')
+# last resume token of every change stream watcher, see notifier.py
+change_stream_tokens_col = LazyCollection('change_stream_tokens')
+# staleness tolerant reads: lists, search, history, reports and exports, see repository.read_session for reading
+# one's own writes from them
+debtors_secondary_col = LazyCollection('debtors', secondary_reads=True)
+ledger_secondary_col = LazyCollection('ledger', secondary_reads=True)
+# bot persistence
+user_data_col = LazyCollection('user_data')
+conversations_col = LazyCollection('conversations')
+
+
+def supports_transactions():
+    """Multi-document transactions need a replica set or a sharded cluster, a standalone mongod has none."""
+    return get_client().topology_description.topology_type_name in ('ReplicaSetWithPrimary', 'Sharded')
+
+
+def supports_change_streams():
+    """Change streams read the oplog, which a standalone mongod does not have either."""
+    return supports_transactions()
+
+
+# Indexes ==============================================================================================================
+INDEXES = {
+    'debtors': [
+        # shop side lookups, one phone number per shop
+        IndexModel([('shop_id', pymongo.ASCENDING), ('phone_number', pymongo.ASCENDING)],
+                   name='shop_id_phone_number', unique=True),
+        # debtor side lookups in /show_my_debts
+        IndexModel([('phone_number', pymongo.ASCENDING)], name='phone_number'),
+        # keyset pagination of the debtor list, one index per sort order
+        IndexModel([('shop_id', pymongo.ASCENDING), ('debt_amount', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)],
+                   name='shop_id_debt_amount'),
+        IndexModel([('shop_id', pymongo.ASCENDING), ('name', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)],
+                   name='shop_id_name'),
+        IndexModel([('shop_id', pymongo.ASCENDING), ('last_activity', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)],
+                   name='shop_id_last_activity'),
+        # prefix search by normalized name and nickname, see search.py
+        IndexModel([('shop_id', pymongo.ASCENDING), ('search_keys', pymongo.ASCENDING)], name='shop_id_search_keys'),
+        # ledger export walks the debtors of a shop in _id order
+        IndexModel([('shop_id', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)], name='shop_id_id'),
+        # reminder sweeps, only debtors with a scheduled reminder are indexed
+        IndexModel([('remind_at', pymongo.ASCENDING)], name='remind_at',
+                   partialFilterExpression={'remind_at': {'$exists': True}}),
+    ],
+    'shops': [
+        IndexModel([('phone_number', pymongo.ASCENDING)], name='phone_number', unique=True),
+    ],
+    'ledger': [
+        # one bucket per debtor and month, `timestamp` is the first moment of the month
+        IndexModel([('debtor_id', pymongo.ASCENDING), ('timestamp', pymongo.ASCENDING)],
+                   name='debtor_id_timestamp', unique=True),
+        # ledger export merges the buckets of a shop with its debtors in debtor_id order
+        IndexModel([('shop_id', pymongo.ASCENDING), ('debtor_id', pymongo.ASCENDING), ('timestamp', pymongo.ASCENDING)],
+                   name='shop_id_debtor_id_timestamp'),
+        # period reports of a shop
+        IndexModel([('shop_id', pymongo.ASCENDING), ('timestamp', pymongo.ASCENDING)], name='shop_id_timestamp'),
+    ],
+    'report_cache': [
+        IndexModel([('shop_id', pymongo.ASCENDING), ('unit', pymongo.ASCENDING), ('start', pymongo.ASCENDING)],
+                   name='shop_id_unit_start', unique=True),
+    ],
+    'conversations': [
+        IndexModel([('name', pymongo.ASCENDING)], name='name'),
+    ],
+}
+
+
+def ensure_indexes(missing_only=False):
+    """Creates the indexes of INDEXES, with `missing_only` just the ones the collections do not have yet."""
+    db = get_database()
+    for collection_name, indexes in INDEXES.items():
+        if missing_only:
+            existing = {index.get('name') for index in db[collection_name].list_indexes()}
+            indexes = [index for index in indexes if index.document.get('name') not in existing]
+            if not indexes:
+                continue
+        try:
+            created = db[collection_name].create_indexes(indexes)
+            logger.info('{}: {}'.format(collection_name, ', '.join(created)))
+        except OperationFailure as error:
+            logger.error('Index creation failed on {}: {}'.format(collection_name, error))
+
+
+# Health ===============================================================================================================
+def check_readiness():
+    """
+    Fails fast with a PyMongoError when MongoDB cannot be reached within the server selection timeout, then creates
+    the indexes that are missing. Returns the round trip time of the ping in seconds.
+    """
+    started = time.perf_counter()
+    get_client().admin.command('ping')
+    ping = time.perf_counter() - started
+
+    ensure_indexes(missing_only=True)
+    return ping
+
+
+def health():
+    """Returns the ping time, the topology and the utilization of the connection pool of every server."""
+    client = get_client()
+    started = time.perf_counter()
+    client.admin.command('ping')
+    return {
+        'ping': time.perf_counter() - started,
+        'topology': client.topology_description.topology_type_name,
+        'max_pool_size': client.options.pool_options.max_pool_size,
+        'pools': pool_metrics.stats(),
+    }
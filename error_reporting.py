@@ -0,0 +1,113 @@
+import asyncio
+import html
+import os
+import time
+import traceback
+
+from telegram import Update
+from telegram.constants import ParseMode
+
+# frames of the bot's own modules locate an error better than the library frames it was raised from
+BOT_ROOT = os.path.dirname(os.path.abspath(__file__))
+# characters of the traceback shown per error, a summary message holds 4096
+TRACEBACK_LIMIT = 1500
+MESSAGE_LIMIT = 4096
+
+
+def fingerprint(error):
+    """Returns what identifies an error across occurrences: its type and the innermost frame of the bot's own code."""
+    frames = traceback.extract_tb(error.__traceback__)
+    own_frames = [frame for frame in frames if os.path.abspath(frame.filename).startswith(BOT_ROOT + os.sep)]
+    frame = (own_frames or frames or [None])[-1]
+    location = '{}:{} in {}'.format(os.path.relpath(frame.filename, BOT_ROOT), frame.lineno, frame.name) \
+        if frame is not None else 'unknown location'
+    return '{} at {}'.format(type(error).__name__, location)
+
+
+def describe_update(update):
+    if not isinstance(update, Update):
+        return 'no update' if update is None else type(update).__name__
+    user = update.effective_user
+    kind = 'callback query' if update.callback_query else 'message' if update.message else 'update'
+    return '{} {} from user {}'.format(kind, update.update_id, user.id if user else None)
+
+
+class ErrorReporter:
+    """
+    Reports the errors of the handlers to the developer chat through the outbox, as one summary every `window`
+    seconds with a count per fingerprint instead of one message per error. An error already reported is reported
+    again at most every `interval` seconds, with the count of all its occurrences since. Recording is cheap, so an
+    outage that makes every handler fail does not flood the chat nor hold up the handlers.
+    """
+
+    def __init__(self, outbox, chat_id, window=60.0, interval=600.0, max_fingerprints=100):
+        self.outbox = outbox
+        self.chat_id = chat_id
+        self.window = window
+        self.interval = interval
+        self.max_fingerprints = max_fingerprints
+        # fingerprint -> [count, first occurrence's traceback, first occurrence's update]
+        self._pending = {}
+        self._overflow = 0
+        self._reported_at = {}
+        self._task = None
+
+    def record(self, error, update=None):
+        key = fingerprint(error)
+        pending = self._pending.get(key)
+        if pending is not None:
+            pending[0] += 1
+        elif len(self._pending) < self.max_fingerprints:
+            self._pending[key] = [1, ''.join(traceback.format_exception(None, error, error.__traceback__)),
+                                  describe_update(update)]
+        else:
+            self._overflow += 1
+
+    def start(self):
+        self._task = asyncio.create_task(self._run(), name='error-reporter')
+
+    async def stop(self):
+        """Stops the background task and hands whatever was recorded since the last summary to the outbox."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.flush(ignore_interval=True)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.window)
+            self.flush()
+
+    def flush(self, now=None, ignore_interval=False):
+        """Sends a summary of the errors whose fingerprint may be reported again, the others keep counting."""
+        now = time.monotonic() if now is None else now
+        due = [(key, pending) for key, pending in self._pending.items()
+               if ignore_interval or key not in self._reported_at or now - self._reported_at[key] >= self.interval]
+        overflow, self._overflow = self._overflow, 0
+        if not due and not overflow:
+            return
+
+        sections = []
+        for key, (count, traceback_text, update) in sorted(due, key=lambda item: -item[1][0]):
+            del self._pending[key]
+            self._reported_at[key] = now
+            sections.append('<b>{:,}× {}</b>\nfirst on {}\n<pre>{}</pre>'.format(
+                count, html.escape(key), html.escape(update), html.escape(traceback_text[-TRACEBACK_LIMIT:])))
+        if overflow:
+            sections.append('<b>{:,}×</b> errors of other fingerprints'.format(overflow))
+        # fingerprints that have not been seen for a while may be reported right away again
+        self._reported_at = {key: reported_at for key, reported_at in self._reported_at.items()
+                             if now - reported_at < self.interval}
+
+        header = '⚠️ {:,} errors'.format(sum(pending[0] for _, pending in due) + overflow)
+        message = header
+        for section in sections:
+            if len(message) + len(section) + 2 > MESSAGE_LIMIT:
+                self.outbox.send(self.chat_id, message, parse_mode=ParseMode.HTML)
+                message = header + ' (continued)'
+            message += '\n\n' + section
+        self.outbox.send(self.chat_id, message, parse_mode=ParseMode.HTML)
@@ -0,0 +1,80 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+_CLOSE = object()
+
+
+class GroupCommitter:
+    """
+    Collects operations submitted from many handlers and writes them in batches: a batch is flushed `max_delay`
+    seconds after its first operation or as soon as it has `max_batch` operations, and the next batch collects while
+    the previous one is written. `flush` is a coroutine function taking the list of operations and returning one
+    result per operation, every submitter gets its own result or the batch's exception.
+    """
+
+    def __init__(self, flush, max_batch=100, max_delay=0.005):
+        self.flush = flush
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.batches = 0
+        self.operations = 0
+        self._queue = asyncio.Queue()
+        self._closed = False
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run(), name='group-commit')
+
+    async def submit(self, operation):
+        if self._closed:
+            raise RuntimeError('Group commit is closed')
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((operation, future))
+        return await future
+
+    async def close(self):
+        """Stops taking operations and returns once everything submitted so far is written."""
+        self._closed = True
+        self._queue.put_nowait((_CLOSE, None))
+        await self._task
+        logger.info('Group commit wrote {} operations in {} batches'.format(self.operations, self.batches))
+
+    async def _collect(self):
+        """Returns the next batch and whether the committer was closed while it was collected."""
+        loop = asyncio.get_running_loop()
+        batch = []
+        operation, future = await self._queue.get()
+        deadline = loop.time() + self.max_delay
+        while operation is not _CLOSE:
+            batch.append((operation, future))
+            if len(batch) >= self.max_batch:
+                return batch, False
+            if self._queue.empty():
+                try:
+                    operation, future = await asyncio.wait_for(self._queue.get(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    return batch, False
+            else:
+                operation, future = self._queue.get_nowait()
+        return batch, True
+
+    async def _run(self):
+        closed = False
+        while not closed:
+            batch, closed = await self._collect()
+            if not batch:
+                continue
+            try:
+                results = await self.flush([operation for operation, _ in batch])
+            except Exception as error:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+            else:
+                for (_, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+            self.batches += 1
+            self.operations += len(batch)
@@ -1,22 +1,32 @@
-import html
-import json
+import csv
+import gzip
 import logging
+import os
 import re
 import sys
-import traceback
+import tempfile
 from datetime import datetime
+from io import BytesIO
 from os import environ
 
-import pymongo
 from bson import ObjectId
 from pymongo.errors import PyMongoError
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup, \
     ReplyKeyboardRemove
-from telegram.constants import ParseMode
-from telegram.ext import PicklePersistence, Application, ContextTypes, CommandHandler, ConversationHandler, \
+from telegram.ext import Application, ContextTypes, CommandHandler, ConversationHandler, \
     MessageHandler, filters, CallbackQueryHandler
 
-from models import Shop, Debtor
+import metrics
+import reports
+import repository
+import database
+from cache import TTLCache
+from error_reporting import ErrorReporter
+from notifier import BalanceNotifier
+from outbox import Outbox
+from persistence import MongoPersistence
+from update_processor import PerUserUpdateProcessor
+from models import Shop, Debtor, Transaction
 
 # Logging ==============================================================================================================
 logging.basicConfig(
@@ -29,12 +39,6 @@ logging.basicConfig(
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
-# MongoDB connection ===================================================================================================
-myclient = pymongo.MongoClient('mongodb://localhost:27017/')
-qarz_daftar_db = myclient['qarz_daftar']
-debtors_col = qarz_daftar_db['debtors']
-shops_col = qarz_daftar_db['shops']
-
 # Constants for conversation states ====================================================================================
 (SIGN_IN,
  SIGN_IN_AS_DEBTOR,
@@ -56,44 +60,104 @@ shops_col = qarz_daftar_db['shops']
  CHECK_NEW_DEBTOR_DATA,
  DEBTOR_ALREADY_EXISTS,
  DEBTOR_OPTIONS,
- TRANSACTIONS) = range(21)
+ TRANSACTIONS,
+ IMPORT_DEBTORS) = range(22)
+
+# names of the states above, the labels of handler metrics
+STATE_NAMES = {state: name for name, state in list(globals().items()) if name.isupper() and isinstance(state, int)}
 
 # Regex constants ======================================================================================================
 DEBTOR_PHONE_REGEX = '^\+998\d{9}$'
 AMOUNT_REGEX = '^\d+$'
 
+# List of debtors ======================================================================================================
+DEBTORS_PAGE_SIZE = 20
+DEBTORS_LIST_SORTS = {'debt': '💰', 'name': '🔤', 'recent': '🕒'}
+
+# Search of debtors ====================================================================================================
+SEARCH_RESULTS_LIMIT = 50
+SEARCH_PAGE_SIZE = 10
+
+# Import of debtors ====================================================================================================
+IMPORT_DEBTORS_COLUMNS = ['name', 'nickname', 'phone_number', 'debt_amount']
+IMPORT_DEBTORS_CHUNK_SIZE = 500
+
+# Ledger export ========================================================================================================
+EXPORT_LEDGER_COLUMNS = ['name', 'nickname', 'phone_number', 'debt_amount', 'type', 'amount', 'timestamp']
+
+# Transactions =========================================================================================================
+TRANSACTIONS_PAGE_SIZE = 20
+
+# Reminders ============================================================================================================
+REMINDERS_SWEEP_INTERVAL = int(environ.get('REMINDERS_SWEEP_INTERVAL', 600))
+REMINDERS_BATCH_SIZE = 500
+REMINDER_PROJECTION = {'shop_id': 1, 'phone_number': 1, 'debt_amount': 1, 'last_activity': 1}
+MAX_REMINDER_DAYS = 365
+
+
+# Rendered output ======================================================================================================
+# debtor list pages and cards by the version of their shop, see repository.find_shop_version: until something in the
+# shop changes, showing one again costs a version check instead of a query and a render
+rendered_cache = TTLCache('rendered', maxsize=int(environ.get('RENDERED_CACHE_SIZE', 5000)),
+                          ttl=int(environ.get('RENDERED_CACHE_TTL', 600)))
+
+CACHES = repository.CACHES + [rendered_cache]
+
 
 # Helper functions =====================================================================================================
-def find_debtor_by_phone(shop_id, debtor_phone):
+async def find_debtor_by_phone(shop_id, debtor_phone):
     try:
-        shop = shops_col.find_one({'_id': shop_id})
-        for debtor_dict in shop.get('debtors'):
-            if debtor_dict.get('phone') == debtor_phone:
-                return debtor_dict.get('debtor_id')
-        return None
+        return await repository.find_debtor_id_by_phone(shop_id, debtor_phone)
     except PyMongoError as error:
         logger.error('PyMongoError: {}'.format(error))
         return None
 
 
-def get_debtors_list_keyboard(shop_id):
-    try:
-        found_shop = shops_col.find_one({'_id': shop_id})
-        if found_shop:
-            keyboard = []
-            for debtor in found_shop.get('debtors'):
-                found_debtor = debtors_col.find_one({'_id': debtor.get('debtor_id')})
-                temp_text = "{} - {:,} so'm".format(
-                    found_debtor.get('name'),
-                    found_debtor.get('debt_amount'))
-                ikb = InlineKeyboardButton(temp_text, callback_data=str(found_debtor.get('_id')))
-                keyboard.append([ikb])
-            keyboard.append([InlineKeyboardButton('🔙', callback_data='back')])
-
-            reply_markup = InlineKeyboardMarkup(keyboard)
-        else:
-            reply_markup = InlineKeyboardMarkup([[]])
+def new_debtors_list_state(sort='debt'):
+    # cursors[-1] is the keyset cursor of the shown page, next_cursor the one of the page after it
+    return {'sort': sort, 'cursors': [None], 'next_cursor': None}
+
 
+async def get_debtors_list_keyboard(shop_id, list_state):
+    try:
+        sort = list_state['sort']
+        version, read_time = await repository.find_shop_version(shop_id)
+        cursor = list_state['cursors'][-1]
+        key = ('page', shop_id, version, sort, tuple(cursor) if cursor else None, len(list_state['cursors']) > 1)
+        rendered = rendered_cache.get(key)
+        if rendered is not None:
+            reply_markup, list_state['next_cursor'] = rendered
+            return reply_markup
+
+        debtors = await repository.find_debtors_page(shop_id, sort, after=cursor, limit=DEBTORS_PAGE_SIZE + 1,
+                                                     projection={'name': 1, 'debt_amount': 1, 'last_activity': 1},
+                                                     read_time=read_time)
+        has_next_page = len(debtors) > DEBTORS_PAGE_SIZE
+        debtors = debtors[:DEBTORS_PAGE_SIZE]
+        list_state['next_cursor'] = repository.debtors_page_key(sort, debtors[-1]) if has_next_page else None
+
+        keyboard = []
+        for found_debtor in debtors:
+            temp_text = "{} - {:,} so'm".format(
+                found_debtor.name,
+                found_debtor.debt_amount)
+            ikb = InlineKeyboardButton(temp_text, callback_data=str(found_debtor.id))
+            keyboard.append([ikb])
+
+        page_buttons = []
+        if len(list_state['cursors']) > 1:
+            page_buttons.append(InlineKeyboardButton('⬅', callback_data='page_prev'))
+        if has_next_page:
+            page_buttons.append(InlineKeyboardButton('➡', callback_data='page_next'))
+        if page_buttons:
+            keyboard.append(page_buttons)
+
+        keyboard.append([InlineKeyboardButton(('✅ ' if key == sort else '') + text, callback_data='sort_' + key)
+                         for key, text in DEBTORS_LIST_SORTS.items()])
+        keyboard.append([InlineKeyboardButton('🔙', callback_data='back')])
+
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        rendered_cache.set(key, (reply_markup, list_state['next_cursor']))
         return reply_markup
 
     except PyMongoError as error:
@@ -101,56 +165,210 @@ def get_debtors_list_keyboard(shop_id):
         return None
 
 
-def get_debtor_info(debtor_id):
+DEBTOR_CARD_PROJECTION = {'phone_number': 1, 'name': 1, 'nickname': 1, 'debt_amount': 1}
+
+
+def format_debtor_info(found_debtor):
+    return "phone: {}\n" \
+           "name: {}\n" \
+           "nickname: {}\n" \
+           "debt: {:,} so'm" \
+        .format(found_debtor.phone_number,
+                found_debtor.name,
+                found_debtor.nickname,
+                found_debtor.debt_amount)
+
+
+async def get_debtor_info(shop_id, debtor_id):
     try:
-        found_debtor = debtors_col.find_one({'_id': debtor_id})
-        if found_debtor:
-            text = "phone: {}\n" \
-                   "name: {}\n" \
-                   "nickname: {}\n" \
-                   "debt: {:,} so'm" \
-                .format(found_debtor.get('phone_number'),
-                        found_debtor.get('name'),
-                        found_debtor.get('nickname'),
-                        found_debtor.get('debt_amount'))
-            return text
+        version, _ = await repository.find_shop_version(shop_id)
+        text = rendered_cache.get(('card', debtor_id, version))
+        if text is None:
+            # the debtor cache only forgets this process' own postings, a card of a new version is built from MongoDB
+            repository.debtors_cache.invalidate(debtor_id)
+            found_debtor = await repository.find_debtor(debtor_id)
+            if found_debtor:
+                text = format_debtor_info(found_debtor)
+                rendered_cache.set(('card', debtor_id, version), text)
+        return text
     except PyMongoError as error:
         logger.error('PyMongoError: {}'.format(error))
         return None
 
 
-def find_debts(debtor_phone_number):
+async def find_debts(debtor_phone_number):
     try:
-        debtors = debtors_col.find({'phone_number': debtor_phone_number})
-        if debtors is not None:
-            buttons = []
+        debts = await repository.find_debts(debtor_phone_number)
+        buttons = []
 
-            for debt in debtors:
-                shop = shops_col.find_one({'_id': debt.get('shop_id')})
-                buttons.append([InlineKeyboardButton("{} - {} so'm".format(shop.get('name'), debt.get('debt_amount')),
-                                                     callback_data=str(debt.get('_id')))])
+        for debtor, shop_name in debts:
+            buttons.append([InlineKeyboardButton("{} - {} so'm".format(shop_name, debtor.debt_amount),
+                                                 callback_data=str(debtor.id))])
 
-            return InlineKeyboardMarkup(buttons)
+        return InlineKeyboardMarkup(buttons)
 
     except PyMongoError as error:
         logger.error('PyMongoError: {}'.format(error))
         return None
 
 
-def get_transactions(debtor_id):
+def new_transactions_page_state(debtor_id):
+    # cursors[-1] is the `before` cursor of the shown page, next_cursor the one of the next (older) page
+    return {'debtor_id': debtor_id, 'cursors': [None], 'next_cursor': None}
+
+
+async def get_transactions(page_state):
     try:
-        debtor = debtors_col.find_one({'_id': debtor_id})
-        if debtor is not None:
-            result_text = '\n'.join("{} {}{:,} so'm".format(
-                t.get('timestamp').strftime('%d/%m/%y %H:%M'),
-                '+' if t.get('type') == 'debt' else '-',
-                t.get('amount')) for t in debtor.get('transactions'))
-            return result_text
-        else:
-            return 'error'
+        page = await repository.find_transactions_page(page_state['debtor_id'], before=page_state['cursors'][-1],
+                                                       limit=TRANSACTIONS_PAGE_SIZE + 1)
+        has_next_page = len(page) > TRANSACTIONS_PAGE_SIZE
+        page = page[:TRANSACTIONS_PAGE_SIZE]
+        page_state['next_cursor'] = page[-1][0] if has_next_page else None
+        transactions = [transaction for _, transaction in page]
+
+        if not transactions:
+            return 'No transactions yet.'
+
+        result_text = '\n'.join("{} {}{:,} so'm".format(
+            t.timestamp.strftime('%d/%m/%y %H:%M'),
+            '+' if t.type == 'debt' else '-',
+            t.amount) for t in transactions)
+        return result_text
     except PyMongoError as error:
         logger.error('PyMongoError: {}'.format(error))
-        return None
+        return 'Error. Please contact administrator.'
+
+
+def get_transactions_keyboard(page_state):
+    page_buttons = []
+    if len(page_state['cursors']) > 1:
+        page_buttons.append(InlineKeyboardButton('⬅', callback_data='tx_newer'))
+    if page_state['next_cursor'] is not None:
+        page_buttons.append(InlineKeyboardButton('➡', callback_data='tx_older'))
+
+    keyboard = [page_buttons] if page_buttons else []
+    keyboard.append([InlineKeyboardButton('🔙', callback_data='back')])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def turn_transactions_page(page_state, direction):
+    if direction == 'tx_older' and page_state['next_cursor'] is not None:
+        page_state['cursors'].append(page_state['next_cursor'])
+    elif direction == 'tx_newer' and len(page_state['cursors']) > 1:
+        page_state['cursors'].pop()
+
+
+async def import_debtors_chunk(shop_id, chunk, errors):
+    existing_phones = await repository.insert_debtors(shop_id, [debtor_doc for _, debtor_doc in chunk])
+    for row_number, debtor_doc in chunk:
+        if debtor_doc.get('phone_number') in existing_phones:
+            errors.append((row_number, 'row {}: debtor with phone number {} already exists'.format(
+                row_number, debtor_doc.get('phone_number'))))
+    return len(chunk) - len(existing_phones)
+
+
+async def import_debtors_csv(path, shop_id):
+    """
+    Streams the debtors of a CSV file into the shop in chunks, returns the imported count and the per-row errors in row
+    order.
+    """
+    imported = 0
+    errors = []
+    seen_phones = set()
+    chunk = []
+
+    with open(path, newline='', encoding='utf-8-sig') as csv_file:
+        for row_number, row in enumerate(csv.reader(csv_file), start=1):
+            row = [cell.strip() for cell in row]
+            if not any(row) or (row_number == 1 and [cell.lower() for cell in row] == IMPORT_DEBTORS_COLUMNS):
+                continue
+
+            if len(row) != len(IMPORT_DEBTORS_COLUMNS):
+                errors.append((row_number, 'row {}: expected {} columns: {}'.format(
+                    row_number, len(IMPORT_DEBTORS_COLUMNS), ', '.join(IMPORT_DEBTORS_COLUMNS))))
+                continue
+            name, nickname, phone_number, debt_amount = row
+            if not name:
+                errors.append((row_number, 'row {}: name is empty'.format(row_number)))
+            elif not re.match(DEBTOR_PHONE_REGEX, phone_number):
+                errors.append((row_number, "row {}: phone number '{}' is not in format '+998XXXXXXXXX'".format(
+                    row_number, phone_number)))
+            elif not re.match(AMOUNT_REGEX, debt_amount):
+                errors.append((row_number, "row {}: invalid debt amount '{}'".format(row_number, debt_amount)))
+            elif phone_number in seen_phones:
+                errors.append((row_number, 'row {}: phone number {} is repeated in the file'.format(
+                    row_number, phone_number)))
+            else:
+                seen_phones.add(phone_number)
+                chunk.append((row_number, Debtor(name, nickname, phone_number, shop_id, int(debt_amount)).to_doc()))
+
+            if len(chunk) == IMPORT_DEBTORS_CHUNK_SIZE:
+                imported += await import_debtors_chunk(shop_id, chunk, errors)
+                chunk = []
+
+    if chunk:
+        imported += await import_debtors_chunk(shop_id, chunk, errors)
+    # the "already exists" errors of a chunk only come once it is written
+    errors.sort(key=lambda error: error[0])
+    return imported, [message for _, message in errors]
+
+
+def write_ledger_csv(shop_id, path, compress, write_time=None):
+    """Writes every debtor and transaction of the shop to a CSV file, gzip compressed if asked. Blocking."""
+    rows = 0
+    open_file = gzip.open if compress else open
+    with open_file(path, 'wt', newline='', encoding='utf-8') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(EXPORT_LEDGER_COLUMNS)
+        for debtor, transaction in repository.iter_shop_ledger(shop_id, {'name': 1, 'nickname': 1,
+                                                                         'phone_number': 1, 'debt_amount': 1},
+                                                               write_time):
+            row = [debtor.name, debtor.nickname, debtor.phone_number, debtor.debt_amount]
+            if transaction is not None:
+                row += [transaction.type, transaction.amount, transaction.timestamp.strftime('%Y-%m-%d %H:%M:%S')]
+            writer.writerow(row)
+            rows += 1
+    return rows
+
+
+def get_search_results_keyboard(search_state):
+    page = search_state['page']
+    debtors = search_state['debtors']
+
+    keyboard = [[InlineKeyboardButton(text, callback_data=debtor_id)]
+                for debtor_id, text in debtors[page * SEARCH_PAGE_SIZE:(page + 1) * SEARCH_PAGE_SIZE]]
+
+    page_buttons = []
+    if page > 0:
+        page_buttons.append(InlineKeyboardButton('⬅', callback_data='search_prev'))
+    if (page + 1) * SEARCH_PAGE_SIZE < len(debtors):
+        page_buttons.append(InlineKeyboardButton('➡', callback_data='search_next'))
+    if page_buttons:
+        keyboard.append(page_buttons)
+
+    return InlineKeyboardMarkup(keyboard)
+
+
+async def get_shop_menu_text(shop_id):
+    try:
+        summary = await repository.find_shop_summary(shop_id)
+    except PyMongoError as error:
+        logger.error('PyMongoError: {}'.format(error))
+        summary = None
+
+    if summary is None:
+        return 'Shop Menu:'
+
+    is_today = summary.get('day') == repository.summary_day(datetime.now())
+    return "Shop Menu:\n\n" \
+           "Outstanding: {:,} so'm\n" \
+           "Debtors: {:,} ({:,} in arrears)\n" \
+           "Today: +{:,} so'm / -{:,} so'm" \
+        .format(summary.get('total_outstanding', 0),
+                summary.get('debtor_count', 0),
+                summary.get('arrears_count', 0),
+                summary.get('today_debts', 0) if is_today else 0,
+                summary.get('today_payments', 0) if is_today else 0)
 
 
 # Keyboards ============================================================================================================
@@ -159,8 +377,6 @@ plus_minus_back_keyboard = InlineKeyboardMarkup([[InlineKeyboardButton('➕', ca
                                                  [InlineKeyboardButton('📃', callback_data='transactions')],
                                                  [InlineKeyboardButton('🔙', callback_data='back')]])
 
-back_inline_keyboard = InlineKeyboardMarkup([[InlineKeyboardButton('🔙', callback_data='back')]])
-
 choose_role_keyboard = ReplyKeyboardMarkup([['🛒 Shop'],
                                             ['👤 Debtor']],
                                            one_time_keyboard=True)
@@ -190,7 +406,8 @@ async def start(update: Update, _) -> int:
 # /shop_menu -----------------------------------------------------------------------------------------------------------
 async def handle_shop_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if context.user_data.get('shop_id'):
-        await update.message.reply_text('Shop Menu:', reply_markup=shop_menu_keyboard)
+        text = await get_shop_menu_text(context.user_data.get('shop_id'))
+        await update.message.reply_text(text, reply_markup=shop_menu_keyboard)
         return SHOP_MENU
     else:
         await update.message.reply_text('Please type /start to sign in as a shop')
@@ -235,6 +452,12 @@ async def handle_debtor_phone_number(update: Update, context: ContextTypes.DEFAU
             phone_number = '+' + phone_number
 
         context.user_data['debtor_phone_number'] = phone_number
+        try:
+            await repository.save_debtor_chat(phone_number, update.effective_chat.id)
+        except PyMongoError as error:
+            # the debtor can still sign in, just without reminders
+            logger.error('PyMongoError: {}'.format(error))
+
         await update.message.reply_text(
             "You have shared your phone number: {}. You have been signed in as a debtor.\n\n"
             "Please send /show_my_debts to get a list of your debts.".format(phone_number),
@@ -256,20 +479,34 @@ async def handle_debtor_wrong_phone_number(update: Update, _) -> int:
 
 async def show_debts(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     debtor_phone_number = context.user_data.get('debtor_phone_number')
-    debts = find_debts(debtor_phone_number)
+    debts = await find_debts(debtor_phone_number)
     await update.message.reply_text('Debts:', reply_markup=debts)
     return DEBTOR_OPTIONS
 
 
-async def select_debt(update: Update, _) -> int:
+async def select_debt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
 
-    debtor_id = ObjectId(query.data)
+    page_state = new_transactions_page_state(ObjectId(query.data))
+    context.user_data['transactions_page'] = page_state
+
+    transactions = await get_transactions(page_state)
 
-    transactions = get_transactions(debtor_id)
+    await query.edit_message_text(transactions, reply_markup=get_transactions_keyboard(page_state))
+    return DEBTOR_OPTIONS
+
+
+async def select_debt_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+
+    page_state = context.user_data['transactions_page']
+    turn_transactions_page(page_state, query.data)
 
-    await query.edit_message_text(transactions, reply_markup=back_inline_keyboard)
+    transactions = await get_transactions(page_state)
+
+    await query.edit_message_text(transactions, reply_markup=get_transactions_keyboard(page_state))
     return DEBTOR_OPTIONS
 
 
@@ -278,7 +515,7 @@ async def show_debts_back(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await query.answer()
 
     debtor_phone_number = context.user_data.get('debtor_phone_number')
-    debts = find_debts(debtor_phone_number)
+    debts = await find_debts(debtor_phone_number)
     await query.edit_message_text('Debts:', reply_markup=debts)
     return DEBTOR_OPTIONS
 
@@ -299,12 +536,12 @@ async def handle_shop_phone_number(update: Update, context: ContextTypes.DEFAULT
         context.user_data['shop_phone_number'] = phone_number
 
         try:
-            found_shop = shops_col.find_one({'phone_number': phone_number})
+            found_shop = await repository.find_shop_by_phone(phone_number)
 
             if found_shop is not None:
-                context.user_data['shop_id'] = found_shop.get('_id')
-                context.user_data['shop_name'] = found_shop.get('name')
-                context.user_data['shop_location'] = found_shop.get('location')
+                context.user_data['shop_id'] = found_shop.id
+                context.user_data['shop_name'] = found_shop.name
+                context.user_data['shop_location'] = found_shop.location
 
                 await update.message.reply_text(
                     'Welcome, {}!\nPlease choose option ⤵'.format(context.user_data['shop_name']),
@@ -350,9 +587,9 @@ async def handle_shop_location(update: Update, context: ContextTypes.DEFAULT_TYP
     )
 
     try:
-        result = shops_col.insert_one(new_shop.to_dict())
-        if result is not None:
-            context.user_data['shop_id'] = result.inserted_id
+        shop_id = await repository.insert_shop(new_shop.to_doc())
+        if shop_id is not None:
+            context.user_data['shop_id'] = shop_id
             await update.message.reply_text("Shop successfully added\n\nPlease choose option ⤵",
                                             reply_markup=shop_menu_keyboard)
             return SHOP_MENU
@@ -369,7 +606,8 @@ async def handle_shop_location(update: Update, context: ContextTypes.DEFAULT_TYP
 # Choose Role -> Shop -> Search Debtor ---------------------------------------------------------------------------------
 async def search_debtor(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data['chosen_shop_menu'] = 'search_debtor'
-    await update.message.reply_text("Please send debtor's phone number to search in format \"+998XXXXXXXXX\" ✍")
+    await update.message.reply_text("Please send debtor's phone number in format \"+998XXXXXXXXX\" "
+                                    "or debtor's name or nickname to search ✍")
     return SEARCH_DEBTOR
 
 
@@ -377,10 +615,10 @@ async def search_debtor_by_phone(update: Update, context: ContextTypes.DEFAULT_T
     debtor_phone = update.message.text
 
     try:
-        debtor_id = find_debtor_by_phone(context.user_data.get('shop_id'), debtor_phone)
+        debtor_id = await find_debtor_by_phone(context.user_data.get('shop_id'), debtor_phone)
         if debtor_id is not None:
             context.user_data['chosen_debtor_id'] = debtor_id
-            text = get_debtor_info(debtor_id)
+            text = await get_debtor_info(context.user_data.get('shop_id'), debtor_id)
 
             await update.message.reply_text(text, reply_markup=plus_minus_back_keyboard)
             return DEBTOR_INFO
@@ -401,7 +639,52 @@ async def search_debtor_by_phone(update: Update, context: ContextTypes.DEFAULT_T
 
 
 async def search_debtor_wrong_phone(update: Update, _) -> int:
-    await update.message.reply_text("Wrong format.\nPlease send debtor's phone number in format '+998XXXXXXXXX'")
+    await update.message.reply_text("Wrong format.\nPlease send debtor's phone number in format '+998XXXXXXXXX' "
+                                    "or debtor's name or nickname")
+    return SEARCH_DEBTOR
+
+
+async def search_debtor_by_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    search_query = update.message.text
+
+    try:
+        debtors = await repository.search_debtors(context.user_data.get('shop_id'), search_query,
+                                                  SEARCH_RESULTS_LIMIT)
+    except PyMongoError as error:
+        logger.error('PyMongoError: {}'.format(error))
+
+        await update.message.reply_text('Error. Please contact administrator.')
+        return ConversationHandler.END
+
+    if not debtors:
+        keyboard = ReplyKeyboardMarkup([['➕ Add New Debtor']], one_time_keyboard=True)
+        text = 'No debtors found for \'{}\'.\n' \
+               'You can add new debtor or send another name or phone number ⤵'.format(search_query)
+        await update.message.reply_text(text, reply_markup=keyboard)
+        return SEARCH_DEBTOR
+
+    search_state = {
+        'query': search_query,
+        'debtors': [[str(debtor.id), "{} - {:,} so'm".format(debtor.name, debtor.debt_amount)] for debtor in debtors],
+        'page': 0,
+    }
+    context.user_data['search_results'] = search_state
+
+    await update.message.reply_text('Debtors found for \'{}\':'.format(search_query),
+                                    reply_markup=get_search_results_keyboard(search_state))
+    return SEARCH_DEBTOR
+
+
+async def search_results_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+
+    search_state = context.user_data['search_results']
+    search_state['page'] += 1 if query.data == 'search_next' else -1
+    search_state['page'] = max(0, search_state['page'])
+
+    await query.edit_message_text('Debtors found for \'{}\':'.format(search_state['query']),
+                                  reply_markup=get_search_results_keyboard(search_state))
     return SEARCH_DEBTOR
 
 
@@ -439,11 +722,11 @@ async def handle_new_debtor_phone(update: Update, context: ContextTypes.DEFAULT_
     new_debtor_phone = update.message.text
 
     try:
-        found_debtor = find_debtor_by_phone(context.user_data.get('shop_id'), new_debtor_phone)
+        found_debtor = await find_debtor_by_phone(context.user_data.get('shop_id'), new_debtor_phone)
         if found_debtor is not None:
             context.user_data['existing_debtor'] = ObjectId(found_debtor)
 
-            debtor_into_text = get_debtor_info(found_debtor)
+            debtor_into_text = await get_debtor_info(context.user_data.get('shop_id'), found_debtor)
             keyboard = ReplyKeyboardMarkup([['Go To Debtor'], ['Send Another Phone Number']], one_time_keyboard=True)
             await update.message.reply_text(
                 "Debtor with {} phone number is already exists:\n\n{}\n\n"
@@ -468,7 +751,7 @@ async def go_to_existing_debtor(update: Update, context: ContextTypes.DEFAULT_TY
     debtor_id = context.user_data.get('existing_debtor')
     context.user_data['chosen_debtor_id'] = debtor_id
 
-    text = get_debtor_info(debtor_id)
+    text = await get_debtor_info(context.user_data.get('shop_id'), debtor_id)
 
     await update.message.reply_text(text, reply_markup=plus_minus_back_keyboard)
     return DEBTOR_INFO
@@ -508,20 +791,14 @@ async def new_debtor_correct_data(update: Update, context: ContextTypes.DEFAULT_
         context.user_data.get('new_debtor_phone'),
         context.user_data.get('shop_id'),
         context.user_data.get('new_debtor_debt_amount'),
-        [],
     )
 
     try:
-        debtor_insert_result = debtors_col.insert_one(new_debtor.to_dict())
-        shops_col.update_one({'_id': context.user_data.get('shop_id')},
-                             {'$push': {'debtors': {
-                                 'debtor_id': debtor_insert_result.inserted_id,
-                                 'phone': context.user_data.get('new_debtor_phone')
-                             }}})
+        debtor_id = await repository.insert_debtor(new_debtor.to_doc())
 
-        context.user_data['chosen_debtor_id'] = debtor_insert_result.inserted_id
+        context.user_data['chosen_debtor_id'] = debtor_id
 
-        text = get_debtor_info(debtor_insert_result.inserted_id)
+        text = await get_debtor_info(context.user_data.get('shop_id'), debtor_id)
 
         await query.edit_message_text(text, reply_markup=plus_minus_back_keyboard)
         return DEBTOR_INFO
@@ -544,17 +821,47 @@ async def new_debtor_incorrect_data(update: Update, _) -> int:
 # Choose Role -> Shop -> List of debtors -------------------------------------------------------------------------------
 async def list_of_debtors(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data['chosen_shop_menu'] = 'list_of_debtors'
+    context.user_data['debtors_list'] = new_debtors_list_state()
 
-    reply_markup = get_debtors_list_keyboard(context.user_data.get('shop_id'))
+    reply_markup = await get_debtors_list_keyboard(context.user_data.get('shop_id'),
+                                                   context.user_data['debtors_list'])
     await update.message.reply_text('List of debtors:', reply_markup=reply_markup)
     return LIST_OF_DEBTORS
 
 
+async def list_of_debtors_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+
+    list_state = context.user_data.setdefault('debtors_list', new_debtors_list_state())
+    if query.data == 'page_next' and list_state['next_cursor'] is not None:
+        list_state['cursors'].append(list_state['next_cursor'])
+    elif query.data == 'page_prev' and len(list_state['cursors']) > 1:
+        list_state['cursors'].pop()
+
+    reply_markup = await get_debtors_list_keyboard(context.user_data.get('shop_id'), list_state)
+    await query.edit_message_text('List of debtors:', reply_markup=reply_markup)
+    return LIST_OF_DEBTORS
+
+
+async def list_of_debtors_sort(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+
+    context.user_data['debtors_list'] = new_debtors_list_state(query.data[len('sort_'):])
+
+    reply_markup = await get_debtors_list_keyboard(context.user_data.get('shop_id'),
+                                                   context.user_data['debtors_list'])
+    await query.edit_message_text('List of debtors:', reply_markup=reply_markup)
+    return LIST_OF_DEBTORS
+
+
 async def back_to_shop_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
     await query.delete_message()
-    await context.bot.send_message(update.effective_chat.id, 'Shop Menu:', reply_markup=shop_menu_keyboard)
+    text = await get_shop_menu_text(context.user_data.get('shop_id'))
+    await context.bot.send_message(update.effective_chat.id, text, reply_markup=shop_menu_keyboard)
     return SHOP_MENU
 
 
@@ -565,26 +872,171 @@ async def choose_debtor(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     debtor_id = ObjectId(query.data)
     context.user_data['chosen_debtor_id'] = debtor_id
 
-    text = get_debtor_info(debtor_id)
+    text = await get_debtor_info(context.user_data.get('shop_id'), debtor_id)
     await query.edit_message_text(text, reply_markup=plus_minus_back_keyboard)
     return DEBTOR_INFO
 
 
+# Choose Role -> Shop -> Import debtors --------------------------------------------------------------------------------
+async def import_debtors(update: Update, _) -> int:
+    await update.message.reply_text(
+        "Please send a CSV file of debtors with the columns: {}.\n"
+        "Phone numbers must be in format '+998XXXXXXXXX'. Send /cancel to go back.".format(
+            ', '.join(IMPORT_DEBTORS_COLUMNS)),
+        reply_markup=ReplyKeyboardRemove())
+    return IMPORT_DEBTORS
+
+
+async def handle_import_debtors_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await update.message.reply_text('Importing debtors, please wait ⏳')
+
+    try:
+        with tempfile.NamedTemporaryFile(suffix='.csv') as csv_file:
+            telegram_file = await update.message.document.get_file()
+            await telegram_file.download_to_drive(csv_file.name)
+            imported, errors = await import_debtors_csv(csv_file.name, context.user_data.get('shop_id'))
+    except UnicodeDecodeError:
+        await update.message.reply_text('The file must be a UTF-8 encoded CSV file. Please send another file.')
+        return IMPORT_DEBTORS
+    except PyMongoError as error:
+        logger.error('PyMongoError: {}'.format(error))
+
+        await update.message.reply_text('Error. Please contact administrator.')
+        return ConversationHandler.END
+
+    await update.message.reply_text('{:,} debtors imported, {:,} rows skipped.'.format(imported, len(errors)),
+                                    reply_markup=shop_menu_keyboard)
+    if errors:
+        await update.message.reply_document(BytesIO('\n'.join(errors).encode()), filename='import_errors.txt')
+    return SHOP_MENU
+
+
+async def handle_import_debtors_wrong_file(update: Update, _) -> int:
+    await update.message.reply_text('Please send the debtors as a CSV file or /cancel.')
+    return IMPORT_DEBTORS
+
+
+# Choose Role -> Shop -> Export ledger ---------------------------------------------------------------------------------
+async def export_ledger(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    compress = 'gz' in context.args
+    filename = 'ledger_{:%Y-%m-%d_%H-%M}.csv{}'.format(datetime.now(), '.gz' if compress else '')
+
+    await update.message.reply_text('Exporting the ledger, please wait ⏳')
+
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, filename)
+            shop_id = context.user_data.get('shop_id')
+            rows = await repository.run_in_executor(write_ledger_csv, shop_id, path, compress,
+                                                    repository.last_write(shop_id))
+            with open(path, 'rb') as ledger_file:
+                await update.message.reply_document(ledger_file, filename=filename,
+                                                    caption='{:,} rows'.format(rows),
+                                                    reply_markup=shop_menu_keyboard)
+        return SHOP_MENU
+
+    except PyMongoError as error:
+        logger.error('PyMongoError: {}'.format(error))
+
+        await update.message.reply_text('Error. Please contact administrator.')
+        return ConversationHandler.END
+
+
+# Choose Role -> Shop -> Rebuild summary -------------------------------------------------------------------------------
+async def rebuild_summary(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    try:
+        await repository.run_in_executor(repository.rebuild_shop_summary, context.user_data.get('shop_id'))
+    except PyMongoError as error:
+        logger.error('PyMongoError: {}'.format(error))
+
+        await update.message.reply_text('Error. Please contact administrator.')
+        return ConversationHandler.END
+
+    text = await get_shop_menu_text(context.user_data.get('shop_id'))
+    await update.message.reply_text(text, reply_markup=shop_menu_keyboard)
+    return SHOP_MENU
+
+
+# Choose Role -> Shop -> Report ----------------------------------------------------------------------------------------
+REPORT_DATE_FORMATS = {'day': '%d/%m/%y', 'week': 'week of %d/%m/%y', 'month': '%m/%Y'}
+
+
+def format_report(report):
+    lines = ['Debts / payments by {}:'.format(report['unit'])]
+    for period in reversed(report['periods']):
+        lines.append("{}: +{:,} / -{:,} so'm".format(period['start'].strftime(REPORT_DATE_FORMATS[report['unit']]),
+                                                     period['debts'], period['payments']))
+    if report['top_debtors']:
+        lines.append('\nTop debtors:')
+        for place, debtor in enumerate(report['top_debtors'], 1):
+            lines.append("{}. {} - {:,} so'm".format(place, debtor.name, debtor.debt_amount))
+    return '\n'.join(lines)
+
+
+async def report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    unit = context.args[0] if context.args else 'day'
+    if unit not in reports.REPORT_PERIODS:
+        await update.message.reply_text('Usage: /report [day|week|month]')
+        return SHOP_MENU
+
+    try:
+        shop_report = await reports.build_report(context.user_data.get('shop_id'), unit)
+    except PyMongoError as error:
+        logger.error('PyMongoError: {}'.format(error))
+
+        await update.message.reply_text('Error. Please contact administrator.')
+        return ConversationHandler.END
+
+    await update.message.reply_text(format_report(shop_report), reply_markup=shop_menu_keyboard)
+    return SHOP_MENU
+
+
+# Choose Role -> Shop -> Reminders -------------------------------------------------------------------------------------
+async def reminders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    argument = context.args[0] if context.args else ''
+    if argument == 'off':
+        argument = '0'
+    if not argument.isdigit() or int(argument) > MAX_REMINDER_DAYS:
+        await update.message.reply_text('Usage: /reminders N to remind debtors who have not paid for N days, '
+                                        '/reminders off to stop reminders')
+        return SHOP_MENU
+
+    reminder_days = int(argument)
+    try:
+        await repository.set_reminder_days(context.user_data.get('shop_id'), reminder_days)
+    except PyMongoError as error:
+        logger.error('PyMongoError: {}'.format(error))
+
+        await update.message.reply_text('Error. Please contact administrator.')
+        return ConversationHandler.END
+
+    if reminder_days:
+        text = 'Debtors who have not paid for {} days will get a reminder every {} days.'.format(reminder_days,
+                                                                                                 reminder_days)
+    else:
+        text = 'Reminders are off.'
+    await update.message.reply_text(text, reply_markup=shop_menu_keyboard)
+    return SHOP_MENU
+
+
 # Debtor Info Callback Function (+ / - / back) -------------------------------------------------------------------------
 async def debtor_info_back(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
 
     if context.user_data['chosen_shop_menu'] == 'search_debtor':
-        await query.edit_message_text("Please send debtor's phone number in format '+998XXXXXXXXX'")
+        await query.edit_message_text("Please send debtor's phone number in format '+998XXXXXXXXX' "
+                                      "or debtor's name or nickname")
         return SEARCH_DEBTOR
     elif context.user_data['chosen_shop_menu'] == 'list_of_debtors':
-        reply_markup = get_debtors_list_keyboard(context.user_data.get('shop_id'))
+        list_state = context.user_data.setdefault('debtors_list', new_debtors_list_state())
+        reply_markup = await get_debtors_list_keyboard(context.user_data.get('shop_id'), list_state)
         await query.edit_message_text('List of debtors:', reply_markup=reply_markup)
         return LIST_OF_DEBTORS
     elif context.user_data['chosen_shop_menu'] == 'add_debtor':
         await query.delete_message()
-        await context.bot.send_message(update.effective_chat.id, 'Shop Menu:', reply_markup=shop_menu_keyboard)
+        text = await get_shop_menu_text(context.user_data.get('shop_id'))
+        await context.bot.send_message(update.effective_chat.id, text, reply_markup=shop_menu_keyboard)
         return SHOP_MENU
 
 
@@ -604,11 +1056,25 @@ async def debtor_info_transactions(update: Update, context: ContextTypes.DEFAULT
     query = update.callback_query
     await query.answer()
 
-    debtor_id = context.user_data['chosen_debtor_id']
+    page_state = new_transactions_page_state(context.user_data['chosen_debtor_id'])
+    context.user_data['transactions_page'] = page_state
 
-    transactions = get_transactions(debtor_id)
+    transactions = await get_transactions(page_state)
 
-    await query.edit_message_text(transactions, reply_markup=back_inline_keyboard)
+    await query.edit_message_text(transactions, reply_markup=get_transactions_keyboard(page_state))
+    return TRANSACTIONS
+
+
+async def debtor_info_transactions_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+
+    page_state = context.user_data['transactions_page']
+    turn_transactions_page(page_state, query.data)
+
+    transactions = await get_transactions(page_state)
+
+    await query.edit_message_text(transactions, reply_markup=get_transactions_keyboard(page_state))
     return TRANSACTIONS
 
 
@@ -618,7 +1084,7 @@ async def debtor_info_transactions_back(update: Update, context: ContextTypes.DE
 
     debtor_id = context.user_data['chosen_debtor_id']
 
-    text = get_debtor_info(debtor_id)
+    text = await get_debtor_info(context.user_data.get('shop_id'), debtor_id)
     await query.edit_message_text(text, reply_markup=plus_minus_back_keyboard)
     return DEBTOR_INFO
 
@@ -632,25 +1098,16 @@ async def handle_debt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     debt_amount = int(update.message.text)
     debtor_id = context.user_data['chosen_debtor_id']
 
-    transaction = {
-        'type': 'debt',
-        'amount': debt_amount,
-        'timestamp': datetime.now()
-    }
+    transaction = Transaction('debt', debt_amount, datetime.now())
 
     try:
-        push_transaction_result = debtors_col.update_one(
-            {"_id": debtor_id},
-            {"$push": {"transactions": transaction}}
-        )
-
-        inc_debt_result = debtors_col.update_one(
-            {"_id": debtor_id},
-            {"$inc": {"debt_amount": debt_amount}}
-        )
-        logger.info('{}\n{}'.format(push_transaction_result.raw_result, inc_debt_result))
+        updated_debtor = await repository.post_transaction(debtor_id, context.user_data.get('shop_id'), transaction,
+                                                           debt_amount, DEBTOR_CARD_PROJECTION)
+        if updated_debtor is None:
+            await update.message.reply_text('Debtor not found.', reply_markup=shop_menu_keyboard)
+            return SHOP_MENU
 
-        text = get_debtor_info(debtor_id)
+        text = format_debtor_info(updated_debtor)
         await update.message.reply_text(text, reply_markup=plus_minus_back_keyboard)
         return DEBTOR_INFO
 
@@ -666,27 +1123,18 @@ async def handle_wrong_payment(update: Update, _) -> int:
 
 async def handle_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     payment_amount = int(update.message.text)
-    transaction = {
-        'type': 'payment',
-        'amount': payment_amount,
-        'timestamp': datetime.now()
-    }
+    transaction = Transaction('payment', payment_amount, datetime.now())
 
     debtor_id = context.user_data['chosen_debtor_id']
 
     try:
-        push_transaction_result = debtors_col.update_one(
-            {"_id": debtor_id},
-            {"$push": {"transactions": transaction}}
-        )
-
-        inc_payment_result = debtors_col.update_one(
-            {"_id": debtor_id},
-            {"$inc": {"debt_amount": -payment_amount}}
-        )
-        logger.info('{}\n{}'.format(push_transaction_result.raw_result, inc_payment_result))
+        updated_debtor = await repository.post_transaction(debtor_id, context.user_data.get('shop_id'), transaction,
+                                                           -payment_amount, DEBTOR_CARD_PROJECTION)
+        if updated_debtor is None:
+            await update.message.reply_text('Debtor not found.', reply_markup=shop_menu_keyboard)
+            return SHOP_MENU
 
-        text = get_debtor_info(debtor_id)
+        text = format_debtor_info(updated_debtor)
         await update.message.reply_text(text, reply_markup=plus_minus_back_keyboard)
         return DEBTOR_INFO
 
@@ -695,35 +1143,149 @@ async def handle_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return ConversationHandler.END
 
 
+# /cache_stats ---------------------------------------------------------------------------------------------------------
+async def cache_stats(update: Update, _) -> None:
+    text = '\n'.join("{}: {size}/{maxsize} entries, {hits} hits, {misses} misses, {hit_rate:.1%} hit rate"
+                     .format(cache.name, **cache.stats()) for cache in CACHES)
+    await update.message.reply_text(text)
+
+
+# /health --------------------------------------------------------------------------------------------------------------
+async def health(update: Update, _) -> None:
+    try:
+        status = await repository.run_in_executor(database.health)
+    except PyMongoError as error:
+        await update.message.reply_text('MongoDB is unavailable: {}'.format(error))
+        return
+
+    lines = ['MongoDB: {topology}, ping {ping_ms:.1f} ms'.format(ping_ms=status['ping'] * 1000, **status)]
+    for address, pool in sorted(status['pools'].items()):
+        lines.append('{}: {in_use}/{max_pool_size} connections in use, {open} open, {waiting} waiting, '
+                     '{check_out_failures} check out failures'.format(address, max_pool_size=status['max_pool_size'],
+                                                                     **pool))
+    lines.append('Executor: {} workers'.format(repository.MONGO_EXECUTOR_WORKERS))
+    await update.message.reply_text('\n'.join(lines))
+
+
 # Error Handler --------------------------------------------------------------------------------------------------------
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.error("Exception while handling an update:", exc_info=context.error)
+    # the reporter sends a summary to the developer chat later, so an outage does not cost a message per error
+    if 'error_reporter' in context.bot_data:
+        context.bot_data['error_reporter'].record(context.error, update)
 
-    tb_list = traceback.format_exception(
-        None, context.error, context.error.__traceback__)
-    tb_string = "".join(tb_list)
-
-    update_str = update.to_dict() if isinstance(update, Update) else str(update)
-    message = (
-        f"An exception was raised while handling an update\n"
-        f"<pre>update = {html.escape(json.dumps(update_str, indent=2, ensure_ascii=False))}"
-        "</pre>\n\n"
-        f"<pre>context.chat_data = {html.escape(str(context.chat_data))}</pre>\n\n"
-        f"<pre>context.user_data = {html.escape(str(context.user_data))}</pre>\n\n"
-        f"<pre>{html.escape(tb_string)}</pre>"
-    )
-    if len(message) < 4095:
-        await context.bot.send_message(
-            chat_id=environ['DEVELOPER_CHAT_ID'], text=message, parse_mode=ParseMode.HTML)
-    else:
-        await context.bot.send_message(chat_id=environ['DEVELOPER_CHAT_ID'], text=tb_string[:4096])
+
+# Metrics --------------------------------------------------------------------------------------------------------------
+def cache_metrics():
+    for stat, kind in [('size', 'gauge'), ('hits', 'counter'), ('misses', 'counter')]:
+        name = 'qarz_daftar_cache_{}{}'.format(stat, '_total' if kind == 'counter' else '')
+        yield '# TYPE {} {}'.format(name, kind)
+        for cache in CACHES:
+            yield '{}{{cache="{}"}} {}'.format(name, cache.name, cache.stats()[stat])
+
+
+# Reminders ------------------------------------------------------------------------------------------------------------
+def format_reminder(debtor, shop):
+    return "Reminder from {}: you owe {:,} so'm since {:%d/%m/%y}.\n\nPlease send /show_my_debts for details.".format(
+        shop.name, debtor.debt_amount, debtor.last_activity)
+
+
+async def sweep_reminders(context: ContextTypes.DEFAULT_TYPE) -> None:
+    outbox = context.bot_data['outbox']
+    now = datetime.now()
+    queued = 0
+    while True:
+        try:
+            debtors = await repository.claim_due_reminders(now, REMINDERS_BATCH_SIZE, REMINDER_PROJECTION)
+            chats = await repository.find_debtor_chats({debtor.phone_number for debtor, _ in debtors})
+        except PyMongoError as error:
+            logger.error('PyMongoError: {}'.format(error))
+            return
+
+        for debtor, shop in debtors:
+            chat_id = chats.get(debtor.phone_number)
+            if chat_id is not None:
+                outbox.send(chat_id, format_reminder(debtor, shop))
+                queued += 1
+        if len(debtors) < REMINDERS_BATCH_SIZE:
+            break
+
+    if queued:
+        logger.info('queued {} reminders, {} messages in the outbox'.format(queued, len(outbox)))
 
 
 # Main =================================================================================================================
+def developer_chat_id():
+    """Returns the DEVELOPER_CHAT_ID chat id, or the value as is for a channel's @username, None if it is not set."""
+    chat_id = environ.get('DEVELOPER_CHAT_ID', '').strip()
+    if not chat_id:
+        return None
+    try:
+        return int(chat_id)
+    except ValueError:
+        return chat_id
+
+
+def developer_chat_filter():
+    chat_id = developer_chat_id()
+    if isinstance(chat_id, str):
+        return filters.Chat(username=chat_id)
+    # without a developer chat nobody may use the developer commands
+    return filters.Chat(chat_id=chat_id)
+
+
+async def post_init(application: Application) -> None:
+    ping = await repository.run_in_executor(database.check_readiness)
+    logger.info('MongoDB is ready, ping {:.1f} ms'.format(ping * 1000))
+
+    if environ.get('GROUP_COMMIT'):
+        repository.enable_group_commit(int(environ.get('GROUP_COMMIT_MAX_BATCH', 100)),
+                                       float(environ.get('GROUP_COMMIT_DELAY_MS', 5)) / 1000)
+
+    outbox = Outbox(application.bot, rate=int(environ.get('OUTBOX_RATE', 25)))
+    outbox.start()
+    application.bot_data['outbox'] = outbox
+    if developer_chat_id() is not None:
+        error_reporter = ErrorReporter(outbox, developer_chat_id(),
+                                       window=float(environ.get('ERROR_REPORT_WINDOW', 60)),
+                                       interval=float(environ.get('ERROR_REPORT_INTERVAL', 600)))
+        error_reporter.start()
+        application.bot_data['error_reporter'] = error_reporter
+    else:
+        logger.warning('DEVELOPER_CHAT_ID is not set, errors are only logged')
+    application.job_queue.run_repeating(sweep_reminders, interval=REMINDERS_SWEEP_INTERVAL, first=10,
+                                        name='sweep_reminders')
+
+    if database.supports_change_streams():
+        notifier = BalanceNotifier(outbox, window=float(environ.get('BALANCE_NOTIFICATIONS_WINDOW', 5)))
+        notifier.start()
+        application.bot_data['notifier'] = notifier
+    else:
+        logger.warning('MongoDB is not a replica set, debtors will not be notified about balance changes')
+
+    if environ.get('METRICS_PORT'):
+        metrics.register_collector(cache_metrics)
+        metrics.start_server(int(environ['METRICS_PORT']), environ.get('METRICS_HOST', '127.0.0.1'))
+
+
+async def post_stop(application: Application) -> None:
+    # postings still queued for group commit are written before the bot exits
+    await repository.disable_group_commit()
+    if 'notifier' in application.bot_data:
+        await application.bot_data['notifier'].stop()
+    if 'error_reporter' in application.bot_data:
+        await application.bot_data['error_reporter'].stop()
+    await application.bot_data['outbox'].stop()
+
+
 def main() -> None:
-    persistence = PicklePersistence(filepath='persistence.pickle')
+    persistence = MongoPersistence()
+
+    update_processor = PerUserUpdateProcessor(int(environ.get('MAX_CONCURRENT_UPDATES', 64)))
 
-    app = Application.builder().token(environ['TOKEN']).persistence(persistence).build()
+    app = Application.builder().token(environ['TOKEN']).persistence(persistence) \
+        .post_init(post_init).post_stop(post_stop).concurrent_updates(update_processor) \
+        .request(metrics.TimedRequest(connection_pool_size=256)).build()
 
     main_conv = ConversationHandler(
         entry_points=[CommandHandler('start', start),
@@ -741,6 +1303,7 @@ def main() -> None:
             # debtor ---------------------------------------------------------------------------------------------------
             DEBTOR_OPTIONS: [CommandHandler('show_my_debts', show_debts),
                              CallbackQueryHandler(show_debts_back, pattern="^back$"),
+                             CallbackQueryHandler(select_debt_page, pattern="^tx_(newer|older)$"),
                              CallbackQueryHandler(select_debt)],
             # sign in as shop ------------------------------------------------------------------------------------------
             SIGN_IN_AS_SHOP: [MessageHandler(filters.Regex(re.compile(r'back', re.IGNORECASE)), choose_role_back),
@@ -755,12 +1318,25 @@ def main() -> None:
             SHOP_MENU: [CommandHandler('shop_menu', handle_shop_menu),
                         MessageHandler(filters.Regex('^🔎 Search debtor$'), search_debtor),
                         MessageHandler(filters.Regex('^➕ Add debtor$'), add_debtor),
-                        MessageHandler(filters.Regex('^📃 List of debtors$'), list_of_debtors)],
+                        MessageHandler(filters.Regex('^📃 List of debtors$'), list_of_debtors),
+                        CommandHandler('import_debtors', import_debtors),
+                        CommandHandler('export_ledger', export_ledger),
+                        CommandHandler('rebuild_summary', rebuild_summary),
+                        CommandHandler('report', report),
+                        CommandHandler('reminders', reminders)],
+            # import of debtors ----------------------------------------------------------------------------------------
+            IMPORT_DEBTORS: [MessageHandler(filters.Document.FileExtension('csv'), handle_import_debtors_file),
+                             CommandHandler('cancel', handle_shop_menu),
+                             MessageHandler(filters.ALL & ~filters.COMMAND, handle_import_debtors_wrong_file)],
             # search for debtor ----------------------------------------------------------------------------------------
             SEARCH_DEBTOR: [MessageHandler(filters.Regex(DEBTOR_PHONE_REGEX), search_debtor_by_phone),
                             MessageHandler(filters.Regex('^➕ Add New Debtor$'), add_debtor),
                             MessageHandler(filters.Regex('^✍ Send Another Phone Number$'), search_debtor),
+                            MessageHandler(filters.Regex(r'^\+?\d'), search_debtor_wrong_phone),
+                            MessageHandler(filters.TEXT & ~filters.COMMAND, search_debtor_by_name),
                             MessageHandler(filters.ALL & ~filters.COMMAND, search_debtor_wrong_phone),
+                            CallbackQueryHandler(search_results_page, pattern="^search_(prev|next)$"),
+                            CallbackQueryHandler(choose_debtor),
                             CommandHandler('cancel', handle_shop_menu)],
 
             # add new debtor -------------------------------------------------------------------------------------------
@@ -782,13 +1358,16 @@ def main() -> None:
                                     CallbackQueryHandler(new_debtor_incorrect_data, pattern="^incorrect$")],
             # list of debtors ------------------------------------------------------------------------------------------
             LIST_OF_DEBTORS: [CallbackQueryHandler(back_to_shop_menu, pattern="^back"),
+                              CallbackQueryHandler(list_of_debtors_page, pattern="^page_(prev|next)$"),
+                              CallbackQueryHandler(list_of_debtors_sort, pattern="^sort_(debt|name|recent)$"),
                               CallbackQueryHandler(choose_debtor)],
             # debtor info ----------------------------------------------------------------------------------------------
             DEBTOR_INFO: [CallbackQueryHandler(debtor_info_back, pattern="^back$"),
                           CallbackQueryHandler(debtor_info_transactions, pattern="^transactions"),
                           CallbackQueryHandler(debtor_info_plus_minus, pattern="^\+|-$")],
             # transactions ---------------------------------------------------------------------------------------------
-            TRANSACTIONS: [CallbackQueryHandler(debtor_info_transactions_back, pattern="^back$")],
+            TRANSACTIONS: [CallbackQueryHandler(debtor_info_transactions_back, pattern="^back$"),
+                           CallbackQueryHandler(debtor_info_transactions_page, pattern="^tx_(newer|older)$")],
             # [+ / -] --------------------------------------------------------------------------------------------------
             SEND_DEBT: [MessageHandler(filters.Regex(AMOUNT_REGEX), handle_debt),
                         MessageHandler(filters.TEXT & ~filters.COMMAND, handle_wrong_debt)],
@@ -801,14 +1380,26 @@ def main() -> None:
         name='main_conv'
     )
 
+    metrics.instrument_conversation(main_conv, STATE_NAMES)
     app.add_handler(main_conv)
+    developer_chat = developer_chat_filter()
+    app.add_handler(CommandHandler('cache_stats', cache_stats, filters=developer_chat))
+    app.add_handler(CommandHandler('health', health, filters=developer_chat))
 
     app.add_error_handler(error_handler)
 
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    if environ.get('WEBHOOK_URL'):
+        app.run_webhook(listen=environ.get('WEBHOOK_LISTEN', '127.0.0.1'),
+                        port=int(environ.get('WEBHOOK_PORT', 8443)),
+                        url_path=environ.get('WEBHOOK_PATH', ''),
+                        webhook_url=environ['WEBHOOK_URL'],
+                        secret_token=environ.get('WEBHOOK_SECRET_TOKEN'),
+                        max_connections=int(environ.get('WEBHOOK_MAX_CONNECTIONS', 40)),
+                        allowed_updates=Update.ALL_TYPES)
+    else:
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
 
     # TODO - add show_debtor_transactions functionality
-    # TODO - optimize mongodb search with mongodb indexes
     # TODO - add reply_markup=ReplyKeyboardRemove() where it needed
     # TODO - remove other InlineKeyboardMarkups when sending new
 
@@ -0,0 +1,285 @@
+import bisect
+import logging
+import threading
+import time
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import environ
+
+from pymongo import monitoring
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Metrics ==============================================================================================================
+# upper bounds in seconds, from a cached page render up to a slow export
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(label_names, label_values, extra=''):
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+             for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Histogram:
+    """Prometheus histogram with labels. Thread-safe, pymongo calls its listeners from the executor threads."""
+
+    def __init__(self, name, documentation, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        with self._lock:
+            # one count per bucket plus the +Inf one, then the sum
+            series = self._series.setdefault(tuple(label_values), [0] * (len(self.buckets) + 1) + [0.0])
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def render(self):
+        yield '# HELP {} {}'.format(self.name, self.documentation)
+        yield '# TYPE {} histogram'.format(self.name)
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+        for label_values, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values):
+                cumulative += count
+                yield '{}_bucket{} {}'.format(self.name, _format_labels(self.label_names, label_values,
+                                                                        'le="{}"'.format(bound)), cumulative)
+            yield '{}_sum{} {}'.format(self.name, _format_labels(self.label_names, label_values), values[-1])
+            yield '{}_count{} {}'.format(self.name, _format_labels(self.label_names, label_values), cumulative)
+
+
+class Counter:
+    """Prometheus counter with labels."""
+
+    def __init__(self, name, documentation, label_names):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_values, amount=1):
+        with self._lock:
+            self._series[tuple(label_values)] = self._series.get(tuple(label_values), 0) + amount
+
+    def render(self):
+        yield '# HELP {} {}'.format(self.name, self.documentation)
+        yield '# TYPE {} counter'.format(self.name)
+        with self._lock:
+            series = dict(self._series)
+        for label_values, value in sorted(series.items()):
+            yield '{}{} {}'.format(self.name, _format_labels(self.label_names, label_values), value)
+
+
+HANDLER_SECONDS = Histogram('qarz_daftar_handler_seconds', 'Time spent in a conversation handler callback.',
+                            ('state', 'handler'))
+TELEGRAM_REQUEST_SECONDS = Histogram('qarz_daftar_telegram_request_seconds', 'Time spent in a Bot API request.',
+                                     ('method',))
+MONGO_COMMAND_SECONDS = Histogram('qarz_daftar_mongo_command_seconds', 'Time spent in a MongoDB command.',
+                                  ('collection', 'command'))
+MONGO_COMMAND_FAILURES = Counter('qarz_daftar_mongo_command_failures_total', 'MongoDB commands that failed.',
+                                 ('collection', 'command'))
+METRICS = [HANDLER_SECONDS, TELEGRAM_REQUEST_SECONDS, MONGO_COMMAND_SECONDS, MONGO_COMMAND_FAILURES]
+
+# functions returning more lines in the Prometheus text format, called on every scrape
+_collectors = []
+
+
+def register_collector(collector):
+    _collectors.append(collector)
+
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for collector in _collectors:
+        lines.extend(collector())
+    return '\n'.join(lines) + '\n'
+
+
+# Handlers =============================================================================================================
+def timed(state, callback):
+    @wraps(callback)
+    async def timed_callback(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            HANDLER_SECONDS.observe((state, callback.__name__), time.perf_counter() - started)
+    return timed_callback
+
+
+def instrument_conversation(conversation, state_names):
+    """Times every callback of `conversation`, labelled by the name of its state and the callback's name."""
+    groups = [('entry_points', conversation.entry_points), ('fallbacks', conversation.fallbacks)]
+    groups += [(state_names.get(state, str(state)), handlers) for state, handlers in conversation.states.items()]
+    for state, handlers in groups:
+        for handler in handlers:
+            handler.callback = timed(state, handler.callback)
+
+
+class TimedRequest(HTTPXRequest):
+    """Bot API requests that record their time, labelled by the API method."""
+
+    async def do_request(self, url, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().do_request(url, *args, **kwargs)
+        finally:
+            TELEGRAM_REQUEST_SECONDS.observe((url.rsplit('/', 1)[-1],), time.perf_counter() - started)
+
+
+# MongoDB ==============================================================================================================
+SLOW_MONGO_COMMAND_SECONDS = float(environ.get('SLOW_MONGO_COMMAND_MS', 100)) / 1000
+
+
+def filter_shape(value):
+    """Replaces the values of a query with their type names, which keeps phone numbers and names out of the logs."""
+    if isinstance(value, dict):
+        return {key: filter_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [filter_shape(item) for item in value[:3]] + (['...'] if len(value) > 3 else [])
+    return type(value).__name__
+
+
+def _command_filter(command_name, command):
+    if command_name in ('find', 'count', 'distinct'):
+        return command.get('filter', command.get('query'))
+    if command_name == 'findAndModify':
+        return command.get('query')
+    if command_name in ('update', 'delete'):
+        statements = command.get('updates' if command_name == 'update' else 'deletes') or [{}]
+        return statements[0].get('q')
+    if command_name == 'aggregate':
+        return [stage for stage in command.get('pipeline', []) if '$match' in stage][:1]
+    return None
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """Records the time of every MongoDB command and logs the slow ones with the shape of their filter."""
+
+    def __init__(self):
+        self._started = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        self._started[(event.connection_id, event.request_id)] = (
+            collection if isinstance(collection, str) else '', event.command)
+
+    def succeeded(self, event):
+        collection, command = self._started.pop((event.connection_id, event.request_id), ('', None))
+        seconds = event.duration_micros / 1e6
+        MONGO_COMMAND_SECONDS.observe((collection, event.command_name), seconds)
+        if seconds >= SLOW_MONGO_COMMAND_SECONDS and command is not None:
+            logger.warning('Slow MongoDB {} on {}: {:.0f} ms, filter {}'.format(
+                event.command_name, collection, seconds * 1000,
+                filter_shape(_command_filter(event.command_name, command))))
+
+    def failed(self, event):
+        collection, _ = self._started.pop((event.connection_id, event.request_id), ('', None))
+        MONGO_COMMAND_SECONDS.observe((collection, event.command_name), event.duration_micros / 1e6)
+        MONGO_COMMAND_FAILURES.inc((collection, event.command_name))
+
+
+command_metrics = CommandMetrics()
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Keeps the number of open, checked out and awaited connections of every server's pool."""
+
+    STATS = ('open', 'in_use', 'waiting', 'check_out_failures')
+
+    def __init__(self):
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def _add(self, address, stat, amount):
+        with self._lock:
+            pool = self._pools.setdefault('{}:{}'.format(*address), dict.fromkeys(self.STATS, 0))
+            pool[stat] += amount
+
+    def stats(self):
+        with self._lock:
+            return {address: dict(pool) for address, pool in self._pools.items()}
+
+    def render(self):
+        pools = self.stats()
+        for stat in self.STATS:
+            name = 'qarz_daftar_mongo_pool_{}'.format(stat + '_total' if stat == 'check_out_failures' else stat)
+            yield '# TYPE {} {}'.format(name, 'counter' if stat == 'check_out_failures' else 'gauge')
+            for address, pool in sorted(pools.items()):
+                yield '{}{{address="{}"}} {}'.format(name, address, pool[stat])
+
+    def connection_created(self, event):
+        self._add(event.address, 'open', 1)
+
+    def connection_closed(self, event):
+        self._add(event.address, 'open', -1)
+
+    def connection_check_out_started(self, event):
+        self._add(event.address, 'waiting', 1)
+
+    def connection_checked_out(self, event):
+        self._add(event.address, 'waiting', -1)
+        self._add(event.address, 'in_use', 1)
+
+    def connection_check_out_failed(self, event):
+        self._add(event.address, 'waiting', -1)
+        self._add(event.address, 'check_out_failures', 1)
+
+    def connection_checked_in(self, event):
+        self._add(event.address, 'in_use', -1)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+
+pool_metrics = PoolMetrics()
+METRICS.append(pool_metrics)
+
+
+# HTTP endpoint ========================================================================================================
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_):
+        pass
+
+
+def start_server(port, host='127.0.0.1'):
+    """Serves /metrics in the Prometheus text format from a daemon thread."""
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info('Serving metrics on http://{}:{}/metrics'.format(host, port))
+    return server
@@ -0,0 +1,150 @@
+import argparse
+import logging
+import pickle
+import sys
+from datetime import datetime
+from itertools import groupby
+
+from pymongo import UpdateOne, ReplaceOne
+
+from database import debtors_col, shops_col, ledger_col, report_cache_col, debtor_chats_col, user_data_col, \
+    conversations_col
+from persistence import conversation_id
+from search import search_keys
+from repository import ledger_bucket, rebuild_shop_summary
+
+logging.basicConfig(
+    format="[%(funcName)s] %(message)s",
+    level=logging.INFO,
+    handlers=[
+        logging.StreamHandler(sys.stdout)
+    ]
+)
+logger = logging.getLogger(__name__)
+
+
+def drop_embedded_shop_debtors():
+    """Removes the `debtors` array from shop documents, debtors are looked up by their own `shop_id` instead."""
+    for shop in shops_col.find({'debtors': {'$exists': True}}, {'debtors': 1}):
+        debtor_ids = [debtor.get('debtor_id') for debtor in shop.get('debtors')]
+        result = debtors_col.update_many({'_id': {'$in': debtor_ids}, 'shop_id': {'$exists': False}},
+                                         {'$set': {'shop_id': shop.get('_id')}})
+        if result.modified_count:
+            logger.info('shop {}: restored shop_id of {} debtors'.format(shop.get('_id'), result.modified_count))
+
+    result = shops_col.update_many({'debtors': {'$exists': True}}, {'$unset': {'debtors': ''}})
+    logger.info('removed embedded debtors from {} shops'.format(result.modified_count))
+
+
+def backfill_last_activity():
+    """Sets `last_activity` of older debtors to their latest transaction, or their creation time without any."""
+    result = debtors_col.update_many(
+        {'last_activity': {'$exists': False}},
+        [{'$set': {'last_activity': {'$ifNull': [{'$max': '$transactions.timestamp'}, {'$toDate': '$_id'}]}}}]
+    )
+    logger.info('backfilled last_activity of {} debtors'.format(result.modified_count))
+
+
+def move_transactions_to_ledger():
+    """Moves the embedded `transactions` arrays of debtors into monthly ledger buckets, safe to run again."""
+    moved = 0
+    for debtor in debtors_col.find({'transactions': {'$exists': True}}, {'shop_id': 1, 'transactions': 1}):
+        transactions = sorted(debtor.get('transactions'), key=lambda t: t.get('timestamp'))
+        requests = [UpdateOne({'debtor_id': debtor.get('_id'), 'timestamp': bucket},
+                              {'$addToSet': {'transactions': {'$each': list(bucket_transactions)}},
+                               '$setOnInsert': {'shop_id': debtor.get('shop_id')}},
+                              upsert=True)
+                    for bucket, bucket_transactions in groupby(transactions,
+                                                               key=lambda t: ledger_bucket(t.get('timestamp')))]
+        if requests:
+            ledger_col.bulk_write(requests, ordered=True)
+
+        debtors_col.update_one({'_id': debtor.get('_id')}, {'$unset': {'transactions': ''}})
+        moved += len(transactions)
+
+    logger.info('moved {} transactions to the ledger'.format(moved))
+
+    # cached reports of closed periods did not include the moved transactions
+    report_cache_col.delete_many({})
+
+
+def backfill_search_keys(chunk_size=1000):
+    """Sets the normalized `search_keys` of debtors created before name search existed."""
+    requests = []
+    updated = 0
+    for debtor in debtors_col.find({'search_keys': {'$exists': False}}, {'name': 1, 'nickname': 1}):
+        requests.append(UpdateOne({'_id': debtor.get('_id')},
+                                  {'$set': {'search_keys': search_keys(debtor.get('name'), debtor.get('nickname'))}}))
+        if len(requests) == int(chunk_size):
+            updated += debtors_col.bulk_write(requests, ordered=False).modified_count
+            requests = []
+    if requests:
+        updated += debtors_col.bulk_write(requests, ordered=False).modified_count
+    logger.info('backfilled search_keys of {} debtors'.format(updated))
+
+
+def import_pickle_persistence(filepath='persistence.pickle'):
+    """Imports `user_data` and conversation states of a PicklePersistence file into the Mongo persistence."""
+    with open(filepath, 'rb') as file:
+        data = pickle.load(file)
+
+    users = data.get('user_data') or {}
+    requests = [ReplaceOne({'_id': user_id}, {'_id': user_id, 'data': dict(user_data)}, upsert=True)
+                for user_id, user_data in users.items()]
+    if requests:
+        user_data_col.bulk_write(requests, ordered=False)
+    logger.info('imported user_data of {} users'.format(len(requests)))
+
+    for name, conversations in (data.get('conversations') or {}).items():
+        requests = [ReplaceOne({'_id': conversation_id(name, key)},
+                               {'_id': conversation_id(name, key), 'name': name, 'key': list(key), 'state': state},
+                               upsert=True)
+                    for key, state in conversations.items() if state is not None]
+        if requests:
+            conversations_col.bulk_write(requests, ordered=False)
+        logger.info('imported {} {} conversations'.format(len(requests), name))
+
+
+def rebuild_shop_summaries():
+    """Recomputes the summary document of every shop from scratch."""
+    shops = 0
+    for shop in shops_col.find({}, {'_id': 1}):
+        rebuild_shop_summary(shop.get('_id'))
+        shops += 1
+    logger.info('rebuilt summaries of {} shops'.format(shops))
+
+
+def backfill_debtor_chats():
+    """Records the chats of debtors who signed in before their chat ids were kept, so that they get reminders too."""
+    # in a private chat the chat id is the user id, the key of the user_data documents
+    requests = [UpdateOne({'_id': user.get('data').get('debtor_phone_number')},
+                          {'$setOnInsert': {'chat_id': user.get('_id'), 'updated_at': datetime.now()}}, upsert=True)
+                for user in user_data_col.find({'data.debtor_phone_number': {'$exists': True}},
+                                               {'data.debtor_phone_number': 1})]
+    if requests:
+        debtor_chats_col.bulk_write(requests, ordered=False)
+    logger.info('backfilled chats of {} debtors'.format(len(requests)))
+
+
+MIGRATIONS = {
+    'drop_embedded_shop_debtors': drop_embedded_shop_debtors,
+    'backfill_last_activity': backfill_last_activity,
+    'move_transactions_to_ledger': move_transactions_to_ledger,
+    'import_pickle_persistence': import_pickle_persistence,
+    'backfill_search_keys': backfill_search_keys,
+    'rebuild_shop_summaries': rebuild_shop_summaries,
+    'backfill_debtor_chats': backfill_debtor_chats,
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='One-shot data migrations for the "Qarz Daftar" database.')
+    parser.add_argument('migration', choices=MIGRATIONS)
+    parser.add_argument('arguments', nargs='*', help='positional arguments of the migration, e.g. a file path')
+    args = parser.parse_args()
+
+    MIGRATIONS[args.migration](*args.arguments)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,3 @@
 from .shop import Shop
 from .debtor import Debtor
+from .transaction import Transaction
@@ -0,0 +1,71 @@
+class Document:
+    """
+    Base of the models: a slotted object per MongoDB document, a fraction of the memory of the dict pymongo decodes
+    it to, and `_id` becomes the `id` attribute. Subclasses list their document fields in FIELDS. A model decoded
+    with a projection only has the projected fields, reading any other raises AttributeError, so a field missing from
+    a projection shows up as an error instead of a silent None. Projected fields absent from the document are None.
+    """
+
+    __slots__ = ()
+    FIELDS = ()
+    _projections = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # (document key, attribute) pairs, and the pairs a projection loads by the projection's items
+        cls._fields = tuple((field, 'id' if field == '_id' else field) for field in cls.FIELDS)
+        cls._projections = {}
+
+    @classmethod
+    def _projected_fields(cls, projection):
+        key = tuple(projection.items())
+        fields = cls._projections.get(key)
+        if fields is None:
+            included = {field for field, value in projection.items() if value}
+            if included - {'_id'}:
+                fields = tuple((field, attribute) for field, attribute in cls._fields
+                               if field in included or field == '_id' and projection.get('_id', 1))
+            else:
+                # an exclusion projection
+                fields = tuple((field, attribute) for field, attribute in cls._fields
+                               if projection.get(field, 1))
+            cls._projections[key] = fields
+        return fields
+
+    @classmethod
+    def _decode(cls, doc, fields):
+        model = cls.__new__(cls)
+        get = doc.get
+        for field, attribute in fields:
+            setattr(model, attribute, get(field))
+        return model
+
+    @classmethod
+    def from_doc(cls, doc, projection=None):
+        """Decodes a document read with `projection`, None stays None. Keys that are not FIELDS are ignored."""
+        if doc is None:
+            return None
+        return cls._decode(doc, cls._fields if projection is None else cls._projected_fields(projection))
+
+    @classmethod
+    def from_docs(cls, docs, projection=None):
+        """Decodes the documents of a cursor read with `projection` into a list, working out the projection once."""
+        fields = cls._fields if projection is None else cls._projected_fields(projection)
+        return [cls._decode(doc, fields) for doc in docs]
+
+    def to_doc(self):
+        """Encodes the loaded fields, an `id` that is not set yet is left to MongoDB."""
+        doc = {}
+        for field, attribute in self._fields:
+            try:
+                doc[field] = getattr(self, attribute)
+            except AttributeError:
+                pass
+        return doc
+
+    def __eq__(self, other):
+        return type(other) is type(self) and other.to_doc() == self.to_doc()
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join('{}={!r}'.format(field, value)
+                                                              for field, value in self.to_doc().items()))
@@ -0,0 +1,13 @@
+from .document import Document
+
+
+class Transaction(Document):
+    """A debt or payment, embedded in the debtor's monthly ledger bucket."""
+
+    FIELDS = ('type', 'amount', 'timestamp')
+    __slots__ = ('type', 'amount', 'timestamp')
+
+    def __init__(self, type, amount, timestamp):
+        self.type = type
+        self.amount = amount
+        self.timestamp = timestamp
@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError, OperationFailure, PyMongoError
+
+import repository
+from database import debtors_col, change_stream_tokens_col
+
+logger = logging.getLogger(__name__)
+
+# balance changes of the debtors, only the fields a notification needs
+BALANCE_CHANGES_PIPELINE = [
+    {'$match': {'operationType': 'update', 'updateDescription.updatedFields.debt_amount': {'$exists': True}}},
+    {'$project': {'fullDocument.phone_number': 1, 'fullDocument.shop_id': 1, 'fullDocument.debt_amount': 1}},
+]
+# the oplog no longer has the event of the resume token
+CHANGE_STREAM_HISTORY_LOST = 286
+
+
+class BalanceNotifier:
+    """
+    Watches the debtors' balances on a change stream and tells debtors who signed in to the bot about new debts and
+    payments. Changes within `window` seconds are coalesced into one message per debtor and shop. The resume token is
+    saved after every flush, so a restart continues where the last flushed change left off: changes are not lost but
+    the ones of an unfinished window may be notified twice.
+
+    Every bot process runs a notifier, but only the one holding the lease in the token's document watches the stream,
+    so a change is notified once however many processes run. The lease is renewed while watching and taken over by
+    another process `lease` seconds after its holder stopped renewing it, or right away after a clean stop.
+    """
+
+    def __init__(self, outbox, window=5.0, name='debtor_balances', collection=debtors_col,
+                 tokens=change_stream_tokens_col, lease=30.0):
+        self.outbox = outbox
+        self.window = window
+        self.name = name
+        self.collection = collection
+        self.tokens = tokens
+        self.lease = lease
+        self.owner = str(ObjectId())
+        self._pending = {}
+        self._pending_token = None
+        self._flush_handle = None
+        self._flush_task = None
+        self._loop = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._watch, name='balance-notifier', daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        self._stopped.set()
+        await self._loop.run_in_executor(None, self._thread.join)
+        # let the changes handed over by the thread's last call_soon_threadsafe in
+        await asyncio.sleep(0)
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        # a flush in progress hands back what it has not sent yet, the final one sends it and saves the newest token
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        try:
+            await repository.run_in_executor(self._release_lease)
+        except PyMongoError as error:
+            logger.error('PyMongoError: {}'.format(error))
+
+    # Lease ------------------------------------------------------------------------------------------------------------
+    def _acquire_lease(self):
+        """Takes the lease if it is free or expired, or renews it. Returns whether this notifier holds it now."""
+        now = datetime.now()
+        try:
+            self.tokens.update_one(
+                {'_id': self.name, '$or': [{'owner': self.owner}, {'lease_until': {'$not': {'$gt': now}}}]},
+                {'$set': {'owner': self.owner, 'lease_until': now + timedelta(seconds=self.lease)}}, upsert=True)
+        except DuplicateKeyError:
+            # another notifier holds it, so the filter matched nothing and the upsert hit the _id
+            return False
+        return True
+
+    def _release_lease(self):
+        self.tokens.update_one({'_id': self.name, 'owner': self.owner}, {'$unset': {'owner': '', 'lease_until': ''}})
+
+    # Change stream thread ---------------------------------------------------------------------------------------------
+    def _watch(self):
+        while not self._stopped.is_set():
+            try:
+                if not self._acquire_lease():
+                    self._stopped.wait(self.lease / 3)
+                    continue
+                renew_at = time.monotonic() + self.lease / 3
+                saved = self.tokens.find_one({'_id': self.name})
+                with self.collection.watch(BALANCE_CHANGES_PIPELINE, full_document='updateLookup',
+                                           resume_after=saved.get('token') if saved else None,
+                                           max_await_time_ms=500) as stream:
+                    while not self._stopped.is_set():
+                        if time.monotonic() >= renew_at:
+                            if not self._acquire_lease():
+                                logger.warning('Another process took over the balance notifications')
+                                break
+                            renew_at = time.monotonic() + self.lease / 3
+                        change = stream.try_next()
+                        if change is not None:
+                            self._loop.call_soon_threadsafe(self._add, change)
+            except OperationFailure as error:
+                if error.code != CHANGE_STREAM_HISTORY_LOST:
+                    logger.error('Balance notifications stopped: {}'.format(error))
+                    return
+                logger.warning('Balance changes since the last resume token are lost, watching from now on')
+                self.tokens.update_one({'_id': self.name}, {'$unset': {'token': ''}})
+            except PyMongoError as error:
+                # pymongo already resumes after transient errors, so this is an outage, wait before starting over
+                logger.error('PyMongoError: {}'.format(error))
+                self._stopped.wait(5)
+
+    # Event loop side --------------------------------------------------------------------------------------------------
+    def _add(self, change):
+        debtor = change.get('fullDocument')
+        if debtor is not None:
+            key = (debtor.get('phone_number'), debtor.get('shop_id'))
+            changes = self._pending.get(key, (None, 0))[1]
+            self._pending[key] = (debtor.get('debt_amount'), changes + 1)
+        self._pending_token = change.get('_id')
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_handle is None and not self._stopped.is_set():
+            self._flush_handle = self._loop.call_later(self.window, self._start_flush)
+
+    def _start_flush(self):
+        self._flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        self._flush_handle = None
+        pending, self._pending = self._pending, {}
+        token, self._pending_token = self._pending_token, None
+        if token is None:
+            return
+
+        try:
+            chats = await repository.find_debtor_chats({phone_number for phone_number, _ in pending})
+            for (phone_number, shop_id), (balance, changes) in list(pending.items()):
+                chat_id = chats.get(phone_number)
+                if chat_id is not None:
+                    shop = await repository.find_shop(shop_id)
+                    self.outbox.send(chat_id, format_balance_notification(shop.name if shop else None, balance,
+                                                                          changes))
+                del pending[(phone_number, shop_id)]
+
+            # a save already on its way finishes even if stop() cancels the flush, so it cannot land after the final
+            # flush's newer token
+            # only while holding the lease, a notifier that lost it must not move its successor's token
+            saving = asyncio.ensure_future(repository.run_in_executor(
+                self.tokens.update_one, {'_id': self.name, 'owner': self.owner},
+                {'$set': {'token': token, 'updated_at': datetime.now()}}))
+            try:
+                await asyncio.shield(saving)
+            except asyncio.CancelledError:
+                await saving
+                raise
+        except PyMongoError as error:
+            logger.error('PyMongoError: {}'.format(error))
+            # what was not sent is tried again with the next window, the token is only saved once it went out
+            self._restore(pending, token)
+            self._schedule_flush()
+        except asyncio.CancelledError:
+            self._restore(pending, token)
+            raise
+
+    def _restore(self, pending, token):
+        """Puts the changes of a cancelled flush back in front of the ones that came in since."""
+        for key, (balance, changes) in pending.items():
+            newer = self._pending.get(key)
+            self._pending[key] = (newer[0], newer[1] + changes) if newer is not None else (balance, changes)
+        if self._pending_token is None:
+            self._pending_token = token
+
+
+def format_balance_notification(shop_name, balance, changes):
+    text = "🔔 {}: your debt is now {:,} so'm".format(shop_name, balance)
+    if changes > 1:
+        text += ' after {} changes'.format(changes)
+    return text + '.\n\nPlease send /show_my_debts for details.'
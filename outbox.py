@@ -0,0 +1,109 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    """
+    Queue of messages the bot sends on its own, e.g. reminders, drained by a background task at no more than `rate`
+    messages per second overall and one message per `chat_interval` seconds to the same chat, which keeps bulk sends
+    below Telegram's flood limits. Replies of the interactive handlers do not go through it and are never held up.
+    """
+
+    def __init__(self, bot, rate=25, chat_interval=1.0, max_attempts=3):
+        self.bot = bot
+        self.rate = rate
+        self.chat_interval = chat_interval
+        self.max_attempts = max_attempts
+        self.sent = 0
+        self.failed = 0
+        # (ready_at, sequence number, chat_id, text, kwargs, attempt) ordered by when each message may be sent
+        self._heap = []
+        self._sequence = itertools.count()
+        self._chat_ready_at = {}
+        self._next_send_at = 0.0
+        self._sending = False
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def send(self, chat_id, text, **kwargs):
+        now = time.monotonic()
+        ready_at = max(now, self._chat_ready_at.get(chat_id, 0.0))
+        self._chat_ready_at[chat_id] = ready_at + self.chat_interval
+        self._push(ready_at, chat_id, text, kwargs, 1)
+
+    def _push(self, ready_at, chat_id, text, kwargs, attempt):
+        heapq.heappush(self._heap, (ready_at, next(self._sequence), chat_id, text, kwargs, attempt))
+        self._wakeup.set()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run(), name='outbox')
+
+    async def stop(self, timeout=10):
+        """Gives the queued messages up to `timeout` seconds to go out, then stops the background task."""
+        deadline = time.monotonic() + timeout
+        while (self._heap or self._sending) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self._heap:
+            logger.warning('Outbox stopped with {} unsent messages'.format(len(self._heap)))
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _wait(self, delay=None):
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self):
+        while True:
+            if not self._heap:
+                now = time.monotonic()
+                self._chat_ready_at = {chat_id: ready_at for chat_id, ready_at in self._chat_ready_at.items()
+                                       if ready_at > now}
+                await self._wait()
+                continue
+
+            delay = max(self._heap[0][0], self._next_send_at) - time.monotonic()
+            if delay > 0:
+                await self._wait(delay)
+                continue
+
+            _, _, chat_id, text, kwargs, attempt = heapq.heappop(self._heap)
+            self._next_send_at = time.monotonic() + 1 / self.rate
+            self._sending = True
+            try:
+                await self.bot.send_message(chat_id, text, **kwargs)
+                self.sent += 1
+            except RetryAfter as error:
+                # flood control applies to the whole bot, so nothing is sent until it is over
+                logger.warning('Outbox hit flood control, retrying in {} s'.format(error.retry_after))
+                self._next_send_at = time.monotonic() + error.retry_after
+                self._push(time.monotonic(), chat_id, text, kwargs, attempt)
+            except (Forbidden, BadRequest) as error:
+                # the user blocked the bot or the chat is gone, retrying will not help
+                logger.info('Outbox dropped a message to {}: {}'.format(chat_id, error))
+                self.failed += 1
+            except TelegramError as error:
+                if attempt < self.max_attempts:
+                    self._push(time.monotonic() + 2 ** attempt, chat_id, text, kwargs, attempt + 1)
+                else:
+                    logger.error('Outbox gave up on a message to {}: {}'.format(chat_id, error))
+                    self.failed += 1
+            finally:
+                self._sending = False
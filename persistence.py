@@ -0,0 +1,94 @@
+from copy import deepcopy
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from database import user_data_col, conversations_col
+from repository import run_in_executor
+
+
+def conversation_id(name, key):
+    return '{}:{}'.format(name, ':'.join(str(part) for part in key))
+
+
+class MongoPersistence(BasePersistence):
+    """
+    Stores every user's `user_data` and every conversation state as its own Mongo document. `user_data` is loaded
+    on the user's first update and only entries that changed since they were last stored are written back.
+    """
+
+    def __init__(self, update_interval: float = 60):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True,
+                                                     callback_data=False),
+                         update_interval=update_interval)
+        # user_id -> user_data as it is stored in Mongo, only for users whose data has been loaded
+        self._stored_user_data = {}
+
+    # user_data --------------------------------------------------------------------------------------------------------
+    async def get_user_data(self):
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        if user_id in self._stored_user_data:
+            return
+
+        doc = await run_in_executor(user_data_col.find_one, {'_id': user_id})
+        data = doc.get('data') if doc is not None else {}
+        user_data.update(deepcopy(data))
+        self._stored_user_data[user_id] = data
+
+    async def update_user_data(self, user_id, data):
+        if user_id not in self._stored_user_data or self._stored_user_data[user_id] == data:
+            return
+
+        await run_in_executor(user_data_col.replace_one, {'_id': user_id}, {'_id': user_id, 'data': data},
+                              upsert=True)
+        self._stored_user_data[user_id] = data
+
+    async def drop_user_data(self, user_id):
+        self._stored_user_data.pop(user_id, None)
+        await run_in_executor(user_data_col.delete_one, {'_id': user_id})
+
+    # conversations ----------------------------------------------------------------------------------------------------
+    async def get_conversations(self, name):
+        docs = await run_in_executor(lambda: list(conversations_col.find({'name': name}, {'key': 1, 'state': 1})))
+        return {tuple(doc.get('key')): doc.get('state') for doc in docs}
+
+    async def update_conversation(self, name, key, new_state):
+        _id = conversation_id(name, key)
+        if new_state is None:
+            await run_in_executor(conversations_col.delete_one, {'_id': _id})
+        else:
+            await run_in_executor(conversations_col.replace_one, {'_id': _id},
+                                  {'_id': _id, 'name': name, 'key': list(key), 'state': new_state}, upsert=True)
+
+    # not stored -------------------------------------------------------------------------------------------------------
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        # every update is written as soon as the application hands it over, nothing is buffered
+        pass
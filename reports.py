@@ -0,0 +1,99 @@
+from datetime import datetime, timedelta
+
+import pymongo
+from pymongo import UpdateOne
+
+from database import debtors_secondary_col, ledger_secondary_col, report_cache_col, max_staleness
+from models import Debtor
+from repository import run_in_executor, ledger_bucket, last_write, read_session
+
+# unit -> number of periods shown in a report
+REPORT_PERIODS = {'day': 7, 'week': 8, 'month': 6}
+TOP_DEBTOR_PROJECTION = {'name': 1, 'debt_amount': 1}
+
+
+def period_start(unit, timestamp):
+    day = timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    if unit == 'day':
+        return day
+    if unit == 'week':
+        return day - timedelta(days=day.weekday())
+    return day.replace(day=1)
+
+
+def next_period_start(unit, start):
+    if unit == 'day':
+        return start + timedelta(days=1)
+    if unit == 'week':
+        return start + timedelta(weeks=1)
+    return (start + timedelta(days=32)).replace(day=1)
+
+
+def report_periods(unit, now):
+    """Returns the starts of the last periods of `unit` oldest first, the last one being the current open period."""
+    starts = [period_start(unit, now)]
+    for _ in range(REPORT_PERIODS[unit] - 1):
+        starts.insert(0, period_start(unit, starts[0] - timedelta(days=1)))
+    return starts
+
+
+def _aggregate_periods(shop_id, boundaries, session):
+    """Sums debts and payments of the shop per period between consecutive `boundaries` in one aggregation."""
+    start, end = boundaries[0], boundaries[-1]
+    pipeline = [
+        # the (shop_id, timestamp) index narrows the scan down to the monthly buckets of the reported range
+        {'$match': {'shop_id': shop_id, 'timestamp': {'$gte': ledger_bucket(start), '$lt': end}}},
+        {'$unwind': '$transactions'},
+        {'$match': {'transactions.timestamp': {'$gte': start, '$lt': end}}},
+        {'$bucket': {
+            'groupBy': '$transactions.timestamp',
+            'boundaries': boundaries,
+            'output': {
+                'debts': {'$sum': {'$cond': [{'$eq': ['$transactions.type', 'debt']}, '$transactions.amount', 0]}},
+                'payments': {'$sum': {'$cond': [{'$eq': ['$transactions.type', 'payment']},
+                                                '$transactions.amount', 0]}},
+            },
+        }},
+    ]
+    return {result.get('_id'): result for result in ledger_secondary_col.aggregate(pipeline, session=session)}
+
+
+def _build_report(shop_id, unit, now, top_debtors_limit, write_time=None):
+    starts = report_periods(unit, now)
+    closed_starts = starts[:-1]
+
+    # closed periods never change again, so they are computed once and then read from the cache
+    cached = {doc.get('start'): doc for doc in report_cache_col.find(
+        {'shop_id': shop_id, 'unit': unit, 'start': {'$in': closed_starts}}, {'start': 1, 'debts': 1, 'payments': 1})}
+
+    first_missing = next(start for start in starts if start not in cached)
+    boundaries = starts[starts.index(first_missing):] + [next_period_start(unit, starts[-1])]
+    with read_session(write_time) as session:
+        computed = _aggregate_periods(shop_id, boundaries, session)
+        top_debtors = Debtor.from_docs(debtors_secondary_col.find(
+            {'shop_id': shop_id, 'debt_amount': {'$gt': 0}}, TOP_DEBTOR_PROJECTION, session=session)
+            .sort([('debt_amount', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)])
+            .limit(top_debtors_limit), TOP_DEBTOR_PROJECTION)
+
+    # a secondary may still lack the last postings of a period that closed moments ago, so it is cached a bit later
+    settled = now - timedelta(seconds=max_staleness() + 10)
+    periods = []
+    cache_requests = []
+    for start in starts:
+        result = cached.get(start) or computed.get(start) or {}
+        period = {'start': start, 'debts': result.get('debts', 0), 'payments': result.get('payments', 0)}
+        periods.append(period)
+        if start in closed_starts and start not in cached and next_period_start(unit, start) <= settled:
+            cache_requests.append(UpdateOne({'shop_id': shop_id, 'unit': unit, 'start': start},
+                                            {'$set': {'debts': period['debts'], 'payments': period['payments']}},
+                                            upsert=True))
+    if cache_requests:
+        report_cache_col.bulk_write(cache_requests, ordered=False)
+
+    return {'unit': unit, 'periods': periods, 'top_debtors': top_debtors}
+
+
+async def build_report(shop_id, unit, top_debtors_limit=5):
+    """Returns debts and payments of the shop per period of `unit` and its largest debtors."""
+    return await run_in_executor(_build_report, shop_id, unit, datetime.now(), top_debtors_limit,
+                                 last_write(shop_id))
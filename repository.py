@@ -0,0 +1,689 @@
+import asyncio
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import partial
+from os import environ
+
+import pymongo
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from cache import TTLCache
+from group_commit import GroupCommitter
+from models import Debtor, Shop, Transaction
+from search import normalize, match_score
+from database import get_client, debtors_col, shops_col, ledger_col, shop_summaries_col, debtor_chats_col, \
+    debtors_secondary_col, ledger_secondary_col, max_staleness, supports_transactions
+
+logger = logging.getLogger(__name__)
+
+# Executor =============================================================================================================
+# pymongo is blocking, so every query runs on a worker thread and the event loop keeps serving other conversations.
+MONGO_EXECUTOR_WORKERS = 32
+
+_executor = ThreadPoolExecutor(max_workers=MONGO_EXECUTOR_WORKERS, thread_name_prefix='mongo')
+
+
+async def run_in_executor(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, partial(func, *args, **kwargs))
+
+
+# Caches ===============================================================================================================
+# Read-through caches of whole documents. Writes made by this process invalidate the touched entries and the TTL
+# bounds how stale an entry written by another process can get.
+debtors_cache = TTLCache('debtors', maxsize=int(environ.get('DEBTORS_CACHE_SIZE', 10000)),
+                         ttl=int(environ.get('DEBTORS_CACHE_TTL', 60)))
+shops_cache = TTLCache('shops', maxsize=int(environ.get('SHOPS_CACHE_SIZE', 1000)),
+                       ttl=int(environ.get('SHOPS_CACHE_TTL', 300)))
+# cluster and operation time of this process' latest write per shop and debtor, kept for as long as a secondary
+# serving reads may lack it, max staleness plus the heartbeat interval it is estimated at; only filled on replica sets
+recent_writes = TTLCache('recent_writes', maxsize=int(environ.get('RECENT_WRITES_CACHE_SIZE', 10000)),
+                         ttl=max_staleness() + 10)
+# (version, read time) of every shop, see find_shop_version
+shop_versions = TTLCache('shop_versions', maxsize=int(environ.get('SHOP_VERSIONS_CACHE_SIZE', 1000)),
+                         ttl=float(environ.get('SHOP_VERSIONS_CACHE_TTL', 5)))
+
+CACHES = [debtors_cache, shops_cache, recent_writes, shop_versions]
+
+
+def _cache_shop(shop):
+    if shop is not None:
+        shops_cache.set(('_id', shop.id), shop)
+        shops_cache.set(('phone_number', shop.phone_number), shop)
+    return shop
+
+
+# Read routing =========================================================================================================
+# Lists, search, history, reports and exports read from secondaries, everything a write depends on and the debtor card
+# shown right after a posting read from the primary. A user reading their own recent write from a secondary does so in
+# a causally consistent session, so the secondary waits until it has applied that write.
+def _write_in_session(write, transaction=False):
+    """
+    Runs `write(session)` and returns its result and, on a replica set, the cluster and operation time of the write,
+    to be passed to read_session. Without a replica set there are no secondaries and the session is None.
+    """
+    if not supports_transactions():
+        return write(None), None
+    with get_client().start_session() as session:
+        result = session.with_transaction(write) if transaction else write(session)
+        if session.operation_time is None:
+            return result, None
+        return result, (session.cluster_time, session.operation_time)
+
+
+def _remember_write(write_time, *ids):
+    if write_time is not None:
+        for _id in ids:
+            recent_writes.set(_id, write_time)
+
+
+def last_write(_id):
+    """Returns the time of this process' latest write to the shop or debtor `_id` that a secondary may lack."""
+    return recent_writes.get(_id)
+
+
+@contextmanager
+def read_session(write_time):
+    """Yields a causally consistent session that only reads data which includes the write at `write_time`, or None."""
+    if write_time is None:
+        yield None
+        return
+    cluster_time, operation_time = write_time
+    with get_client().start_session(causal_consistency=True) as session:
+        session.advance_cluster_time(cluster_time)
+        session.advance_operation_time(operation_time)
+        yield session
+
+
+# Shops ================================================================================================================
+async def find_shop(shop_id):
+    shop = shops_cache.get(('_id', shop_id))
+    if shop is None:
+        shop = _cache_shop(Shop.from_doc(await run_in_executor(shops_col.find_one, {'_id': shop_id})))
+    return shop
+
+
+async def find_shop_by_phone(phone_number):
+    shop = shops_cache.get(('phone_number', phone_number))
+    if shop is None:
+        shop = _cache_shop(Shop.from_doc(await run_in_executor(shops_col.find_one, {'phone_number': phone_number})))
+    return shop
+
+
+async def insert_shop(shop_doc):
+    result = await run_in_executor(shops_col.insert_one, shop_doc)
+    return result.inserted_id
+
+
+def _reminder_days(shop):
+    return shop.reminder_days if shop is not None else None
+
+
+# Debtors ==============================================================================================================
+async def find_debtor(debtor_id):
+    debtor = debtors_cache.get(debtor_id)
+    if debtor is None:
+        generation = debtors_cache.generation
+        debtor = Debtor.from_doc(await run_in_executor(debtors_col.find_one, {'_id': debtor_id}))
+        if debtor is not None:
+            debtors_cache.set(debtor_id, debtor, generation)
+    return debtor
+
+
+async def find_debtor_id_by_phone(shop_id, debtor_phone):
+    debtor = await run_in_executor(debtors_col.find_one, {'shop_id': shop_id, 'phone_number': debtor_phone},
+                                   {'_id': 1})
+    return debtor.get('_id') if debtor is not None else None
+
+
+# Keyset sort orders of the debtor list, the trailing `_id` makes every key unique
+DEBTORS_SORT_ORDERS = {
+    'debt': [('debt_amount', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)],
+    'name': [('name', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)],
+    'recent': [('last_activity', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)],
+}
+
+
+def _keyset_filter(sort_order, after):
+    (field, direction), _ = sort_order
+    value, last_id = after
+    operator = '$gt' if direction == pymongo.ASCENDING else '$lt'
+    return {'$or': [{field: {operator: value}},
+                    {field: value, '_id': {operator: last_id}}]}
+
+
+def _find_debtors_page(shop_id, sort, after, limit, projection, write_time):
+    sort_order = DEBTORS_SORT_ORDERS[sort]
+    query = {'shop_id': shop_id}
+    if after is not None:
+        query.update(_keyset_filter(sort_order, after))
+    with read_session(write_time) as session:
+        return Debtor.from_docs(debtors_secondary_col.find(query, projection, session=session)
+                                .sort(sort_order).limit(limit), projection)
+
+
+async def find_debtors_page(shop_id, sort, after=None, limit=20, projection=None, read_time=None):
+    """
+    Returns up to `limit` debtors of a shop in `sort` order, starting after the `[value, _id]` key `after`. With the
+    `read_time` of find_shop_version, the debtors are at least as recent as that version.
+    """
+    return await run_in_executor(_find_debtors_page, shop_id, sort, after, limit, projection,
+                                 read_time or last_write(shop_id))
+
+
+def debtors_page_key(sort, debtor):
+    """Returns the keyset cursor of `debtor` for `sort`, to be passed as `after` for the next page."""
+    (field, _), _ = DEBTORS_SORT_ORDERS[sort]
+    return [getattr(debtor, field), debtor.id]
+
+
+# candidates fetched per search query before they are ranked, the first ones in the order of the index below
+SEARCH_CANDIDATES_LIMIT = 200
+SEARCH_INDEX = 'shop_id_search_keys'
+
+
+def _find_debtors_by_key_prefix(shop_id, prefix, projection, write_time):
+    # an anchored regex on the normalized keys is answered from the (shop_id, search_keys) index. Hinting it makes the
+    # candidates the same on every search: those with the alphabetically first matching keys, not whichever documents
+    # a plan happens to reach first
+    with read_session(write_time) as session:
+        return Debtor.from_docs(debtors_secondary_col.find(
+            {'shop_id': shop_id, 'search_keys': {'$regex': '^' + re.escape(prefix)}}, projection,
+            session=session).hint(SEARCH_INDEX).limit(SEARCH_CANDIDATES_LIMIT), projection)
+
+
+async def search_debtors(shop_id, query, limit, projection=None):
+    """
+    Returns up to `limit` debtors whose name or nickname matches `query` by prefix or fuzzily, best first. Only the
+    first SEARCH_CANDIDATES_LIMIT debtors by key sharing the query's first two letters are ranked for fuzzy matches, so
+    in a shop with more of them a misspelled query may miss debtors whose keys sort after those.
+    """
+    normalized = normalize(query)
+    if not normalized:
+        return []
+
+    projection = dict(projection or {'name': 1, 'debt_amount': 1}, search_keys=1)
+    write_time = last_write(shop_id)
+    candidates = await run_in_executor(_find_debtors_by_key_prefix, shop_id, normalized, projection, write_time)
+    if len(candidates) < limit and len(normalized) > 2:
+        # fuzzy matches only need to share the first two letters, the rest may contain typos
+        found_ids = {candidate.id for candidate in candidates}
+        candidates += [candidate for candidate in
+                       await run_in_executor(_find_debtors_by_key_prefix, shop_id, normalized[:2], projection,
+                                             write_time)
+                       if candidate.id not in found_ids]
+
+    scored = [(match_score(normalized, candidate.search_keys), candidate) for candidate in candidates]
+    scored = sorted((item for item in scored if item[0] > 0), key=lambda item: (-item[0], item[1].name))
+    return [candidate for _, candidate in scored[:limit]]
+
+
+async def find_debts(debtor_phone_number):
+    """Returns (debtor, shop name) of every debt of the phone number, the shop joined in a single aggregation."""
+    pipeline = [
+        {'$match': {'phone_number': debtor_phone_number}},
+        {'$lookup': {'from': shops_col.name, 'localField': 'shop_id', 'foreignField': '_id', 'as': 'shop'}},
+        {'$project': {'debt_amount': 1, 'shop_name': {'$arrayElemAt': ['$shop.name', 0]}}},
+    ]
+    docs = await run_in_executor(lambda: list(debtors_secondary_col.aggregate(pipeline)))
+    return [(Debtor.from_doc(doc, {'debt_amount': 1}), doc.get('shop_name')) for doc in docs]
+
+
+def _with_remind_at(debtor_doc, reminder_days):
+    if reminder_days and debtor_doc.get('debt_amount') > 0:
+        return dict(debtor_doc, remind_at=debtor_doc.get('last_activity') + timedelta(days=reminder_days))
+    return debtor_doc
+
+
+def _insert_debtor(debtor_doc, reminder_days):
+    def insert(session):
+        result = debtors_col.insert_one(_with_remind_at(dict(debtor_doc, last_activity=datetime.now()), reminder_days),
+                                        session=session)
+        shop_summaries_col.update_one({'_id': debtor_doc.get('shop_id')}, _summary_debtors_update([debtor_doc]),
+                                      upsert=True, session=session)
+        return result.inserted_id
+
+    return _write_in_session(insert)
+
+
+async def insert_debtor(debtor_doc):
+    shop = await find_shop(debtor_doc.get('shop_id'))
+    debtor_id, write_time = await run_in_executor(_insert_debtor, debtor_doc, _reminder_days(shop))
+    debtors_cache.invalidate(debtor_id)
+    shop_versions.invalidate(debtor_doc.get('shop_id'))
+    _remember_write(write_time, debtor_doc.get('shop_id'))
+    return debtor_id
+
+
+def _insert_debtors(shop_id, debtor_docs, reminder_days):
+    def insert(session):
+        phone_numbers = [debtor_doc.get('phone_number') for debtor_doc in debtor_docs]
+        existing = {debtor.get('phone_number') for debtor in debtors_col.find(
+            {'shop_id': shop_id, 'phone_number': {'$in': phone_numbers}}, {'_id': 0, 'phone_number': 1},
+            session=session)}
+
+        now = datetime.now()
+        new_docs = [_with_remind_at(dict(debtor_doc, last_activity=now), reminder_days) for debtor_doc in debtor_docs
+                    if debtor_doc.get('phone_number') not in existing]
+        if new_docs:
+            try:
+                debtors_col.insert_many(new_docs, ordered=False, session=session)
+            except BulkWriteError as error:
+                # debtors added by someone else since the lookup above hit the (shop_id, phone_number) index
+                for write_error in error.details.get('writeErrors'):
+                    if write_error.get('code') != 11000:
+                        raise
+                    existing.add(new_docs[write_error.get('index')].get('phone_number'))
+
+            inserted_docs = [debtor_doc for debtor_doc in new_docs if debtor_doc.get('phone_number') not in existing]
+            if inserted_docs:
+                shop_summaries_col.update_one({'_id': shop_id}, _summary_debtors_update(inserted_docs), upsert=True,
+                                              session=session)
+        return existing
+
+    return _write_in_session(insert)
+
+
+async def insert_debtors(shop_id, debtor_docs):
+    """Inserts a batch of debtors of one shop, skipping phone numbers the shop already has. Returns the skipped ones."""
+    shop = await find_shop(shop_id)
+    try:
+        existing, write_time = await run_in_executor(_insert_debtors, shop_id, debtor_docs, _reminder_days(shop))
+    finally:
+        shop_versions.invalidate(shop_id)
+    _remember_write(write_time, shop_id)
+    return existing
+
+
+# Shop summaries =======================================================================================================
+def summary_day(timestamp):
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _summary_debtors_update(debtor_docs):
+    return {'$inc': {
+        'debtor_count': len(debtor_docs),
+        'total_outstanding': sum(debtor_doc.get('debt_amount') for debtor_doc in debtor_docs),
+        'arrears_count': sum(1 for debtor_doc in debtor_docs if debtor_doc.get('debt_amount') > 0),
+        'version': 1,
+    }}
+
+
+def _summary_posting_totals(transaction, balance_before, balance_after):
+    """Returns how a posting changes total_outstanding, arrears_count, today_debts and today_payments."""
+    return [
+        balance_after - balance_before,
+        int(balance_after > 0) - int(balance_before > 0),
+        transaction.amount if transaction.type == 'debt' else 0,
+        transaction.amount if transaction.type == 'payment' else 0,
+    ]
+
+
+def _summary_posting_update(day, totals):
+    # an update pipeline, so today's totals start over from zero on the first posting of a new day
+    outstanding, arrears, debts, payments = totals
+    is_today = {'$eq': ['$day', day]}
+    return [{'$set': {
+        'total_outstanding': {'$add': [{'$ifNull': ['$total_outstanding', 0]}, outstanding]},
+        'arrears_count': {'$add': [{'$ifNull': ['$arrears_count', 0]}, arrears]},
+        'today_debts': {'$cond': [is_today, {'$add': ['$today_debts', debts]}, debts]},
+        'today_payments': {'$cond': [is_today, {'$add': ['$today_payments', payments]}, payments]},
+        'day': day,
+        'version': {'$add': [{'$ifNull': ['$version', 0]}, 1]},
+    }}]
+
+
+async def find_shop_summary(shop_id):
+    return await run_in_executor(shop_summaries_col.find_one, {'_id': shop_id})
+
+
+def _find_shop_version(shop_id):
+    if not supports_transactions():
+        return (shop_summaries_col.find_one({'_id': shop_id}, {'version': 1}) or {}).get('version', 0), None
+    with get_client().start_session(causal_consistency=True) as session:
+        summary = shop_summaries_col.find_one({'_id': shop_id}, {'version': 1}, session=session)
+        return (summary or {}).get('version', 0), (session.cluster_time, session.operation_time)
+
+
+async def find_shop_version(shop_id):
+    """
+    Returns the version of the shop, which every debtor insert and posting bumps, and the time it was read on the
+    primary: reads passed that time see the shop at least at that version, even on a secondary. Checks are cached
+    briefly, writes of this process show up right away, the ones of other processes within the cache's TTL.
+    """
+    version = shop_versions.get(shop_id)
+    if version is None:
+        # a version read while this process posts to the shop is not cached, it may be from before the posting
+        generation = shop_versions.generation
+        version = await run_in_executor(_find_shop_version, shop_id)
+        shop_versions.set(shop_id, version, generation)
+    return version
+
+
+def rebuild_shop_summary(shop_id):
+    """Recomputes the summary of a shop from its debtors and today's ledger entries. Blocking."""
+    totals = next(debtors_col.aggregate([
+        {'$match': {'shop_id': shop_id}},
+        {'$group': {'_id': None,
+                    'debtor_count': {'$sum': 1},
+                    'total_outstanding': {'$sum': '$debt_amount'},
+                    'arrears_count': {'$sum': {'$cond': [{'$gt': ['$debt_amount', 0]}, 1, 0]}}}},
+    ]), {})
+
+    day = summary_day(datetime.now())
+    today = {result.get('_id'): result.get('amount') for result in ledger_col.aggregate([
+        {'$match': {'shop_id': shop_id, 'timestamp': ledger_bucket(day)}},
+        {'$unwind': '$transactions'},
+        {'$match': {'transactions.timestamp': {'$gte': day}}},
+        {'$group': {'_id': '$transactions.type', 'amount': {'$sum': '$transactions.amount'}}},
+    ])}
+
+    summary = {
+        'debtor_count': totals.get('debtor_count', 0),
+        'total_outstanding': totals.get('total_outstanding', 0),
+        'arrears_count': totals.get('arrears_count', 0),
+        'today_debts': today.get('debt', 0),
+        'today_payments': today.get('payment', 0),
+        'day': day,
+    }
+    # the version keeps counting up, so nothing rendered from before the rebuild is shown again
+    shop_summaries_col.update_one({'_id': shop_id}, {'$set': summary, '$inc': {'version': 1}}, upsert=True)
+    return dict(summary, _id=shop_id)
+
+
+# Ledger ===============================================================================================================
+def ledger_bucket(timestamp):
+    """Returns the `timestamp` of the monthly ledger bucket a transaction made at `timestamp` belongs to."""
+    return timestamp.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _debtor_posting_update(amount_delta, timestamp, reminder_days):
+    if not reminder_days:
+        return {"$inc": {"debt_amount": amount_delta}, "$set": {"last_activity": timestamp}}
+
+    # an update pipeline, so the reminder can depend on the balance: it is due `reminder_days` after the balance
+    # became positive or after the last payment, and there is none without a debt
+    balance_after = {'$add': ['$debt_amount', amount_delta]}
+    due = timestamp + timedelta(days=reminder_days)
+    if amount_delta > 0:
+        remind_at = {'$cond': [{'$gt': ['$debt_amount', 0]}, {'$ifNull': ['$remind_at', due]}, due]}
+    else:
+        remind_at = due
+    return [{'$set': {
+        'debt_amount': balance_after,
+        'last_activity': timestamp,
+        'remind_at': {'$cond': [{'$gt': [balance_after, 0]}, remind_at, '$$REMOVE']},
+    }}]
+
+
+def _post_transaction(debtor_id, shop_id, transaction, amount_delta, projection, reminder_days):
+    projection = dict(projection, debt_amount=1) if projection else None
+
+    def post(session=None):
+        debtor = Debtor.from_doc(debtors_col.find_one_and_update(
+            {"_id": debtor_id},
+            _debtor_posting_update(amount_delta, transaction.timestamp, reminder_days),
+            projection=projection,
+            return_document=ReturnDocument.AFTER,
+            session=session
+        ), projection)
+        # a debtor deleted meanwhile gets neither a ledger entry nor a share of the shop's summary
+        if debtor is None:
+            return None
+        ledger_col.update_one(
+            {"debtor_id": debtor_id, "timestamp": ledger_bucket(transaction.timestamp)},
+            {"$push": {"transactions": transaction.to_doc()},
+             "$setOnInsert": {"shop_id": shop_id}},
+            upsert=True,
+            session=session
+        )
+        shop_summaries_col.update_one(
+            {"_id": shop_id},
+            _summary_posting_update(summary_day(transaction.timestamp), _summary_posting_totals(
+                transaction, debtor.debt_amount - amount_delta, debtor.debt_amount)),
+            upsert=True,
+            session=session
+        )
+        return debtor
+
+    return _write_in_session(post, transaction=True)
+
+
+def _post_transactions(postings):
+    """
+    Blocking. Writes a batch of postings with one ordered bulk write per collection, see enable_group_commit. Returns
+    the (debtor, write time) of every posting like _post_transaction does.
+    """
+    projections = [posting[4] for posting in postings]
+    projection = None
+    if all(projections):
+        projection = {'debt_amount': 1}
+        for posting_projection in projections:
+            projection.update(posting_projection)
+
+    def post(session=None):
+        debtors_col.bulk_write([
+            UpdateOne({"_id": debtor_id},
+                      _debtor_posting_update(amount_delta, transaction.timestamp, reminder_days))
+            for debtor_id, _, transaction, amount_delta, _, reminder_days in postings], ordered=True, session=session)
+        debtors = {debtor.get('_id'): debtor for debtor in debtors_col.find(
+            {'_id': {'$in': list({posting[0] for posting in postings})}}, projection, session=session)}
+        posted = [posting for posting in postings if posting[0] in debtors]
+        if posted:
+            ledger_col.bulk_write([
+                UpdateOne({"debtor_id": debtor_id, "timestamp": ledger_bucket(transaction.timestamp)},
+                          {"$push": {"transactions": transaction.to_doc()}, "$setOnInsert": {"shop_id": shop_id}},
+                          upsert=True)
+                for debtor_id, shop_id, transaction, _, _, _ in posted], ordered=True, session=session)
+
+        # walking back from the balances after the batch gives every posting the balance right after it
+        balances = {debtor_id: debtor.get('debt_amount') for debtor_id, debtor in debtors.items()}
+        results = [None] * len(postings)
+        summaries = {}
+        for index in reversed(range(len(postings))):
+            debtor_id, shop_id, transaction, amount_delta, _, _ = postings[index]
+            if debtor_id not in balances:
+                continue
+            balance_after = balances[debtor_id]
+            balances[debtor_id] = balance_after - amount_delta
+            results[index] = Debtor.from_doc(dict(debtors[debtor_id], debt_amount=balance_after), projection)
+
+            totals = summaries.setdefault((shop_id, summary_day(transaction.timestamp)), [0, 0, 0, 0])
+            for position, change in enumerate(_summary_posting_totals(transaction, balances[debtor_id], balance_after)):
+                totals[position] += change
+
+        if summaries:
+            shop_summaries_col.bulk_write([
+                UpdateOne({"_id": shop_id}, _summary_posting_update(day, totals), upsert=True)
+                for (shop_id, day), totals in sorted(summaries.items(), key=lambda summary: summary[0][1])],
+                ordered=True, session=session)
+        return results
+
+    results, write_time = _write_in_session(post, transaction=True)
+    return [(debtor, write_time) for debtor in results]
+
+
+_group_commit = None
+
+
+def enable_group_commit(max_batch, max_delay):
+    """
+    Makes post_transaction queue its postings and write them in batches, trading a few milliseconds of latency for
+    far fewer round trips at peak. Every caller still gets its own acknowledged result. A batch is written in one
+    transaction where the deployment supports it. Meant for a single bot process: without transactions, another
+    process posting to the same debtor at the same moment can skew the arrears count of the shop's summary.
+    """
+    global _group_commit
+    _group_commit = GroupCommitter(partial(run_in_executor, _post_transactions), max_batch, max_delay)
+    _group_commit.start()
+
+
+async def disable_group_commit():
+    """Writes the postings still queued, then goes back to writing every posting on its own."""
+    global _group_commit
+    if _group_commit is not None:
+        group_commit, _group_commit = _group_commit, None
+        await group_commit.close()
+
+
+async def post_transaction(debtor_id, shop_id, transaction, amount_delta, projection=None):
+    """
+    Appends `transaction` to the ledger and applies `amount_delta` to the debtor's balance and the shop's summary,
+    all in one multi-document transaction where the deployment supports it. Returns the updated debtor, loaded with
+    `projection` and its `debt_amount`, or None without posting anything if the debtor no longer exists.
+    """
+    shop = await find_shop(shop_id)
+    posting = (debtor_id, shop_id, transaction, amount_delta, projection, _reminder_days(shop))
+    try:
+        if _group_commit is not None:
+            debtor, write_time = await _group_commit.submit(posting)
+        else:
+            debtor, write_time = await run_in_executor(_post_transaction, *posting)
+    finally:
+        debtors_cache.invalidate(debtor_id)
+        shop_versions.invalidate(shop_id)
+    _remember_write(write_time, shop_id, debtor_id)
+    return debtor
+
+
+def _find_transactions_page(debtor_id, before, limit, write_time):
+    query = {'debtor_id': debtor_id}
+    if isinstance(before, datetime):
+        # a bare timestamp, as cursors were before they had the position, continues before that time
+        before = (before, -1)
+    if before is not None:
+        # the persistence stores user_data's cursors as lists
+        before = tuple(before)
+        query['timestamp'] = {'$lte': ledger_bucket(before[0])}
+
+    with read_session(write_time) as session:
+        # buckets are read newest first and only until the page is full
+        buckets = ledger_secondary_col.find(query, {'transactions': 1}, session=session) \
+            .sort('timestamp', pymongo.DESCENDING).batch_size(2)
+        page = []
+        for bucket in buckets:
+            # a transaction's position in its bucket, which only ever grows, orders the ones made at the same time
+            keyed = [((transaction.get('timestamp'), position), transaction)
+                     for position, transaction in enumerate(bucket.get('transactions'))]
+            for key, transaction in sorted(keyed, key=lambda pair: pair[0], reverse=True):
+                if before is None or key < before:
+                    page.append((key, Transaction.from_doc(transaction)))
+            if len(page) >= limit:
+                buckets.close()
+                break
+    return page[:limit]
+
+
+async def find_transactions_page(debtor_id, before=None, limit=20):
+    """
+    Returns up to `limit` (cursor, transaction) pairs of a debtor newest first, all older than the `before` cursor.
+    A pair's cursor as `before` continues right after its transaction, even past others made in the same millisecond.
+    """
+    return await run_in_executor(_find_transactions_page, debtor_id, before, limit, last_write(debtor_id))
+
+
+def iter_shop_ledger(shop_id, debtor_projection, write_time=None):
+    """
+    Yields (debtor, transaction) pairs of every debtor of a shop in `_id` order and their transactions oldest first,
+    with `None` as the transaction of debtors without any. Blocking, both cursors are merged batch by batch so
+    memory stays flat however long the history is. Pass last_write(shop_id), taken on the event loop, as `write_time`.
+    """
+    with read_session(write_time) as session:
+        debtors = debtors_secondary_col.find({'shop_id': shop_id}, debtor_projection, session=session) \
+            .sort('_id', pymongo.ASCENDING)
+        buckets = ledger_secondary_col.find({'shop_id': shop_id}, {'debtor_id': 1, 'transactions': 1},
+                                            session=session) \
+            .sort([('debtor_id', pymongo.ASCENDING), ('timestamp', pymongo.ASCENDING)])
+
+        bucket = next(buckets, None)
+        for debtor_doc in debtors:
+            debtor = Debtor.from_doc(debtor_doc, debtor_projection)
+            # buckets of debtors that no longer exist
+            while bucket is not None and bucket.get('debtor_id') < debtor.id:
+                bucket = next(buckets, None)
+
+            has_transactions = False
+            while bucket is not None and bucket.get('debtor_id') == debtor.id:
+                for transaction in sorted(bucket.get('transactions'), key=lambda t: t.get('timestamp')):
+                    has_transactions = True
+                    yield debtor, Transaction.from_doc(transaction)
+                bucket = next(buckets, None)
+
+            if not has_transactions:
+                yield debtor, None
+
+
+# Reminders ============================================================================================================
+def _set_reminder_days(shop_id, reminder_days):
+    if reminder_days:
+        shops_col.update_one({'_id': shop_id}, {'$set': {'reminder_days': reminder_days}})
+        debtors_col.update_many({'shop_id': shop_id}, [{'$set': {'remind_at': {'$cond': [
+            {'$gt': ['$debt_amount', 0]},
+            {'$add': ['$last_activity', reminder_days * 24 * 3600 * 1000]},
+            '$$REMOVE']}}}])
+    else:
+        shops_col.update_one({'_id': shop_id}, {'$unset': {'reminder_days': ''}})
+        debtors_col.update_many({'shop_id': shop_id, 'remind_at': {'$exists': True}}, {'$unset': {'remind_at': ''}})
+
+
+async def set_reminder_days(shop_id, reminder_days):
+    """Turns on reminders to debtors of the shop whose balance stayed unpaid for `reminder_days`, 0 turns them off."""
+    try:
+        await run_in_executor(_set_reminder_days, shop_id, reminder_days)
+    finally:
+        shop = shops_cache.get(('_id', shop_id))
+        shops_cache.invalidate(('_id', shop_id))
+        if shop is not None:
+            shops_cache.invalidate(('phone_number', shop.phone_number))
+
+
+def _claim_due_reminders(now, limit, projection):
+    projection = dict(projection, shop_id=1, debt_amount=1, remind_at=1) if projection else None
+    debtors = Debtor.from_docs(debtors_col.find({'remind_at': {'$lte': now}}, projection)
+                               .sort('remind_at', pymongo.ASCENDING).limit(limit), projection)
+    if not debtors:
+        return []
+
+    shop_projection = {'name': 1, 'reminder_days': 1}
+    shops = {shop.id: shop for shop in Shop.from_docs(shops_col.find(
+        {'_id': {'$in': list({debtor.shop_id for debtor in debtors})}}, shop_projection), shop_projection)}
+    claimed = []
+    for debtor in debtors:
+        shop = shops.get(debtor.shop_id)
+        # debtors who paid off in the meantime or whose shop turned reminders off lose their reminder
+        reminder_days = _reminder_days(shop) if (debtor.debt_amount or 0) > 0 else None
+        # pushing remind_at forward before anything is sent, and only if it still is what was read, makes a reminder
+        # go out at most once, even if two processes sweep at the same time or the bot stops before its outbox is empty
+        result = debtors_col.update_one({'_id': debtor.id, 'remind_at': debtor.remind_at},
+                                        {'$set': {'remind_at': now + timedelta(days=reminder_days)}}
+                                        if reminder_days else {'$unset': {'remind_at': ''}})
+        if reminder_days and result.matched_count:
+            claimed.append((debtor, shop))
+    return claimed
+
+
+async def claim_due_reminders(now, limit, projection=None):
+    """
+    Returns (debtor, shop) of up to `limit` debtors whose reminder is due and schedules their next reminder. Debtors
+    come from the partial remind_at index in the order they became due, never from a scan of the debtors.
+    """
+    return await run_in_executor(_claim_due_reminders, now, limit, projection)
+
+
+async def save_debtor_chat(phone_number, chat_id):
+    await run_in_executor(debtor_chats_col.update_one, {'_id': phone_number},
+                          {'$set': {'chat_id': chat_id, 'updated_at': datetime.now()}}, upsert=True)
+
+
+def _find_debtor_chats(phone_numbers):
+    return {chat.get('_id'): chat.get('chat_id')
+            for chat in debtor_chats_col.find({'_id': {'$in': list(phone_numbers)}}, {'chat_id': 1})}
+
+
+async def find_debtor_chats(phone_numbers):
+    """Returns the chat ids of the debtors with `phone_numbers` who signed in to the bot, by phone number."""
+    return await run_in_executor(_find_debtor_chats, phone_numbers)
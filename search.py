@@ -0,0 +1,51 @@
+import re
+from difflib import SequenceMatcher
+
+# Uzbek and Russian Cyrillic letters spelled the way the Uzbek Latin alphabet writes them
+CYRILLIC_TO_LATIN = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'yo', 'ж': 'j', 'з': 'z', 'и': 'i', 'й': 'y',
+    'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ф': 'f',
+    'х': 'x', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'sh', 'ъ': '', 'ы': 'i', 'ь': '', 'э': 'e', 'ю': 'yu',
+    'я': 'ya', 'ў': 'o', 'қ': 'q', 'ғ': 'g', 'ҳ': 'h',
+})
+# oʻ and gʻ are written with all kinds of apostrophes
+APOSTROPHES_REGEX = re.compile("['`ʻʼ‘’]")
+NOT_ALPHANUMERIC_REGEX = re.compile('[^a-z0-9]+')
+
+# minimal similarity of a fuzzy match, 1.0 being identical
+FUZZY_MATCH_RATIO = 0.6
+
+
+def normalize(text):
+    """Lower cases, transliterates Cyrillic to Latin and reduces `text` to words of letters and digits."""
+    text = APOSTROPHES_REGEX.sub('', (text or '').lower().translate(CYRILLIC_TO_LATIN))
+    return NOT_ALPHANUMERIC_REGEX.sub(' ', text).strip()
+
+
+def search_keys(*texts):
+    """Returns the normalized texts and each of their words, the keys a debtor can be found by."""
+    keys = []
+    for text in texts:
+        normalized = normalize(text)
+        if not normalized:
+            continue
+        for key in [normalized] + normalized.split():
+            if key not in keys:
+                keys.append(key)
+    return keys
+
+
+def match_score(query, keys):
+    """Scores how well the normalized `query` matches the best of `keys`, 0 if it does not match at all."""
+    best = 0.0
+    for key in keys:
+        if key == query:
+            score = 3.0
+        elif key.startswith(query):
+            # the less of the key is left over, the better the match
+            score = 2.0 + len(query) / len(key)
+        else:
+            ratio = SequenceMatcher(None, query, key[:len(query) + 1]).ratio()
+            score = ratio if ratio >= FUZZY_MATCH_RATIO else 0.0
+        best = max(best, score)
+    return best
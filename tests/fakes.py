@@ -0,0 +1,192 @@
+"""In-memory stand-ins for the pymongo collections and the outbox the tests replace."""
+import re
+from types import SimpleNamespace
+
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+REMOVE = object()
+
+
+def evaluate(expression, doc):
+    """Evaluates the aggregation expressions the repository's update pipelines use."""
+    if expression == '$$REMOVE':
+        return REMOVE
+    if isinstance(expression, str) and expression.startswith('$'):
+        return doc.get(expression[1:])
+    if isinstance(expression, dict) and len(expression) == 1 and next(iter(expression)).startswith('$'):
+        operator, arguments = next(iter(expression.items()))
+        values = [evaluate(argument, doc) for argument in arguments]
+        if operator == '$add':
+            return sum(values)
+        if operator == '$ifNull':
+            return values[0] if values[0] is not None else values[1]
+        if operator == '$cond':
+            return values[1] if values[0] else values[2]
+        if operator == '$eq':
+            return values[0] == values[1]
+        if operator == '$gt':
+            # null sorts before numbers
+            return values[0] is not None and (values[1] is None or values[0] > values[1])
+        raise NotImplementedError(operator)
+    return expression
+
+
+def _satisfies(value, operators):
+    for operator, operand in operators.items():
+        if operator == '$not':
+            satisfied = not _satisfies(value, operand)
+        elif operator == '$in':
+            satisfied = any(item in operand for item in value) if isinstance(value, list) else value in operand
+        elif operator == '$regex':
+            satisfied = any(isinstance(item, str) and re.search(operand, item)
+                            for item in (value if isinstance(value, list) else [value]))
+        elif value is None:
+            # comparisons never match a missing field
+            satisfied = False
+        elif operator in ('$lt', '$lte', '$gt', '$gte'):
+            satisfied = {'$lt': value < operand, '$lte': value <= operand,
+                         '$gt': value > operand, '$gte': value >= operand}[operator]
+        else:
+            raise NotImplementedError(operator)
+        if not satisfied:
+            return False
+    return True
+
+
+def matches(doc, query):
+    for field, condition in (query or {}).items():
+        value = doc.get(field)
+        if field == '$or':
+            satisfied = any(matches(doc, alternative) for alternative in condition)
+        elif isinstance(condition, dict) and all(key.startswith('$') for key in condition):
+            satisfied = _satisfies(value, condition)
+        elif isinstance(value, list) and not isinstance(condition, list):
+            satisfied = condition in value
+        else:
+            satisfied = value == condition
+        if not satisfied:
+            return False
+    return True
+
+
+def project(doc, projection):
+    if projection is None:
+        return dict(doc)
+    if not any(projection.values()):
+        return {key: value for key, value in doc.items() if key not in projection}
+    return {key: value for key, value in doc.items() if key == '_id' or projection.get(key)}
+
+
+class FakeCursor(list):
+    """The found documents, projected only when iterated, so that they sort by fields the projection leaves out."""
+
+    def __init__(self, docs=(), projection=None):
+        super().__init__(docs)
+        self.projection = projection
+
+    def __iter__(self):
+        return (project(doc, self.projection) for doc in super().__iter__())
+
+    def sort(self, key_or_list=None, direction=None, key=None, reverse=False):
+        if key is not None or key_or_list is None:
+            super().sort(key=key, reverse=reverse)
+            return self
+        sort_order = [(key_or_list, direction)] if isinstance(key_or_list, str) else key_or_list
+        for field, field_direction in reversed(sort_order):
+            super().sort(key=lambda doc: doc.get(field), reverse=field_direction < 0)
+        return self
+
+    def limit(self, limit):
+        return FakeCursor(list.__getitem__(self, slice(limit or None)), self.projection)
+
+    def batch_size(self, batch_size):
+        return self
+
+    def hint(self, index):
+        return self
+
+    def close(self):
+        pass
+
+
+class Collection:
+    """In-memory collection that records the commands sent to it and applies updates and update pipelines."""
+
+    cursor_class = FakeCursor
+
+    def __init__(self, docs=()):
+        self.docs = list(docs)
+        self.commands = []
+
+    def _update(self, query, update, upsert):
+        doc = next((doc for doc in self.docs if matches(doc, query)), None)
+        inserted = doc is None and upsert
+        if inserted:
+            doc = {field: condition for field, condition in query.items()
+                   if not field.startswith('$') and not isinstance(condition, dict)}
+            doc.setdefault('_id', ObjectId())
+            if any(existing.get('_id') == doc['_id'] for existing in self.docs):
+                raise DuplicateKeyError('E11000 duplicate key error')
+            self.docs.append(doc)
+        if doc is None:
+            return None, False
+
+        if isinstance(update, list):
+            for stage in update:
+                values = {field: evaluate(expression, doc) for field, expression in stage['$set'].items()}
+                for field, value in values.items():
+                    if value is REMOVE:
+                        doc.pop(field, None)
+                    else:
+                        doc[field] = value
+            return doc, inserted
+
+        if inserted:
+            doc.update(update.get('$setOnInsert', {}))
+        for field, amount in update.get('$inc', {}).items():
+            doc[field] = doc.get(field, 0) + amount
+        doc.update(update.get('$set', {}))
+        for field in update.get('$unset', {}):
+            doc.pop(field, None)
+        for field, value in update.get('$push', {}).items():
+            doc.setdefault(field, []).append(value)
+        return doc, inserted
+
+    def find(self, query=None, projection=None, session=None):
+        self.commands.append(('find', query))
+        # a snapshot, as a cursor's first batch is
+        return self.cursor_class([dict(doc) for doc in self.docs if matches(doc, query)], projection)
+
+    def find_one(self, query=None, projection=None, session=None):
+        self.commands.append(('find_one', query))
+        return next((project(doc, projection) for doc in self.docs if matches(doc, query)), None)
+
+    def update_one(self, query, update, upsert=False, session=None):
+        self.commands.append(('update_one', query))
+        doc, inserted = self._update(query, update, upsert)
+        return SimpleNamespace(matched_count=int(doc is not None and not inserted),
+                               upserted_id=doc['_id'] if inserted else None)
+
+    def find_one_and_update(self, query, update, projection=None, return_document=None, session=None):
+        self.commands.append(('find_one_and_update', query))
+        doc, _ = self._update(query, update, False)
+        return project(doc, projection) if doc is not None else None
+
+    def bulk_write(self, requests, ordered=True, session=None):
+        self.commands.append(('bulk_write', None))
+        for request in requests:
+            # the repository only bulk writes pymongo.UpdateOne
+            self._update(request._filter, request._doc, request._upsert)
+
+
+class RecordingOutbox:
+    def __init__(self):
+        self.messages = []
+
+    def send(self, chat_id, text, **kwargs):
+        self.messages.append((chat_id, text))
+
+    @property
+    def texts(self):
+        return [text for _, text in self.messages]
@@ -0,0 +1,51 @@
+import cache
+from cache import TTLCache
+
+
+def test_least_recently_used_entry_is_evicted():
+    debtors = TTLCache('debtors', maxsize=2, ttl=60)
+    debtors.set('a', 1)
+    debtors.set('b', 2)
+    debtors.get('a')
+    debtors.set('c', 3)
+
+    assert debtors.get('b') is None
+    assert debtors.get('a') == 1
+    assert debtors.get('c') == 3
+
+
+def test_expired_entry_is_a_miss(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now[0])
+    debtors = TTLCache('debtors', maxsize=10, ttl=60)
+    debtors.set('a', 1)
+
+    now[0] += 61
+
+    assert debtors.get('a') is None
+    assert len(debtors) == 0
+
+
+def test_stats_count_hits_and_misses():
+    debtors = TTLCache('debtors', maxsize=10, ttl=60)
+    debtors.set('a', 1)
+    debtors.get('a')
+    debtors.get('b')
+    debtors.invalidate('a')
+    debtors.get('a')
+
+    assert debtors.stats() == {'size': 0, 'maxsize': 10, 'hits': 1, 'misses': 2, 'hit_rate': 1 / 3}
+
+
+def test_value_read_before_an_invalidation_is_not_stored():
+    versions = TTLCache('versions', maxsize=1, ttl=60)
+    generation = versions.generation
+    versions.invalidate('a')
+    versions.set('a', 1, generation)
+    # 'a' is no longer among the remembered invalidations, which still makes it too old
+    versions.invalidate('b')
+    versions.set('a', 1, generation)
+    versions.set('c', 3, versions.generation)
+
+    assert versions.get('a') is None
+    assert versions.get('c') == 3
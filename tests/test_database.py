@@ -0,0 +1,33 @@
+import database
+
+
+def test_importing_the_bot_does_not_create_the_client():
+    import main  # noqa: F401
+
+    assert database._client is None
+
+
+def test_client_options_come_from_the_environment(monkeypatch):
+    monkeypatch.setenv('MONGODB_MAX_POOL_SIZE', '200')
+    monkeypatch.setenv('MONGODB_READ_PREFERENCE', 'secondaryPreferred')
+    monkeypatch.delenv('MONGODB_MIN_POOL_SIZE', raising=False)
+
+    options = database.client_options('mongodb://localhost:27017/')
+
+    assert options['maxPoolSize'] == 200
+    assert options['readPreference'] == 'secondaryPreferred'
+    assert options['serverSelectionTimeoutMS'] == 5000
+    assert 'minPoolSize' not in options
+
+
+def test_options_of_the_uri_are_not_overridden_by_defaults(monkeypatch):
+    monkeypatch.setenv('MONGODB_CONNECT_TIMEOUT_MS', '2000')
+    monkeypatch.delenv('MONGODB_SERVER_SELECTION_TIMEOUT_MS', raising=False)
+
+    options = database.client_options('mongodb+srv://cluster.example.com/?serverSelectionTimeoutMS=30000'
+                                      '&connecttimeoutms=10000&appName=other')
+
+    assert 'serverSelectionTimeoutMS' not in options
+    assert 'appname' not in options
+    assert options['connectTimeoutMS'] == 2000
+    assert options['socketTimeoutMS'] == 30000
@@ -0,0 +1,127 @@
+import asyncio
+import threading
+
+from bson import ObjectId
+
+import main
+import repository
+from fakes import Collection
+
+
+def seed(monkeypatch, debtors_count):
+    shop_id = ObjectId()
+    debtors = [{'_id': ObjectId(), 'shop_id': shop_id, 'name': 'debtor {:03d}'.format(i), 'nickname': 'nick',
+                'phone_number': '+998{:09d}'.format(i), 'debt_amount': (i % 50) * 1000, 'transactions': []}
+               for i in range(debtors_count)]
+    debtors_col = Collection(debtors)
+    shops_col = Collection([{'_id': shop_id, 'name': 'shop', 'phone_number': '+998000000000'}])
+    monkeypatch.setattr(repository, 'debtors_col', debtors_col)
+    monkeypatch.setattr(repository, 'debtors_secondary_col', debtors_col)
+    monkeypatch.setattr(repository, 'shops_col', shops_col)
+    monkeypatch.setattr(repository, 'shop_summaries_col', Collection([{'_id': shop_id, 'version': 1}]))
+    monkeypatch.setattr(repository, 'supports_transactions', lambda: False)
+    repository.shop_versions.clear()
+    return shop_id, debtors_col, shops_col
+
+
+def debtor_buttons(reply_markup):
+    return [row[0] for row in reply_markup.inline_keyboard if ObjectId.is_valid(row[0].callback_data)]
+
+
+def test_debtors_list_is_rendered_with_one_query(monkeypatch):
+    shop_id, debtors_col, shops_col = seed(monkeypatch, 800)
+
+    reply_markup = asyncio.run(main.get_debtors_list_keyboard(shop_id, main.new_debtors_list_state()))
+
+    assert len(debtors_col.commands) + len(shops_col.commands) == 1
+    assert len(debtor_buttons(reply_markup)) == main.DEBTORS_PAGE_SIZE
+    assert debtor_buttons(reply_markup)[0].text == "debtor 799 - 49,000 so'm"
+
+
+def test_debtors_list_of_empty_shop_has_only_sort_and_back_buttons(monkeypatch):
+    shop_id, debtors_col, shops_col = seed(monkeypatch, 0)
+
+    reply_markup = asyncio.run(main.get_debtors_list_keyboard(shop_id, main.new_debtors_list_state()))
+
+    assert len(debtors_col.commands) + len(shops_col.commands) == 1
+    assert [row[0].callback_data for row in reply_markup.inline_keyboard] == ['sort_debt', 'back']
+
+
+def test_debtors_list_pages_visit_every_debtor_once(monkeypatch):
+    shop_id, debtors_col, _ = seed(monkeypatch, 95)
+    list_state = main.new_debtors_list_state('name')
+
+    seen = []
+    while True:
+        reply_markup = asyncio.run(main.get_debtors_list_keyboard(shop_id, list_state))
+        seen.extend(button.text.split(' - ')[0] for button in debtor_buttons(reply_markup))
+        if list_state['next_cursor'] is None:
+            break
+        list_state['cursors'].append(list_state['next_cursor'])
+
+    assert seen == ['debtor {:03d}'.format(i) for i in range(95)]
+    assert len(debtors_col.commands) == 5
+
+
+def test_unchanged_list_page_and_card_are_not_queried_again(monkeypatch):
+    shop_id, debtors_col, _ = seed(monkeypatch, 30)
+    repository.debtors_cache.clear()
+
+    first = asyncio.run(main.get_debtors_list_keyboard(shop_id, main.new_debtors_list_state()))
+    card = asyncio.run(main.get_debtor_info(shop_id, debtors_col.docs[0]['_id']))
+    repository.debtors_cache.clear()
+    assert asyncio.run(main.get_debtors_list_keyboard(shop_id, main.new_debtors_list_state())) is first
+    assert asyncio.run(main.get_debtor_info(shop_id, debtors_col.docs[0]['_id'])) == card
+    assert len(debtors_col.commands) == 2
+
+    # a posting bumps the shop's version, so both are read and rendered again
+    repository.shop_summaries_col.docs[0]['version'] += 1
+    repository.shop_versions.invalidate(shop_id)
+    asyncio.run(main.get_debtors_list_keyboard(shop_id, main.new_debtors_list_state()))
+    asyncio.run(main.get_debtor_info(shop_id, debtors_col.docs[0]['_id']))
+    assert len(debtors_col.commands) == 4
+
+
+def test_card_of_a_new_version_shows_another_process_posting(monkeypatch):
+    shop_id, debtors_col, _ = seed(monkeypatch, 1)
+    debtor_id = debtors_col.docs[0]['_id']
+    repository.debtors_cache.clear()
+    assert asyncio.run(main.get_debtor_info(shop_id, debtor_id)).endswith("debt: 0 so'm")
+
+    # another process posts: the version moves but this process' debtor cache still holds the old balance
+    debtors_col.docs[0]['debt_amount'] = 5000
+    repository.shop_summaries_col.docs[0]['version'] += 1
+    repository.shop_versions.clear()
+
+    assert repository.debtors_cache.get(debtor_id) is not None
+    assert asyncio.run(main.get_debtor_info(shop_id, debtor_id)).endswith("debt: 5,000 so'm")
+
+
+def test_version_read_during_a_posting_is_not_cached(monkeypatch):
+    shop_id, debtors_col, _ = seed(monkeypatch, 1)
+    summaries = repository.shop_summaries_col
+    reading, release = threading.Event(), threading.Event()
+
+    def stalled_find_one(query, projection):
+        summary = Collection.find_one(summaries, query, projection)
+        reading.set()
+        release.wait(timeout=5)
+        return summary
+
+    def post(*posting):
+        summaries.docs[0]['version'] += 1
+        return None, None
+
+    monkeypatch.setattr(summaries, 'find_one', stalled_find_one)
+    monkeypatch.setattr(repository, '_post_transaction', post)
+
+    async def read_while_posting():
+        read = asyncio.ensure_future(repository.find_shop_version(shop_id))
+        await asyncio.get_running_loop().run_in_executor(None, reading.wait, 5)
+        await repository.post_transaction(debtors_col.docs[0]['_id'], shop_id, None, 0)
+        release.set()
+        return await read, await repository.find_shop_version(shop_id)
+
+    stale, version = asyncio.run(read_while_posting())
+
+    assert (stale, version) == ((1, None), (2, None))
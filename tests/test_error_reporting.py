@@ -0,0 +1,75 @@
+import asyncio
+
+from pymongo.errors import ServerSelectionTimeoutError
+
+from error_reporting import ErrorReporter, fingerprint
+from fakes import RecordingOutbox
+
+
+def raise_error(message):
+    try:
+        raise ServerSelectionTimeoutError(message)
+    except ServerSelectionTimeoutError as error:
+        return error
+
+
+def test_fingerprint_ignores_the_message_but_not_the_location():
+    first, second = raise_error('localhost:27017: timed out'), raise_error('localhost:27018: refused')
+
+    assert fingerprint(first) == fingerprint(second)
+    assert fingerprint(first).startswith('ServerSelectionTimeoutError at tests/test_error_reporting.py:')
+    assert fingerprint(first) != fingerprint(ValueError())
+
+
+def test_an_outage_is_one_summary_per_interval():
+    outbox = RecordingOutbox()
+    reporter = ErrorReporter(outbox, 1, window=60, interval=600)
+
+    for _ in range(1000):
+        reporter.record(raise_error('timed out'))
+    reporter.flush(now=1000)
+    assert len(outbox.messages) == 1
+    assert '1,000× ServerSelectionTimeoutError' in outbox.texts[0]
+
+    # the same error keeps counting until its interval is over, a new one is reported on the next flush
+    for _ in range(500):
+        reporter.record(raise_error('timed out'))
+    reporter.record(ValueError('bad input'))
+    reporter.flush(now=1060)
+    assert len(outbox.messages) == 2
+    assert 'ValueError' in outbox.texts[1] and 'ServerSelectionTimeoutError' not in outbox.texts[1]
+
+    reporter.flush(now=1600)
+    assert len(outbox.messages) == 3
+    assert '500× ServerSelectionTimeoutError' in outbox.texts[2]
+
+
+def test_stop_waits_for_the_background_task_and_sends_the_rest():
+    outbox = RecordingOutbox()
+    reporter = ErrorReporter(outbox, 1, window=60, interval=600)
+
+    async def run():
+        reporter.start()
+        task = reporter._task
+        reporter.record(raise_error('timed out'))
+        await reporter.stop()
+        return task.cancelled()
+
+    assert asyncio.run(run())
+    assert len(outbox.messages) == 1
+
+
+def test_developer_chat_may_be_an_id_or_a_channel_username(monkeypatch):
+    import main
+
+    monkeypatch.setenv('DEVELOPER_CHAT_ID', '-1001234567890')
+    assert main.developer_chat_id() == -1001234567890
+    assert main.developer_chat_filter().chat_ids == {-1001234567890}
+
+    monkeypatch.setenv('DEVELOPER_CHAT_ID', '@qarz_daftar_errors')
+    assert main.developer_chat_id() == '@qarz_daftar_errors'
+    assert main.developer_chat_filter().usernames == {'qarz_daftar_errors'}
+
+    monkeypatch.delenv('DEVELOPER_CHAT_ID')
+    assert main.developer_chat_id() is None
+    assert not main.developer_chat_filter().chat_ids
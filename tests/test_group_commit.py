@@ -0,0 +1,46 @@
+import asyncio
+
+import pytest
+
+from group_commit import GroupCommitter
+
+
+def test_concurrent_operations_are_written_in_batches_with_their_own_results():
+    batches = []
+
+    async def flush(operations):
+        batches.append(operations)
+        await asyncio.sleep(0.01)
+        return [operation * 10 for operation in operations]
+
+    async def run():
+        committer = GroupCommitter(flush, max_batch=4, max_delay=0.005)
+        committer.start()
+        results = await asyncio.gather(*(committer.submit(operation) for operation in range(10)))
+        await committer.close()
+        return results
+
+    assert asyncio.run(run()) == [operation * 10 for operation in range(10)]
+    assert [len(batch) for batch in batches] == [4, 4, 2]
+
+
+def test_failed_batch_fails_every_operation_and_close_writes_the_rest():
+    async def flush(operations):
+        if 'fail' in operations:
+            raise ValueError('write failed')
+        return operations
+
+    async def run():
+        committer = GroupCommitter(flush, max_batch=10, max_delay=0.005)
+        committer.start()
+        failed = asyncio.gather(committer.submit('fail'), committer.submit('other'), return_exceptions=True)
+        assert [type(result) for result in await failed] == [ValueError, ValueError]
+
+        queued = asyncio.ensure_future(committer.submit('queued'))
+        await asyncio.sleep(0)
+        await committer.close()
+        assert queued.result() == 'queued'
+        with pytest.raises(RuntimeError):
+            await committer.submit('late')
+
+    asyncio.run(run())
@@ -0,0 +1,51 @@
+import asyncio
+
+from bson import ObjectId
+
+import main
+import repository
+
+CSV = '''name,nickname,phone_number,debt_amount
+Ali,,+998901234567,1000
+Vali,,+998901234568,2000
+,,+998901234569,3000
+Hasan,,998901234570,4000
+Husan,,+998901234571,1x
+Olim,,+998901234567,5000
+Karim,,+998901234572
+Salim,ka,+998901234573,0
+
+Nodir,,+998901234574,600
+'''
+
+
+def test_rows_are_validated_and_existing_phone_numbers_skipped_with_errors_in_row_order(monkeypatch, tmp_path):
+    shop_id = ObjectId()
+    existing = {'+998901234568', '+998901234574'}
+    inserted = []
+
+    async def insert_debtors(shop, debtor_docs):
+        assert shop == shop_id
+        inserted.extend(debtor_doc['phone_number'] for debtor_doc in debtor_docs
+                        if debtor_doc['phone_number'] not in existing)
+        return {debtor_doc['phone_number'] for debtor_doc in debtor_docs} & existing
+
+    monkeypatch.setattr(repository, 'insert_debtors', insert_debtors)
+    # row 3 already exists, but its chunk is only written with row 9, after rows 4 to 8 were validated
+    monkeypatch.setattr(main, 'IMPORT_DEBTORS_CHUNK_SIZE', 3)
+    path = tmp_path / 'debtors.csv'
+    path.write_text(CSV, encoding='utf-8')
+
+    imported, errors = asyncio.run(main.import_debtors_csv(str(path), shop_id))
+
+    assert inserted == ['+998901234567', '+998901234573']
+    assert imported == 2
+    assert errors == [
+        'row 3: debtor with phone number +998901234568 already exists',
+        'row 4: name is empty',
+        "row 5: phone number '998901234570' is not in format '+998XXXXXXXXX'",
+        "row 6: invalid debt amount '1x'",
+        'row 7: phone number +998901234567 is repeated in the file',
+        'row 8: expected 4 columns: name, nickname, phone_number, debt_amount',
+        'row 11: debtor with phone number +998901234574 already exists',
+    ]
@@ -0,0 +1,27 @@
+from datetime import datetime
+
+from bson import ObjectId
+
+import repository
+from fakes import Collection
+
+
+def test_pages_visit_transactions_of_the_same_millisecond_across_buckets_once(monkeypatch):
+    debtor_id = ObjectId()
+    end_of_april, start_of_may = datetime(2024, 4, 30, 23, 59), datetime(2024, 5, 1)
+    april = [{'type': 'debt', 'amount': amount, 'timestamp': end_of_april} for amount in range(1, 6)]
+    may = [{'type': 'debt', 'amount': amount, 'timestamp': start_of_may} for amount in range(6, 10)]
+    monkeypatch.setattr(repository, 'ledger_secondary_col', Collection([
+        {'debtor_id': debtor_id, 'timestamp': datetime(2024, 4, 1), 'transactions': april},
+        {'debtor_id': debtor_id, 'timestamp': datetime(2024, 5, 1), 'transactions': may}]))
+
+    seen, before = [], None
+    while True:
+        page = repository._find_transactions_page(debtor_id, before, 3, None)
+        seen.extend(transaction.amount for _, transaction in page)
+        if len(page) < 3:
+            break
+        # cursors come back from the persistence as lists
+        before = list(page[-1][0])
+
+    assert seen == list(range(9, 0, -1))
@@ -0,0 +1,39 @@
+import asyncio
+
+from telegram.ext import CommandHandler, ConversationHandler
+
+import metrics
+from metrics import Histogram
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram('latency_seconds', 'Latency.', ('handler',), buckets=(0.1, 1.0))
+    histogram.observe(('start',), 0.05)
+    histogram.observe(('start',), 0.5)
+    histogram.observe(('start',), 5)
+
+    assert list(histogram.render())[2:] == [
+        'latency_seconds_bucket{handler="start",le="0.1"} 1',
+        'latency_seconds_bucket{handler="start",le="1.0"} 2',
+        'latency_seconds_bucket{handler="start",le="+Inf"} 3',
+        'latency_seconds_sum{handler="start"} 5.55',
+        'latency_seconds_count{handler="start"} 3',
+    ]
+
+
+def test_filter_shape_hides_values():
+    query = {'shop_id': 1, '$or': [{'name': {'$gt': 'a'}}], 'phone_number': {'$in': ['1', '2', '3', '4']}}
+
+    assert metrics.filter_shape(query) == {'shop_id': 'int', '$or': [{'name': {'$gt': 'str'}}],
+                                           'phone_number': {'$in': ['str', 'str', 'str', '...']}}
+
+
+def test_instrumented_conversation_records_handler_latency():
+    async def show_menu(update, context):
+        return 1
+
+    conversation = ConversationHandler(entry_points=[], states={1: [CommandHandler('menu', show_menu)]}, fallbacks=[])
+    metrics.instrument_conversation(conversation, {1: 'MENU'})
+
+    assert asyncio.run(conversation.states[1][0].callback(None, None)) == 1
+    assert 'qarz_daftar_handler_seconds_count{state="MENU",handler="show_menu"} 1' in metrics.render()
@@ -0,0 +1,27 @@
+import pytest
+from bson import ObjectId
+
+from models import Debtor, Transaction
+
+
+def test_projected_debtor_only_has_the_projected_fields():
+    doc = dict(Debtor('Ali', None, '+998901234567', ObjectId(), 5000).to_doc(), _id=ObjectId(), transactions=[])
+
+    debtor = Debtor.from_doc(doc, {'name': 1, 'nickname': 1, 'last_activity': 1})
+
+    assert (debtor.id, debtor.name, debtor.nickname, debtor.last_activity) == (doc['_id'], 'Ali', None, None)
+    with pytest.raises(AttributeError):
+        debtor.debt_amount
+    assert Debtor.from_doc(doc, {'_id': 0, 'name': 1}).to_doc() == {'name': 'Ali'}
+    assert 'search_keys' not in Debtor.from_doc(doc, {'search_keys': 0}).to_doc()
+    assert not hasattr(debtor, '__dict__')
+
+
+def test_documents_round_trip():
+    doc = {'_id': ObjectId(), 'shop_id': ObjectId(), 'name': 'Ali', 'nickname': 'aka', 'phone_number': '+998901234567',
+           'debt_amount': 5000, 'search_keys': ['ali', 'aka'], 'last_activity': None, 'remind_at': None}
+
+    assert Debtor.from_doc(doc).to_doc() == doc
+    assert [transaction.to_doc() for transaction in Transaction.from_docs([{'type': 'debt', 'amount': 1}])] == [
+        {'type': 'debt', 'amount': 1, 'timestamp': None}]
+    assert Debtor.from_doc(None) is None
@@ -0,0 +1,180 @@
+import asyncio
+import os
+import threading
+
+import pymongo
+import pytest
+from pymongo.errors import ServerSelectionTimeoutError
+
+import repository
+from models import Shop
+from fakes import Collection, RecordingOutbox
+from notifier import BalanceNotifier
+
+# change streams need a replica set, e.g. a single node one: mongod --replSet rs0, then rs.initiate() in mongosh
+REPLICA_SET_URI = os.environ.get('MONGODB_REPLICA_SET_URI')
+
+requires_replica_set = pytest.mark.skipif(not REPLICA_SET_URI, reason='MONGODB_REPLICA_SET_URI is not set')
+
+
+class Tokens(Collection):
+    """The token document of a notifier, recording the resume tokens it saved."""
+
+    def __init__(self):
+        super().__init__()
+        self.tokens = []
+
+    def update_one(self, query, update, upsert=False, session=None):
+        result = super().update_one(query, update, upsert)
+        if (result.matched_count or result.upserted_id) and 'token' in update.get('$set', {}):
+            self.tokens.append(update['$set']['token'])
+        return result
+
+
+@pytest.fixture
+def db(monkeypatch):
+    client = pymongo.MongoClient(REPLICA_SET_URI)
+    db = client['qarz_daftar_test_notifier']
+    client.drop_database(db.name)
+    monkeypatch.setattr(repository, 'shops_col', db['shops'])
+    monkeypatch.setattr(repository, 'debtor_chats_col', db['debtor_chats'])
+    repository.shops_cache.clear()
+    yield db
+    client.drop_database(db.name)
+    client.close()
+
+
+@requires_replica_set
+def test_burst_of_changes_is_one_notification_and_restarts_resume(db):
+    shop_id = db['shops'].insert_one({'name': 'Birnarsa Market', 'phone_number': '+998991352729'}).inserted_id
+    debtor_id = db['debtors'].insert_one({'shop_id': shop_id, 'phone_number': '+998901234567',
+                                          'debt_amount': 0}).inserted_id
+    db['debtor_chats'].insert_one({'_id': '+998901234567', 'chat_id': 42})
+
+    async def watch(outbox, changes):
+        notifier = BalanceNotifier(outbox, window=0.5, collection=db['debtors'], tokens=db['change_stream_tokens'])
+        notifier.start()
+        await asyncio.sleep(1)
+        for amount in changes:
+            db['debtors'].update_one({'_id': debtor_id}, {'$inc': {'debt_amount': amount}})
+        await asyncio.sleep(2)
+        await notifier.stop()
+
+    first = RecordingOutbox()
+    asyncio.run(watch(first, [10000, 5000, -3000]))
+    assert first.messages == [(42, "🔔 Birnarsa Market: your debt is now 12,000 so'm after 3 changes.\n\n"
+                                    "Please send /show_my_debts for details.")]
+
+    # made while no notifier runs, picked up from the saved resume token
+    db['debtors'].update_one({'_id': debtor_id}, {'$inc': {'debt_amount': -2000}})
+    second = RecordingOutbox()
+    asyncio.run(watch(second, []))
+    assert [text.split('.')[0] for _, text in second.messages] == ["🔔 Birnarsa Market: your debt is now 10,000 so'm"]
+
+
+def change(token, debt_amount):
+    return {'_id': token, 'fullDocument': {'phone_number': '+998901234567', 'shop_id': 1, 'debt_amount': debt_amount}}
+
+
+async def find_shop(shop_id):
+    return Shop('Birnarsa Market', None, '+998991352729')
+
+
+def notifier_without_stream(outbox, tokens, lease=30):
+    """A notifier whose changes are handed to it by the test instead of a change stream thread."""
+    notifier = BalanceNotifier(outbox, window=60, collection=None, tokens=tokens, lease=lease)
+    notifier._loop = asyncio.get_running_loop()
+    notifier._thread = threading.Thread(target=lambda: None)
+    notifier._thread.start()
+    return notifier
+
+
+def test_stop_sends_the_changes_of_a_flush_in_progress_with_the_newer_ones(monkeypatch):
+    lookups = []
+
+    async def find_debtor_chats(phone_numbers):
+        lookups.append(phone_numbers)
+        if len(lookups) == 1:
+            # the flush started by the window is still waiting for MongoDB when the bot stops
+            await asyncio.Event().wait()
+        return {'+998901234567': 42}
+
+    monkeypatch.setattr(repository, 'find_debtor_chats', find_debtor_chats)
+    monkeypatch.setattr(repository, 'find_shop', find_shop)
+    outbox, tokens = RecordingOutbox(), Tokens()
+
+    async def run():
+        notifier = notifier_without_stream(outbox, tokens)
+        assert notifier._acquire_lease()
+        notifier._add(change('first', 10000))
+        notifier._flush_handle.cancel()
+        notifier._start_flush()
+        await asyncio.sleep(0)
+        notifier._add(change('second', 7000))
+        await notifier.stop()
+
+    asyncio.run(run())
+
+    assert outbox.messages == [(42, "🔔 Birnarsa Market: your debt is now 7,000 so'm after 2 changes.\n\n"
+                                    "Please send /show_my_debts for details.")]
+    assert tokens.tokens == ['second']
+
+
+def test_changes_of_a_failed_flush_go_out_with_the_next_one(monkeypatch):
+    lookups = []
+
+    async def find_debtor_chats(phone_numbers):
+        lookups.append(phone_numbers)
+        if len(lookups) == 1:
+            raise ServerSelectionTimeoutError('timed out')
+        return {'+998901234567': 42}
+
+    monkeypatch.setattr(repository, 'find_debtor_chats', find_debtor_chats)
+    monkeypatch.setattr(repository, 'find_shop', find_shop)
+    outbox, tokens = RecordingOutbox(), Tokens()
+
+    async def run():
+        notifier = notifier_without_stream(outbox, tokens)
+        assert notifier._acquire_lease()
+        notifier._add(change('first', 10000))
+        notifier._flush_handle.cancel()
+        await notifier.flush()
+        assert (outbox.messages, tokens.tokens) == ([], [])
+        # the failed flush scheduled the retry
+        assert notifier._flush_handle is not None
+        notifier._add(change('second', 7000))
+        await notifier.stop()
+
+    asyncio.run(run())
+
+    assert outbox.messages == [(42, "🔔 Birnarsa Market: your debt is now 7,000 so'm after 2 changes.\n\n"
+                                    "Please send /show_my_debts for details.")]
+    assert tokens.tokens == ['second']
+
+
+def test_only_the_lease_holder_watches_and_saves_tokens(monkeypatch):
+    async def find_debtor_chats(phone_numbers):
+        return {'+998901234567': 42}
+
+    monkeypatch.setattr(repository, 'find_debtor_chats', find_debtor_chats)
+    monkeypatch.setattr(repository, 'find_shop', find_shop)
+    outbox, tokens = RecordingOutbox(), Tokens()
+
+    async def run():
+        first, second = notifier_without_stream(outbox, tokens), notifier_without_stream(outbox, tokens)
+        assert first._acquire_lease() and first._acquire_lease()
+        assert not second._acquire_lease()
+
+        # a notifier that lost its lease still sends what it has, but leaves the token to the lease holder
+        second._add(change('stale', 7000))
+        await second.stop()
+        first._add(change('first', 10000))
+        await first.stop()
+        assert tokens.tokens == ['first']
+
+        # a clean stop hands the lease over right away, an expired one is taken over too
+        third = notifier_without_stream(outbox, tokens, lease=0)
+        assert third._acquire_lease()
+        assert notifier_without_stream(outbox, tokens)._acquire_lease()
+
+    asyncio.run(run())
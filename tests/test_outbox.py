@@ -0,0 +1,55 @@
+import asyncio
+import time
+
+from telegram.error import RetryAfter
+
+from outbox import Outbox
+
+
+class RecordingBot:
+    def __init__(self, flood_controlled_sends=0):
+        self.sent = []
+        self.flood_controlled_sends = flood_controlled_sends
+
+    async def send_message(self, chat_id, text):
+        if self.flood_controlled_sends:
+            self.flood_controlled_sends -= 1
+            raise RetryAfter(0)
+        self.sent.append((chat_id, text, time.monotonic()))
+
+
+async def drain(outbox):
+    outbox.start()
+    await outbox.stop(timeout=5)
+
+
+def test_messages_to_one_chat_are_spaced_without_holding_up_other_chats():
+    bot = RecordingBot()
+
+    async def run():
+        outbox = Outbox(bot, rate=1000, chat_interval=0.05)
+        for text in ['a1', 'a2', 'a3']:
+            outbox.send(1, text)
+        outbox.send(2, 'b1')
+        await drain(outbox)
+
+    asyncio.run(run())
+
+    assert [text for _, text, _ in bot.sent] == ['a1', 'b1', 'a2', 'a3']
+    chat_times = [sent_at for chat_id, _, sent_at in bot.sent if chat_id == 1]
+    assert all(later - earlier >= 0.045 for earlier, later in zip(chat_times, chat_times[1:]))
+
+
+def test_flood_controlled_message_is_sent_again():
+    bot = RecordingBot(flood_controlled_sends=2)
+
+    async def run():
+        outbox = Outbox(bot, rate=1000)
+        outbox.send(1, 'reminder')
+        await drain(outbox)
+        return outbox
+
+    outbox = asyncio.run(run())
+
+    assert [text for _, text, _ in bot.sent] == ['reminder']
+    assert (outbox.sent, outbox.failed) == (1, 0)
@@ -0,0 +1,20 @@
+from datetime import datetime
+
+from bson import ObjectId
+
+import repository
+from fakes import Collection
+from models import Transaction
+
+
+def test_posting_to_a_deleted_debtor_writes_nothing_else(monkeypatch):
+    collections = {name: Collection() for name in ['debtors_col', 'ledger_col', 'shop_summaries_col']}
+    for name, collection in collections.items():
+        monkeypatch.setattr(repository, name, collection)
+    monkeypatch.setattr(repository, 'supports_transactions', lambda: False)
+    posting = (ObjectId(), ObjectId(), Transaction('debt', 5000, datetime.now()), 5000, {'name': 1}, None)
+
+    assert repository._post_transaction(*posting) == (None, None)
+    assert repository._post_transactions([posting]) == [(None, None)]
+    assert [name for name, _ in collections['debtors_col'].commands] == ['find_one_and_update', 'bulk_write', 'find']
+    assert collections['ledger_col'].commands == collections['shop_summaries_col'].commands == []
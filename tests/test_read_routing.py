@@ -0,0 +1,99 @@
+import asyncio
+import os
+from datetime import datetime
+
+import pymongo
+import pytest
+from pymongo import monitoring
+
+import database
+import repository
+from models import Transaction
+
+# a local three node replica set, e.g. three mongod --replSet rs0 on ports 27017-27019 and rs.initiate() with all three
+# members in mongosh: mongodb://localhost:27017,localhost:27018,localhost:27019/?replicaSet=rs0
+REPLICA_SET_URI = os.environ.get('MONGODB_THREE_NODE_REPLICA_SET_URI')
+
+pytestmark = pytest.mark.skipif(not REPLICA_SET_URI, reason='MONGODB_THREE_NODE_REPLICA_SET_URI is not set')
+
+
+class CommandRecorder(monitoring.CommandListener):
+    def __init__(self):
+        self.commands = []
+
+    def started(self, event):
+        self.commands.append((event.command_name, event.command.get(event.command_name), event.connection_id,
+                              event.command))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def sent_to(self, command_name, collection):
+        return [(address, command) for name, name_collection, address, command in self.commands
+                if name == command_name and name_collection == collection]
+
+
+@pytest.fixture
+def recorder(monkeypatch):
+    recorder = CommandRecorder()
+    client = pymongo.MongoClient(REPLICA_SET_URI, event_listeners=[recorder])
+    db_name = 'qarz_daftar_test_read_routing'
+    client.drop_database(db_name)
+    monkeypatch.setattr(database, '_client', client)
+    monkeypatch.setenv('MONGODB_DATABASE', db_name)
+    for name, collection in [('debtors_col', 'debtors'), ('shops_col', 'shops'), ('ledger_col', 'ledger'),
+                             ('shop_summaries_col', 'shop_summaries')]:
+        monkeypatch.setattr(repository, name, database.LazyCollection(collection))
+    monkeypatch.setattr(repository, 'debtors_secondary_col', database.LazyCollection('debtors', secondary_reads=True))
+    monkeypatch.setattr(repository, 'ledger_secondary_col', database.LazyCollection('ledger', secondary_reads=True))
+    repository.shops_cache.clear()
+    repository.debtors_cache.clear()
+    repository.recent_writes.clear()
+    yield recorder
+    client.drop_database(db_name)
+    client.close()
+
+
+def seed(client):
+    # w: 3, so the secondaries have the debtors before the reads below
+    db = client.get_database(os.environ['MONGODB_DATABASE'], write_concern=pymongo.WriteConcern(w=3))
+    shop_id = db['shops'].insert_one({'name': 'shop', 'phone_number': '+998000000000'}).inserted_id
+    debtor_id = db['debtors'].insert_one({'shop_id': shop_id, 'name': 'debtor', 'phone_number': '+998901234567',
+                                          'debt_amount': 0}).inserted_id
+    return shop_id, debtor_id
+
+
+def test_lists_are_read_from_secondaries(recorder):
+    client = database.get_client()
+    shop_id, _ = seed(client)
+
+    debtors = asyncio.run(repository.find_debtors_page(shop_id, 'debt'))
+
+    assert [debtor.name for debtor in debtors] == ['debtor']
+    [(address, command)] = recorder.sent_to('find', 'debtors')
+    assert address in client.secondaries
+    assert 'afterClusterTime' not in command.get('readConcern', {})
+
+
+def test_own_postings_are_read_back_causally(recorder):
+    client = database.get_client()
+    shop_id, debtor_id = seed(client)
+
+    async def post_and_read():
+        transaction = Transaction('debt', 5000, datetime.now())
+        debtor = await repository.post_transaction(debtor_id, shop_id, transaction, 5000, {'name': 1})
+        return debtor, await repository.find_transactions_page(debtor_id), await repository.find_debtor(debtor_id)
+
+    debtor, transactions, card = asyncio.run(post_and_read())
+
+    assert debtor.debt_amount == card.debt_amount == 5000
+    assert [transaction.amount for _, transaction in transactions] == [5000]
+    [(address, command)] = recorder.sent_to('find', 'ledger')
+    assert address in client.secondaries
+    assert 'afterClusterTime' in command.get('readConcern')
+    # the debtor card shown after a posting comes from the primary
+    [(address, _)] = recorder.sent_to('find', 'debtors')
+    assert address == client.primary
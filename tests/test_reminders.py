@@ -0,0 +1,44 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+import repository
+from fakes import Collection
+
+
+class SweptDebtors(Collection):
+    """In-memory debtors whose finds wait for each other, so that every sweeper reads the same due debtors."""
+
+    def __init__(self, docs, sweepers):
+        super().__init__(docs)
+        self.barrier = threading.Barrier(sweepers)
+        self.lock = threading.Lock()
+
+    def find(self, query=None, projection=None, session=None):
+        with self.lock:
+            found = super().find(query, projection)
+        self.barrier.wait(timeout=5)
+        return found
+
+    def update_one(self, query, update, upsert=False, session=None):
+        with self.lock:
+            return super().update_one(query, update)
+
+
+def test_concurrent_sweeps_claim_every_reminder_once(monkeypatch):
+    now = datetime(2024, 5, 1, 12)
+    shop_id = ObjectId()
+    debtors = [{'_id': ObjectId(), 'shop_id': shop_id, 'name': 'debtor {}'.format(i), 'debt_amount': 1000,
+                'remind_at': now - timedelta(hours=i)} for i in range(20)]
+    swept = SweptDebtors(debtors, sweepers=2)
+    monkeypatch.setattr(repository, 'debtors_col', swept)
+    monkeypatch.setattr(repository, 'shops_col', Collection([{'_id': shop_id, 'name': 'shop', 'reminder_days': 3}]))
+
+    with ThreadPoolExecutor(2) as executor:
+        sweeps = [executor.submit(repository._claim_due_reminders, now, 100, {'name': 1}) for _ in range(2)]
+        claimed = [debtor.id for sweep in sweeps for debtor, shop in sweep.result()]
+
+    assert sorted(claimed) == sorted(debtor['_id'] for debtor in debtors)
+    assert all(doc['remind_at'] == now + timedelta(days=3) for doc in swept.docs)
@@ -0,0 +1,17 @@
+from datetime import datetime
+
+import reports
+
+
+def test_report_periods_end_with_the_open_period():
+    now = datetime(2024, 3, 13, 15, 30)
+
+    assert reports.report_periods('day', now)[-2:] == [datetime(2024, 3, 12), datetime(2024, 3, 13)]
+    assert reports.report_periods('week', now)[-2:] == [datetime(2024, 3, 4), datetime(2024, 3, 11)]
+    assert reports.report_periods('month', now) == [datetime(2023, 10, 1), datetime(2023, 11, 1), datetime(2023, 12, 1),
+                                                    datetime(2024, 1, 1), datetime(2024, 2, 1), datetime(2024, 3, 1)]
+
+
+def test_next_period_start_crosses_month_and_year():
+    assert reports.next_period_start('month', datetime(2023, 12, 1)) == datetime(2024, 1, 1)
+    assert reports.next_period_start('day', datetime(2024, 2, 29)) == datetime(2024, 3, 1)
@@ -0,0 +1,61 @@
+import asyncio
+import random
+
+from bson import ObjectId
+
+import repository
+from fakes import Collection, FakeCursor
+from search import normalize, search_keys, match_score
+
+
+def test_normalize_transliterates_cyrillic_and_drops_apostrophes():
+    assert normalize("G'ulomov  Ғулом-ака") == 'gulomov gulom aka'
+    assert normalize('Ўткир') == normalize("O‘tkir") == 'otkir'
+
+
+def test_search_keys_contain_full_texts_and_words():
+    assert search_keys('Валиев Али', 'Ali aka') == ['valiev ali', 'valiev', 'ali', 'ali aka', 'aka']
+    assert search_keys('Ali', None) == ['ali']
+
+
+def test_exact_match_ranks_above_prefix_and_prefix_above_fuzzy():
+    exact = match_score('ali', search_keys('Ali'))
+    prefix = match_score('ali', search_keys('Alisher'))
+    fuzzy = match_score('alisher', search_keys('Alishir'))
+
+    assert exact > prefix > fuzzy > 0
+    assert match_score('ali', search_keys('Bobur')) == 0
+
+
+class SearchIndexCursor(FakeCursor):
+    prefix = None
+
+    def hint(self, index):
+        assert index == repository.SEARCH_INDEX
+        # an index scan meets every document at its alphabetically first key in the scanned range
+        return self.sort(key=lambda doc: min(key for key in doc['search_keys'] if key.startswith(self.prefix)))
+
+
+class Debtors(Collection):
+    cursor_class = SearchIndexCursor
+
+    def find(self, query=None, projection=None, session=None):
+        cursor = super().find(query, projection, session)
+        cursor.prefix = query['search_keys']['$regex'][1:]
+        return cursor
+
+
+def test_fuzzy_candidates_do_not_depend_on_the_order_documents_are_stored_in(monkeypatch):
+    shop_id = ObjectId()
+    docs = [{'_id': ObjectId(), 'shop_id': shop_id, 'name': name, 'search_keys': search_keys(name)}
+            for name in ['Alo {:03d}'.format(number) for number in range(repository.SEARCH_CANDIDATES_LIMIT + 50)]]
+    docs.append({'_id': ObjectId(), 'shop_id': shop_id, 'name': 'Alishir', 'search_keys': search_keys('Alishir')})
+    monkeypatch.setattr(repository, 'debtors_secondary_col', Debtors(docs))
+    repository.recent_writes.clear()
+
+    first = asyncio.run(repository.search_debtors(shop_id, 'Alisher', 5))
+    random.Random(0).shuffle(docs)
+    second = asyncio.run(repository.search_debtors(shop_id, 'Alisher', 5))
+
+    assert first[0].name == 'Alishir'
+    assert [debtor.id for debtor in first] == [debtor.id for debtor in second]
@@ -0,0 +1,98 @@
+import os
+from datetime import datetime, timedelta
+
+import pymongo
+import pytest
+from bson import ObjectId
+
+import repository
+from fakes import Collection
+from models import Transaction
+
+# any MongoDB, e.g. a local mongod: mongodb://localhost:27017/
+TEST_URI = os.environ.get('MONGODB_TEST_URI')
+
+SUMMARY_FIELDS = ['total_outstanding', 'arrears_count', 'today_debts', 'today_payments', 'day']
+
+
+def post_mixed(shop_id, debtor_ids):
+    """
+    Posts debts and payments yesterday and today, one by one and as a group commit batch with several postings to one
+    debtor, bringing balances to zero and back. Returns the balances the batch's postings reported.
+    """
+    a, b, c = debtor_ids
+    now = datetime.now().replace(microsecond=0)
+    yesterday = now - timedelta(days=1)
+
+    def posting(debtor_id, kind, amount, timestamp, reminder_days=None):
+        delta = amount if kind == 'debt' else -amount
+        return debtor_id, shop_id, Transaction(kind, amount, timestamp), delta, None, reminder_days
+
+    for single in [posting(a, 'debt', 2000, yesterday), posting(b, 'debt', 1000, yesterday),
+                   posting(b, 'payment', 1000, yesterday), posting(a, 'payment', 5000, now),
+                   posting(c, 'debt', 4000, now)]:
+        repository._post_transaction(*single)
+    batch = [posting(b, 'debt', 500, now, 3), posting(b, 'payment', 500, now, 3), posting(b, 'debt', 700, now, 3),
+             posting(c, 'payment', 4000, now, 3), posting(a, 'debt', 100, now, 3)]
+    return [debtor.debt_amount for debtor, _ in repository._post_transactions(batch)]
+
+
+def seed(shop_id):
+    # debtor a already owes 3000 and the summary knows it from a day long gone
+    debtor_ids = [ObjectId(), ObjectId(), ObjectId()]
+    debtors = [{'_id': debtor_id, 'shop_id': shop_id, 'debt_amount': balance}
+               for debtor_id, balance in zip(debtor_ids, [3000, 0, 0])]
+    summary = {'_id': shop_id, 'debtor_count': 3, 'total_outstanding': 3000, 'arrears_count': 1, 'today_debts': 3000,
+               'today_payments': 0, 'day': datetime(2020, 1, 1), 'version': 1}
+    return debtor_ids, debtors, summary
+
+
+def test_summary_kept_by_postings_matches_the_debtors_and_todays_ledger(monkeypatch):
+    shop_id = ObjectId()
+    debtor_ids, debtors, summary = seed(shop_id)
+    debtors_col, ledger_col, summaries_col = Collection(debtors), Collection(), Collection([summary])
+    monkeypatch.setattr(repository, 'debtors_col', debtors_col)
+    monkeypatch.setattr(repository, 'ledger_col', ledger_col)
+    monkeypatch.setattr(repository, 'shop_summaries_col', summaries_col)
+    monkeypatch.setattr(repository, 'supports_transactions', lambda: False)
+
+    assert post_mixed(shop_id, debtor_ids) == [500, 0, 700, 0, 100]
+
+    balances = [debtor['debt_amount'] for debtor in debtors_col.docs]
+    today = repository.summary_day(datetime.now())
+    transactions = [transaction for bucket in ledger_col.docs for transaction in bucket['transactions']
+                    if transaction['timestamp'] >= today]
+    assert balances == [100, 700, 0]
+    assert {field: summaries_col.docs[0][field] for field in SUMMARY_FIELDS} == {
+        'total_outstanding': sum(balances),
+        'arrears_count': sum(1 for balance in balances if balance > 0),
+        'today_debts': sum(t['amount'] for t in transactions if t['type'] == 'debt'),
+        'today_payments': sum(t['amount'] for t in transactions if t['type'] == 'payment'),
+        'day': today,
+    }
+    assert 'remind_at' not in debtors_col.docs[2] and 'remind_at' in debtors_col.docs[1]
+
+
+@pytest.mark.skipif(not TEST_URI, reason='MONGODB_TEST_URI is not set')
+def test_summary_kept_by_postings_matches_a_rebuild(monkeypatch):
+    client = pymongo.MongoClient(TEST_URI)
+    db = client['qarz_daftar_test_shop_summary']
+    client.drop_database(db.name)
+    for name, collection in [('debtors_col', 'debtors'), ('ledger_col', 'ledger'),
+                             ('shop_summaries_col', 'shop_summaries')]:
+        monkeypatch.setattr(repository, name, db[collection])
+    monkeypatch.setattr(repository, 'supports_transactions', lambda: False)
+    try:
+        shop_id = ObjectId()
+        debtor_ids, debtors, summary = seed(shop_id)
+        db['debtors'].insert_many(debtors)
+        db['shop_summaries'].insert_one(summary)
+
+        post_mixed(shop_id, debtor_ids)
+
+        kept = db['shop_summaries'].find_one({'_id': shop_id})
+        rebuilt = repository.rebuild_shop_summary(shop_id)
+        assert {field: kept[field] for field in SUMMARY_FIELDS} == {field: rebuilt[field] for field in SUMMARY_FIELDS}
+    finally:
+        client.drop_database(db.name)
+        client.close()
@@ -0,0 +1,62 @@
+import asyncio
+from datetime import datetime
+
+from telegram import Update, Message, Chat, User
+
+from update_processor import PerUserUpdateProcessor
+
+
+def make_update(update_id, user_id):
+    user = User(user_id, 'user {}'.format(user_id), False)
+    return Update(update_id, message=Message(update_id, datetime.now(), Chat(user_id, Chat.PRIVATE), from_user=user))
+
+
+def test_updates_of_one_user_are_processed_in_order_and_users_concurrently():
+    events = []
+
+    async def handle(update_id, user_id, delay):
+        events.append(('start', user_id, update_id))
+        await asyncio.sleep(delay)
+        events.append(('end', user_id, update_id))
+
+    async def run():
+        processor = PerUserUpdateProcessor(max_concurrent_updates=8)
+        updates = [(1, 1, 0.03), (2, 1, 0.01), (3, 2, 0.01), (4, 1, 0.0), (5, 2, 0.0)]
+        await asyncio.gather(*(processor.process_update(make_update(update_id, user_id),
+                                                        handle(update_id, user_id, delay))
+                               for update_id, user_id, delay in updates))
+        return processor
+
+    processor = asyncio.run(run())
+
+    user_1 = [(kind, update_id) for kind, user_id, update_id in events if user_id == 1]
+    assert user_1 == [('start', 1), ('end', 1), ('start', 2), ('end', 2), ('start', 4), ('end', 4)]
+    # user 2 finished while user 1 was still busy with its first update
+    assert events.index(('end', 2, 5)) < events.index(('end', 1, 1))
+    assert processor._locks == {}
+
+
+def test_updates_waiting_for_their_user_do_not_hold_concurrency_slots():
+    async def run():
+        processor = PerUserUpdateProcessor(max_concurrent_updates=2)
+        busy = asyncio.Event()
+        done = []
+
+        async def handle(update_id, user_id, release=None):
+            if release is not None:
+                await release.wait()
+            done.append((user_id, update_id))
+
+        # user 1's first update blocks, its four followers queue up behind it
+        user_1 = [asyncio.create_task(processor.process_update(make_update(1, 1), handle(1, 1, busy)))]
+        user_1 += [asyncio.create_task(processor.process_update(make_update(update_id, 1), handle(update_id, 1)))
+                   for update_id in range(2, 6)]
+        await asyncio.sleep(0)
+        await asyncio.wait_for(processor.process_update(make_update(6, 2), handle(6, 2)), 1)
+        assert done == [(2, 6)]
+
+        busy.set()
+        await asyncio.gather(*user_1)
+        assert done[1:] == [(1, update_id) for update_id in range(1, 6)]
+
+    asyncio.run(run())
@@ -0,0 +1,61 @@
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# limit of the base class' semaphore, never reached: the real limit is enforced in do_process_update
+UNLIMITED = 2 ** 31 - 1
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates of different users concurrently, while the updates of one user are processed strictly one
+    after another in the order they arrived, so the user's `main_conv` state transitions stay correct.
+    """
+
+    __slots__ = ('_locks', '_concurrency', 'concurrency_limit')
+
+    def __init__(self, max_concurrent_updates: int):
+        # the base class takes its semaphore before do_process_update, while the user's lock has to come first, so
+        # that updates waiting for their user's earlier ones do not hold concurrency slots other users could run in
+        super().__init__(UNLIMITED)
+        if max_concurrent_updates < 1:
+            raise ValueError('`max_concurrent_updates` must be a positive integer!')
+        self.concurrency_limit = max_concurrent_updates
+        self._concurrency = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # user or chat id -> [lock, number of updates holding or waiting for it]
+        self._locks = {}
+
+    @staticmethod
+    def _update_key(update):
+        if isinstance(update, Update):
+            if update.effective_user is not None:
+                return 'user', update.effective_user.id
+            if update.effective_chat is not None:
+                return 'chat', update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine) -> None:
+        key = self._update_key(update)
+        if key is None:
+            async with self._concurrency:
+                await coroutine
+            return
+
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            # asyncio.Lock wakes its waiters first in, first out, which keeps the arrival order
+            async with entry[0]:
+                async with self._concurrency:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass